@@ -5,6 +5,21 @@
 [info][title]在庫数アラート[/title]
 ポータル名: {{ alert.portal_name }}, 商品コード: {{ alert.product_code }}
 最低在庫数:{{ alert.portal_min_product_stock_num }}
+現在在庫数:{% if alert.stock_missing %}在庫データなし（前回通知時 {{ alert.portal_product_stock_num }}）{% else %}{{ alert.portal_product_stock_num }}{% endif %}
+[/info]
+{% endfor %}
+{% for alert in recovered %}
+[info][title]在庫数回復[/title]
+ポータル名: {{ alert.portal_name }}, 商品コード: {{ alert.product_code }}
+{% if alert.threshold_removed %}最低在庫数の定義が削除されたため、通知を終了します{% else %}最低在庫数:{{ alert.portal_min_product_stock_num }}
+現在在庫数:{{ alert.portal_product_stock_num }}{% endif %}
+[/info]
+{% endfor %}
+{% for alert in forecasts %}
+[info][title]在庫切れ予測[/title]
+ポータル名: {{ alert.portal_name }}, 商品コード: {{ alert.product_code }}
+最低在庫数:{{ alert.portal_min_product_stock_num }}
 現在在庫数:{{ alert.portal_product_stock_num }}
+最低在庫数到達まで: 約{{ alert.days_until_threshold }}日（1日あたり {{ alert.daily_decrease }} 減少）
 [/info]
 {% endfor %}
@@ -1,14 +1,18 @@
 # -*- coding: utf-8 -*-
 """
 アラート文の組み立てと ChatWork API への送信。
-トークンは環境変数 CHATWORK_API_TOKEN で渡す。
+トークンは環境変数 CHATWORK_API_TOKEN（または .env）で渡す。
+jinja2 はアラート文を組み立てる時、requests / python-dotenv は送信する時に初めて読み込む
+（アラートのないポータルでは読み込まない）。
 """
 import os
+import re
+from functools import lru_cache
 from pathlib import Path
-from typing import Any
+from typing import TYPE_CHECKING, Any, Iterable, Iterator
 
-import requests
-from jinja2 import Environment, FileSystemLoader
+if TYPE_CHECKING:
+    from jinja2 import Environment, Template
 
 
 # 環境変数キー（トークン）
@@ -17,76 +21,167 @@ CHATWORK_TOKEN_ENV = "CHATWORK_API_TOKEN"
 # 1メッセージの最大文字数（ChatWork 制限に合わせて分割する場合用）
 MESSAGE_MAX_LENGTH = 10000
 
+# アラート1件分のブロックの開始位置（分割はここでのみ行う）
+_BLOCK_START = re.compile(r"^\[info\]", re.MULTILINE)
+
 # テンプレートディレクトリ（プロジェクトルート）
 _TEMPLATE_DIR = Path(__file__).resolve().parent.parent
 
 
-def build_alert_message(alerts: list[dict[str, Any]], chatwork_config: dict[str, Any] | None = None) -> str:
+def _template_alert(a: dict[str, Any]) -> dict[str, Any]:
+    """テンプレート用にアラートを整形する。"""
+    return {
+        "portal_name": a.get("portal_name", ""),
+        "product_code": a.get("product_code", ""),
+        "portal_min_product_stock_num": a.get("min_stock", 0),
+        "portal_product_stock_num": a.get("current_stock", 0),
+        "days_until_threshold": a.get("days_until_threshold"),
+        "daily_decrease": a.get("daily_decrease"),
+        "stock_missing": a.get("stock_missing", False),
+        "threshold_removed": a.get("threshold_removed", False),
+    }
+
+
+@lru_cache(maxsize=1)
+def _environment() -> "Environment":
+    """テンプレート用の Environment（プロセスで1つ）。コンパイル済みテンプレートはこの中にキャッシュされる。"""
+    from jinja2 import Environment, FileSystemLoader
+
+    return Environment(loader=FileSystemLoader(_TEMPLATE_DIR))
+
+
+def load_template() -> "Template":
+    """コンパイル済みの alert_message.tpl を返す（ファイルの更新日時が変わった場合だけ読み直す）。"""
+    return _environment().get_template("alert_message.tpl")
+
+
+@lru_cache(maxsize=1)
+def _load_dotenv() -> None:
+    """.env を環境変数に読み込む（プロセスで1回）。"""
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+
+def _render_chunks(
+    alerts: list[dict[str, Any]],
+    chatwork_config: dict[str, Any] | None,
+    recovered: list[dict[str, Any]] | None,
+    forecasts: list[dict[str, Any]] | None = None,
+) -> Iterator[str]:
+    """alert_message.tpl を template.generate() で少しずつ出力する。"""
+    mention_members = []
+    if chatwork_config:
+        mention_members = chatwork_config.get("mention_members") or []
+
+    return load_template().generate(
+        mention_members=mention_members,
+        alerts=(_template_alert(a) for a in alerts),
+        recovered=(_template_alert(a) for a in recovered or []),
+        forecasts=(_template_alert(a) for a in forecasts or []),
+    )
+
+
+def build_alert_message(
+    alerts: list[dict[str, Any]],
+    chatwork_config: dict[str, Any] | None = None,
+    recovered: list[dict[str, Any]] | None = None,
+    forecasts: list[dict[str, Any]] | None = None,
+) -> str:
     """
     アラート一覧から alert_message.tpl を用いて1本のメッセージ文を組み立てる。
     テンプレート変数:
       - mention_members: setting.json の chatwork.mention_members
-      - alerts: 各要素は portal_name, product_code, portal_min_product_stock_num, portal_product_stock_num
+      - alerts: 各要素は portal_name, product_code, portal_min_product_stock_num, portal_product_stock_num,
+                stock_missing（在庫データに現れなかった未回復のアラートの再通知。在庫数は前回通知時のもの）
+      - recovered: 最低在庫数を上回って回復したもの（alerts と同じ形式。threshold_removed は最低在庫数定義から削除されたもの）
+      - forecasts: 減少傾向から最低在庫数への到達が近いと予測したもの（alerts の形式に days_until_threshold, daily_decrease を加えたもの）
+    送信用には分割済みの文を直接作る build_alert_payloads を使う。
     """
-    mention_members = []
-    if chatwork_config:
-        mention_members = chatwork_config.get("mention_members") or []
+    return "".join(_render_chunks(alerts, chatwork_config, recovered, forecasts))
+
+
+def _iter_segments(chunks: Iterable[str]) -> Iterator[str]:
+    """文字列の断片を順に受け取り、アラート1件分のブロック（[info]）の境目で区切って返す。"""
+    pending = ""  # 次のブロックの開始がまだ来ていない（終わりが確定していない）部分
+    for chunk in chunks:
+        pending += chunk
+        start = 0
+        for m in _BLOCK_START.finditer(pending, 1):
+            yield pending[start:m.start()]
+            start = m.start()
+        if start:
+            pending = pending[start:]
+    if pending:
+        yield pending
+
+
+def _pack_segments(chunks: Iterable[str], max_length: int) -> Iterator[str]:
+    """
+    ブロックを max_length 文字以内に詰めた送信単位を返す。先頭のメンション部分は最初の送信単位に含める。
+    1ブロックだけで max_length を超える場合はそのブロックを文字数で分割する。
+    """
+    current = ""
+    for segment in _iter_segments(chunks):
+        if len(current) + len(segment) <= max_length:
+            current += segment
+            continue
+        if current:
+            yield current
+        while len(segment) > max_length:
+            yield segment[:max_length]
+            segment = segment[max_length:]
+        current = segment
+    if current:
+        yield current
 
-    # テンプレート用にアラートを整形
-    template_alerts = [
-        {
-            "portal_name": a.get("portal_name", ""),
-            "product_code": a.get("product_code", ""),
-            "portal_min_product_stock_num": a.get("min_stock", 0),
-            "portal_product_stock_num": a.get("current_stock", 0),
-        }
-        for a in alerts
-    ]
 
-    env = Environment(loader=FileSystemLoader(_TEMPLATE_DIR))
-    template = env.get_template("alert_message.tpl")
-    return template.render(mention_members=mention_members, alerts=template_alerts)
+def build_alert_payloads(
+    alerts: list[dict[str, Any]],
+    chatwork_config: dict[str, Any] | None = None,
+    recovered: list[dict[str, Any]] | None = None,
+    forecasts: list[dict[str, Any]] | None = None,
+    max_length: int = MESSAGE_MAX_LENGTH,
+) -> list[str]:
+    """
+    build_alert_message と同じ文を、1本に連結せずに max_length 文字以内の送信単位で組み立てる。
+    テンプレートの出力を順に分割していくため、メッセージ全体を2重に持たない。
+    """
+    return list(_pack_segments(_render_chunks(alerts, chatwork_config, recovered, forecasts), max_length))
 
 
-def send_to_chatwork(chatwork_config: dict[str, Any], message: str) -> tuple[bool, str | None]:
+def split_message(message: str, max_length: int = MESSAGE_MAX_LENGTH) -> list[str]:
+    """
+    組み立て済みのメッセージを max_length 文字以内に分割する。分割位置はアラート1件分のブロック（[info]）の境目に限る。
+    """
+    if len(message) <= max_length:
+        return [message]
+    return list(_pack_segments([message], max_length))
+
+
+def send_to_chatwork(
+    chatwork_config: dict[str, Any], message: str | list[str], delivered: set[tuple[str, str]] | None = None
+) -> tuple[bool, str | None]:
     """
     setting.json の chatwork 設定とメッセージで ChatWork に送信する。
+    message は1本の文（ブロック単位で分割して送る）か、build_alert_payloads で分割済みの文のリスト。
     トークンは環境変数 CHATWORK_API_TOKEN から取得。
+    room_id はリストで複数指定でき、ルームごとに並行して送る。
+    送信間隔の制御・再送は app.chatwork_client が行う（chatwork.rate_limit / chatwork.retry）。
+    delivered を渡すと送信済みの (ルーム ID, メッセージのダイジェスト) は送らず、送れたものを加える。
     戻り値: (成功可否, 失敗時のエラー内容)
     """
+    _load_dotenv()
     token = os.environ.get(CHATWORK_TOKEN_ENV)
     if not token:
         return False, "CHATWORK_API_TOKEN が未設定です。.env を確認してください。"
 
-    base_url = (chatwork_config.get("api_base_url") or "https://api.chatwork.com").rstrip("/")
-    room_id = chatwork_config.get("room_id")
-    endpoint_tpl = chatwork_config.get("message_endpoint") or "/v2/rooms/{room_id}/messages"
-    if not room_id:
-        return False, "room_id が未設定です。setting.json を確認してください。"
+    from app.chatwork_client import get_client, room_ids_of
 
-    endpoint = endpoint_tpl.replace("{room_id}", str(room_id))
-    url = f"{base_url}{endpoint}"
+    room_ids = room_ids_of(chatwork_config)
+    if not room_ids:
+        return False, "room_id が未設定です。setting.json を確認してください。"
 
-    # 長文は分割
-    payloads = []
-    if len(message) <= MESSAGE_MAX_LENGTH:
-        payloads.append(message)
-    else:
-        start = 0
-        while start < len(message):
-            payloads.append(message[start : start + MESSAGE_MAX_LENGTH])
-            start += MESSAGE_MAX_LENGTH
-
-    for body in payloads:
-        try:
-            resp = requests.post(
-                url,
-                headers={"X-ChatWorkToken": token},
-                data={"body": body},
-                timeout=30,
-            )
-        except requests.RequestException as e:
-            return False, f"通信エラー: {e}"
-        if resp.status_code not in (200, 201):
-            return False, f"HTTP {resp.status_code}: {resp.text[:500]}"
-    return True, None
+    # 長文はアラートのブロック単位で分割
+    payloads = split_message(message, MESSAGE_MAX_LENGTH) if isinstance(message, str) else message
+    return get_client(token, chatwork_config).send(room_ids, payloads, delivered)
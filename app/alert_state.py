@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+アラートの送信状態（ポータル・返礼品コードごとに、最後に通知した在庫数と日付）をローカルの SQLite に保存する。
+前回から変化のないアラートは再送せず、新規・悪化・回復したものだけを通知するために使う。
+同じ状態が続く場合も、renotify_days 日経過すれば再通知する。
+"""
+import sqlite3
+from datetime import date
+from pathlib import Path
+from typing import AbstractSet, Any, Mapping, NamedTuple
+
+# 同じアラートを再通知するまでの日数のデフォルト（0 なら再通知しない）
+DEFAULT_RENOTIFY_DAYS = 7
+
+# 在庫切れ予測の通知状態は「ポータル名 + この接尾辞」で保存する（在庫数アラートとは別に管理する）
+FORECAST_STATE_SUFFIX = ":forecast"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS alert_state (
+    portal TEXT NOT NULL,
+    product_code TEXT NOT NULL,
+    last_stock INTEGER NOT NULL,
+    min_stock INTEGER NOT NULL,
+    alerted_on TEXT NOT NULL,
+    PRIMARY KEY (portal, product_code)
+)
+"""
+
+
+class AlertState(NamedTuple):
+    """最後に通知したときの在庫数・最低在庫数と通知日（ISO 形式）。"""
+
+    last_stock: int
+    min_stock: int
+    alerted_on: str
+
+
+class AlertDiff(NamedTuple):
+    """今回通知するもの。notify は新規・悪化・再通知、recovered は最低在庫数を上回って回復したもの。"""
+
+    notify: list[dict[str, Any]]
+    recovered: list[dict[str, Any]]
+
+
+def diff_alerts(
+    portal_name: str,
+    alerts: list[dict[str, Any]],
+    stock_by_code: Mapping[str, int],
+    previous: dict[str, AlertState],
+    today: date,
+    renotify_days: int = DEFAULT_RENOTIFY_DAYS,
+    notify_worsened: bool = True,
+    defined: AbstractSet[str] | None = None,
+    remind_missing: bool = True,
+) -> AlertDiff:
+    """
+    今回のアラートと前回の通知状態を比べ、通知するものを選ぶ。
+    - 前回通知していない → 新規
+    - 前回通知時より在庫数が減った → 悪化（notify_worsened=False の場合は通知しない。在庫切れ予測用）
+    - 前回通知から renotify_days 日以上経過 → 再通知
+    前回通知したもののうちアラート対象でなくなったものは、最低在庫数の定義があるコードの集合 defined に照らして解決する。
+    - 今回の在庫データにある → 回復
+    - defined にない（最低在庫数定義から削除された）→ 回復（threshold_removed。在庫データにない場合の在庫数は None）
+    - 定義はあるが在庫データに現れなかった → 判断できないため状態を残し、remind_missing なら renotify_days 日以上経過した時点で
+      在庫データなし（stock_missing。在庫数は前回通知時のもの）として再通知する
+    defined を渡さない場合は、在庫データに現れなかったコードをすべて定義ありとみなす。
+    """
+    notify: list[dict[str, Any]] = []
+    alerted_codes = set()
+    for alert in alerts:
+        code = alert["product_code"]
+        alerted_codes.add(code)
+        state = previous.get(code)
+        if (
+            state is None
+            or (notify_worsened and alert["current_stock"] < state.last_stock)
+            or _renotify_due(state, today, renotify_days)
+        ):
+            notify.append(alert)
+
+    recovered: list[dict[str, Any]] = []
+    for code, state in previous.items():
+        if code in alerted_codes:
+            continue
+        resolved = {
+            "portal_name": portal_name,
+            "product_code": code,
+            "current_stock": stock_by_code.get(code),
+            "min_stock": state.min_stock,
+        }
+        if defined is not None and code not in defined:
+            recovered.append({**resolved, "threshold_removed": True})
+        elif code in stock_by_code:
+            recovered.append(resolved)
+        elif remind_missing and _renotify_due(state, today, renotify_days):
+            notify.append({**resolved, "current_stock": state.last_stock, "stock_missing": True})
+    return AlertDiff(notify, recovered)
+
+
+def _renotify_due(state: AlertState, today: date, renotify_days: int) -> bool:
+    return renotify_days > 0 and (today - date.fromisoformat(state.alerted_on)).days >= renotify_days
+
+
+class AlertStateStore:
+    """アラートの送信状態の SQLite 保存先。1プロセス（1スレッド）内で使う。"""
+
+    def __init__(self, db_path: Path):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(db_path), timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+
+    def load(self, portal: str) -> dict[str, AlertState]:
+        """ポータルの通知状態を返礼品コード → AlertState で返す。"""
+        rows = self._conn.execute(
+            "SELECT product_code, last_stock, min_stock, alerted_on FROM alert_state WHERE portal = ?", (portal,)
+        ).fetchall()
+        return {code: AlertState(last_stock, min_stock, alerted_on) for code, last_stock, min_stock, alerted_on in rows}
+
+    def record(self, portal: str, diff: AlertDiff, today: date) -> None:
+        """送信に成功した通知を保存する。通知したものは在庫数と日付を更新し、回復したものは削除する。"""
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO alert_state (portal, product_code, last_stock, min_stock, alerted_on)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [(portal, a["product_code"], a["current_stock"], a["min_stock"], today.isoformat()) for a in diff.notify],
+            )
+            self._conn.executemany(
+                "DELETE FROM alert_state WHERE portal = ? AND product_code = ?",
+                [(portal, a["product_code"]) for a in diff.recovered],
+            )
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def open_alert_state(cache_dir: Path, settings: dict[str, Any]) -> AlertStateStore | None:
+    """setting.json の alert_state 設定に従って通知状態の保存先を開く。無効または開けない場合は None。"""
+    conf = settings.get("alert_state") or {}
+    if not conf.get("enabled", True):
+        return None
+    try:
+        return AlertStateStore(cache_dir / "alert_state.sqlite3")
+    except sqlite3.Error:
+        return None
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+アーカイブディレクトリの監視（run_all_portals.py --watch 用）。
+日付ディレクトリ（yyyy-MM-dd）配下のポータル名ディレクトリごとに、データファイルのパス・サイズ・更新日時を記録し、
+watch.stable_sec 秒変化がなくなったものを処理対象として返す。処理後にファイルが増えた・変わった場合は再度処理対象にする。
+
+変更の検知は Linux では inotify（ctypes 経由）を使い、使えない環境（Windows 等）ではポーリングする。
+inotify でも watch.poll_interval_sec ごとに走査し直すため、通知の届かない変更（ネットワークドライブ等）も取りこぼさない。
+"""
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import struct
+import sys
+import time
+from datetime import date
+from pathlib import Path
+from typing import Any, Callable, NamedTuple
+
+from app.data_source import ARCHIVE_EXTENSIONS, Source, expand_archives
+from app.dir_walker import ScanOptions, list_data_files
+from app.stock_parser import CHOICE_CHANGE_STOCK_SUFFIX, DATA_EXTENSIONS
+
+DATE_DIR_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+# 既定値（setting.json の watch で上書き）
+DEFAULT_STABLE_SEC = 60.0
+DEFAULT_POLL_INTERVAL_SEC = 10.0
+DEFAULT_WATCH_MODE = "auto"
+
+# 監視する日付ディレクトリの数（新しいものから）。日付が変わった直後に前日分の残りも拾えるよう 2 日分
+ACTIVE_DATE_DIRS = 2
+
+# inotify のイベント（linux/inotify.h）
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_WATCH_MASK = _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_ONLYDIR
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class WatchOptions(NamedTuple):
+    """監視の設定。mode は "auto"（inotify が使えればそれを使う）/ "inotify" / "poll"。"""
+
+    stable_sec: float = DEFAULT_STABLE_SEC
+    poll_interval_sec: float = DEFAULT_POLL_INTERVAL_SEC
+    mode: str = DEFAULT_WATCH_MODE
+
+
+def watch_options(settings: dict[str, Any]) -> WatchOptions:
+    """setting.json の watch 設定から WatchOptions を作る。"""
+    conf = settings.get("watch") or {}
+    return WatchOptions(
+        stable_sec=max(0.0, float(conf.get("stable_sec", DEFAULT_STABLE_SEC))),
+        poll_interval_sec=max(0.5, float(conf.get("poll_interval_sec", DEFAULT_POLL_INTERVAL_SEC))),
+        mode=str(conf.get("mode") or DEFAULT_WATCH_MODE).lower(),
+    )
+
+
+class PollingWatcher:
+    """変更通知を使わず、待ち時間が過ぎるまで眠るだけの監視。"""
+
+    name = "poll"
+
+    def watch(self, dirs: list[Path]) -> None:
+        pass
+
+    def wait(self, timeout: float) -> bool:
+        time.sleep(max(0.0, timeout))
+        return False
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher:
+    """inotify でディレクトリ内のファイルの作成・書き込み完了・移動・削除を待つ（Linux のみ）。"""
+
+    name = "inotify"
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._fd = fd
+        self._wds: dict[str, int] = {}
+
+    def watch(self, dirs: list[Path]) -> None:
+        """監視するディレクトリを dirs に揃える（増えたものを追加し、なくなったものを外す）。"""
+        wanted = {str(d) for d in dirs}
+        for path in [p for p in self._wds if p not in wanted]:
+            self._libc.inotify_rm_watch(self._fd, self._wds.pop(path))
+        for path in wanted.difference(self._wds):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), _WATCH_MASK)
+            # 追加できない場合（監視数の上限・削除済み等）は定期的な走査で拾う
+            if wd >= 0:
+                self._wds[path] = wd
+
+    def wait(self, timeout: float) -> bool:
+        """イベントが届くか timeout 秒経つまで待つ。届いたイベントは読み捨て、届いたかどうかを返す。"""
+        ready, _, _ = select.select([self._fd], [], [], max(0.0, timeout))
+        if not ready:
+            return False
+        removed: set[int] = set()
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(data):
+                wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                if mask & _IN_IGNORED:
+                    removed.add(wd)
+                offset += _EVENT_HEADER.size + length
+        if removed:
+            # 削除されたディレクトリの監視はカーネル側で外れているため、次の watch で追加し直せるようにする
+            self._wds = {p: wd for p, wd in self._wds.items() if wd not in removed}
+        return True
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+def create_watcher(mode: str) -> "InotifyWatcher | PollingWatcher":
+    """mode に応じた監視を作る。inotify が使えない場合はポーリングにする。"""
+    if mode != "poll" and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError) as e:
+            if mode == "inotify":
+                print(f"警告: inotify を使えないため、ポーリングで監視します。{e}", file=sys.stderr)
+    elif mode == "inotify":
+        print("警告: inotify はこの OS では使えないため、ポーリングで監視します。", file=sys.stderr)
+    return PollingWatcher()
+
+
+class _PortalState:
+    __slots__ = ("signature", "changed_at", "processed")
+
+    def __init__(self):
+        self.signature: tuple = ()
+        self.changed_at = 0.0
+        self.processed: tuple = ()
+
+
+def _choice_complete(files: list[Source]) -> bool:
+    """Choice の在庫用 TSV がすべて明細 TSV と組になっているか。"""
+    stems = {p.stem for p in files if p.suffix.lower() == ".tsv"}
+    change_stock = [s for s in stems if s.endswith(CHOICE_CHANGE_STOCK_SUFFIX)]
+    return bool(change_stock) and all(s[: -len(CHOICE_CHANGE_STOCK_SUFFIX)] in stems for s in change_stock)
+
+
+class ArchiveTracker:
+    """
+    アーカイブルート配下の日付ディレクトリ・ポータル名ディレクトリを走査し、揃ったポータルを返す。
+    portals は対象ポータル（小文字のポータル名 → ポータル設定）、scan_for はポータル設定から走査設定を作る関数。
+    start_date より前の日付ディレクトリは対象にしない（未指定時は起動時点で最新の日付ディレクトリから）。
+    """
+
+    def __init__(
+        self,
+        archive_root: Path,
+        portals: dict[str, dict[str, Any]],
+        scan_for: Callable[[dict[str, Any]], ScanOptions],
+        stable_sec: float,
+        start_date: str | None = None,
+    ):
+        self._root = archive_root
+        self._portals = portals
+        self._scan_for = scan_for
+        self._stable_sec = stable_sec
+        self._states: dict[Path, _PortalState] = {}
+        self._watch_dirs: list[Path] = [archive_root]
+        dates = self._date_dirs()
+        self._start_date = start_date or (dates[-1].name if dates else date.today().isoformat())
+
+    def _date_dirs(self) -> list[Path]:
+        try:
+            return sorted(
+                (d for d in self._root.iterdir() if d.is_dir() and DATE_DIR_PATTERN.match(d.name)),
+                key=lambda d: d.name,
+            )
+        except OSError:
+            return []
+
+    def _signature(self, portal_dir: Path, portal_config: dict[str, Any]) -> tuple:
+        """データファイルの (パス, サイズ, 更新日時) の組。揃っていない（Choice の組が欠けている）場合は空。"""
+        scan = self._scan_for(portal_config)
+        files = list_data_files(portal_dir, DATA_EXTENSIONS + ARCHIVE_EXTENSIONS, scan)
+        if not files:
+            return ()
+        if portal_config.get("tsv_join_mode"):
+            # .zip はコピー途中だと中を読めないため、組が揃っていないものとして待つ
+            members = expand_archives(files, (".tsv",), scan.ignore_patterns, warn=False)
+            if not _choice_complete(members):
+                return ()
+        entries = []
+        for path in files:
+            try:
+                st = path.stat()
+            except OSError:
+                # コピー途中で消えた・名前が変わった場合は次回の走査で揃うのを待つ
+                return ()
+            entries.append((str(path), st.st_size, st.st_mtime_ns))
+        return tuple(entries)
+
+    def watch_dirs(self) -> list[Path]:
+        """inotify で監視するディレクトリ（アーカイブルート・対象の日付ディレクトリ・ポータル名ディレクトリとその配下）。"""
+        return self._watch_dirs
+
+    def poll(self, now: float) -> list[Path]:
+        """走査し直し、前回から変化がなく stable_sec 秒経ったポータル名ディレクトリを返す（処理済みとして記録する）。"""
+        dates = [d for d in self._date_dirs() if d.name >= self._start_date][-ACTIVE_DATE_DIRS:]
+        watch_dirs = [self._root, *dates]
+        seen: set[Path] = set()
+        ready: list[Path] = []
+        for date_dir in dates:
+            try:
+                subdirs = sorted((d for d in date_dir.iterdir() if d.is_dir()), key=lambda d: d.name.lower())
+            except OSError:
+                continue
+            for portal_dir in subdirs:
+                portal_config = self._portals.get(portal_dir.name.strip().lower())
+                if portal_config is None:
+                    continue
+                seen.add(portal_dir)
+                signature = self._signature(portal_dir, portal_config)
+                watch_dirs.append(portal_dir)
+                watch_dirs.extend({Path(path).parent for path, _, _ in signature} - {portal_dir})
+                state = self._states.setdefault(portal_dir, _PortalState())
+                if signature != state.signature:
+                    state.signature = signature
+                    state.changed_at = now
+                if signature and signature != state.processed and now - state.changed_at >= self._stable_sec:
+                    state.processed = signature
+                    ready.append(portal_dir)
+        # 対象外になった（古い日付の）ディレクトリの状態は捨てる
+        self._states = {d: s for d, s in self._states.items() if d in seen}
+        self._watch_dirs = watch_dirs
+        return ready
+
+    def next_deadline(self) -> float | None:
+        """揃うのを待っているポータルが処理対象になる最も早い時刻（なければ None）。"""
+        deadlines = [
+            s.changed_at + self._stable_sec for s in self._states.values() if s.signature and s.signature != s.processed
+        ]
+        return min(deadlines) if deadlines else None
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""
+ローカルキャッシュディレクトリの解決。
+setting.json の cache_dir（空ならプロジェクト直下の .cache）を使用する。
+"""
+from pathlib import Path
+from typing import Any
+
+DEFAULT_CACHE_DIR = Path(__file__).resolve().parent.parent / ".cache"
+
+
+def resolve_cache_dir(settings: dict[str, Any]) -> Path:
+    """setting.json の cache_dir を解決する。未指定・空文字ならデフォルトを返す。"""
+    raw = str(settings.get("cache_dir") or "").strip()
+    return Path(raw) if raw else DEFAULT_CACHE_DIR
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+ChatWork API へのメッセージ送信（配信レイヤー）。
+- requests.Session を API トークン・接続先ごとに使い回し、接続をプールする
+- API トークン単位・ルーム単位のトークンバケットで、ChatWork の利用制限を超えないよう送信を待たせる
+- 受け付けられていないことが確かな失敗（429・接続できなかった）は Retry-After / x-ratelimit-reset ヘッダー
+  （なければ指数バックオフ）に従って待ってから再送する。ヘッダーの待ち時間が chatwork.retry.max_wait_sec を超える場合は再送せず失敗にする
+- 5xx・送信後の通信エラーは投稿済みの可能性があるため、chatwork.retry.retry_ambiguous が true の場合だけ再送する
+- 複数ルームへはルームごとに並行して送る（同じルーム内は分割した順に送る）。再送・失敗はルームごとに扱い、
+  送信済み（2xx が返った）のルーム・メッセージには送り直さない
+接続先は setting.json の chatwork.api_base_url で差し替えられるため、ローカルのスタブサーバーでも試せる。
+"""
+import hashlib
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Any
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from app import instrumentation
+
+DEFAULT_BASE_URL = "https://api.chatwork.com"
+DEFAULT_MESSAGE_ENDPOINT = "/v2/rooms/{room_id}/messages"
+
+# ChatWork の利用制限: API トークンごとに 5 分あたり 300 リクエスト、ルームごとに 10 秒あたり 10 メッセージ
+DEFAULT_TOKEN_REQUESTS = 300
+DEFAULT_TOKEN_PERIOD_SEC = 300
+DEFAULT_ROOM_MESSAGES = 10
+DEFAULT_ROOM_PERIOD_SEC = 10
+
+# 再送の設定（setting.json の chatwork.retry で上書き）
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_SEC = 1.0
+DEFAULT_MAX_BACKOFF_SEC = 60.0
+# ヘッダーで指定された待ち時間の上限。これより長く待つよう求められた場合は待たずに失敗にする
+# （誤った値・遠い日時で送信スレッドが止まり、他のルームの送信まで待たされないように）
+DEFAULT_MAX_WAIT_SEC = float(DEFAULT_TOKEN_PERIOD_SEC)
+
+# 再送対象の HTTP ステータス。429 は受け付けられていないため常に再送し、5xx は retry_ambiguous の場合だけ再送する
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+REJECTED_STATUSES = frozenset({429})
+
+REQUEST_TIMEOUT_SEC = 30
+
+# ルームへの同時送信数の上限（接続プールの大きさも兼ねる）
+MAX_ROOM_WORKERS = 8
+
+
+class TokenBucket:
+    """capacity 個のトークンを period_sec 秒で補充するトークンバケット。スレッドから同時に使える。"""
+
+    def __init__(self, capacity: int, period_sec: float):
+        self.capacity = max(1, int(capacity))
+        self._rate = self.capacity / max(float(period_sec), 0.001)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """トークンを1つ取り出す。空なら補充されるまで待つ。"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+
+def _header_wait(resp: requests.Response) -> float | None:
+    """Retry-After（秒数または日時）/ x-ratelimit-reset（UNIX 時刻）から待ち時間を求める。"""
+    retry_after = resp.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    reset = resp.headers.get("x-ratelimit-reset")
+    if reset:
+        try:
+            return max(0.0, float(reset) - time.time())
+        except ValueError:
+            pass
+    return None
+
+
+def _not_sent(e: requests.ConnectionError) -> bool:
+    """接続の確立前に失敗した（リクエストを送っていない）か。"""
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def payload_digest(body: str) -> str:
+    """送信済みの記録に使うメッセージのダイジェスト。"""
+    return hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+
+class ChatworkClient:
+    """
+    1つの API トークン・接続先に対する送信クライアント。
+    get_client で設定ごとに1つだけ作り、スレッド間で共有する。
+    """
+
+    def __init__(self, token: str, chatwork_config: dict[str, Any]):
+        self._base_url = (chatwork_config.get("api_base_url") or DEFAULT_BASE_URL).rstrip("/")
+        self._endpoint = chatwork_config.get("message_endpoint") or DEFAULT_MESSAGE_ENDPOINT
+
+        rate_limit = chatwork_config.get("rate_limit") or {}
+        self._token_bucket = TokenBucket(
+            rate_limit.get("token_requests", DEFAULT_TOKEN_REQUESTS),
+            rate_limit.get("token_period_sec", DEFAULT_TOKEN_PERIOD_SEC),
+        )
+        self._room_capacity = rate_limit.get("room_messages", DEFAULT_ROOM_MESSAGES)
+        self._room_period = rate_limit.get("room_period_sec", DEFAULT_ROOM_PERIOD_SEC)
+        self._room_buckets: dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+        retry = chatwork_config.get("retry") or {}
+        self._max_retries = int(retry.get("max_retries", DEFAULT_MAX_RETRIES))
+        self._backoff = float(retry.get("backoff_sec", DEFAULT_BACKOFF_SEC))
+        self._max_backoff = float(retry.get("max_backoff_sec", DEFAULT_MAX_BACKOFF_SEC))
+        self._retry_ambiguous = bool(retry.get("retry_ambiguous", False))
+        self._max_wait = float(retry.get("max_wait_sec", DEFAULT_MAX_WAIT_SEC))
+
+        self._session = requests.Session()
+        self._session.headers["X-ChatWorkToken"] = token
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_ROOM_WORKERS)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def _room_bucket(self, room_id: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._room_buckets.get(room_id)
+            if bucket is None:
+                bucket = self._room_buckets[room_id] = TokenBucket(self._room_capacity, self._room_period)
+            return bucket
+
+    def _backoff_wait(self, attempt: int) -> float:
+        return min(self._max_backoff, self._backoff * (2**attempt)) * random.uniform(0.5, 1.0)
+
+    def post_message(self, room_id: str, body: str) -> tuple[bool, str | None]:
+        """
+        1通送信する。429・接続できなかった場合は再送し、それでも失敗したらエラー内容を返す。
+        5xx・送信後の通信エラーは投稿済みの可能性があるため、retry_ambiguous の場合だけ再送する。
+        """
+        url = f"{self._base_url}{self._endpoint.replace('{room_id}', room_id)}"
+        room_bucket = self._room_bucket(room_id)
+        attempt = 0
+        while True:
+            self._token_bucket.acquire()
+            room_bucket.acquire()
+            instrumentation.count("http_requests")
+            try:
+                resp = self._session.post(url, data={"body": body}, timeout=REQUEST_TIMEOUT_SEC)
+            except requests.ConnectionError as e:
+                # 接続できなかった場合は未送信なので再送してよい。接続後の切断等は送信済みの可能性がある
+                if attempt >= self._max_retries or not (_not_sent(e) or self._retry_ambiguous):
+                    return False, f"通信エラー: {e}"
+                time.sleep(self._backoff_wait(attempt))
+                attempt += 1
+                instrumentation.count("http_retries")
+                continue
+            except requests.RequestException as e:
+                # 読み込みタイムアウト等は送信済みの可能性があるため再送しない
+                return False, f"通信エラー: {e}"
+            if resp.status_code in (200, 201):
+                return True, None
+            retryable = resp.status_code in REJECTED_STATUSES or (
+                self._retry_ambiguous and resp.status_code in RETRY_STATUSES
+            )
+            if not retryable or attempt >= self._max_retries:
+                return False, f"HTTP {resp.status_code}: {resp.text[:500]}"
+            wait = _header_wait(resp)
+            if wait is not None and wait > self._max_wait:
+                instrumentation.count("http_wait_exceeded")
+                return False, f"HTTP {resp.status_code}: 待ち時間 {wait:.0f} 秒が上限 {self._max_wait:g} 秒を超えるため再送しません"
+            time.sleep(wait if wait is not None else self._backoff_wait(attempt))
+            attempt += 1
+            instrumentation.count("http_retries")
+
+    def _send_room(
+        self, room_id: str, payloads: list[str], delivered: set[tuple[str, str]]
+    ) -> tuple[bool, str | None]:
+        for body in payloads:
+            key = (room_id, payload_digest(body))
+            if key in delivered:
+                instrumentation.count("chatwork_skipped_delivered")
+                continue
+            ok, err = self.post_message(room_id, body)
+            if not ok:
+                return False, err
+            delivered.add(key)
+        return True, None
+
+    def send(
+        self, room_ids: list[str], payloads: list[str], delivered: set[tuple[str, str]] | None = None
+    ) -> tuple[bool, str | None]:
+        """
+        分割済みメッセージを各ルームへ送る。ルーム間は並行、ルーム内は順番どおり。
+        delivered は送信済みの (ルーム ID, payload_digest) の集合。含まれるものは送らず、2xx が返ったものを加える。
+        失敗したルームは以降のメッセージを送らないが、他のルームには送り続ける。
+        1ルームでも失敗すれば False と、失敗したルームごとのエラー内容を返す。
+        """
+        if delivered is None:
+            delivered = set()
+        if len(room_ids) == 1:
+            return self._send_room(room_ids[0], payloads, delivered)
+        with ThreadPoolExecutor(max_workers=min(len(room_ids), MAX_ROOM_WORKERS)) as executor:
+            futures = [
+                instrumentation.submit_in_context(executor, self._send_room, room_id, payloads, delivered)
+                for room_id in room_ids
+            ]
+            results = [future.result() for future in futures]
+        errors = [f"room {room_id}: {err}" for room_id, (ok, err) in zip(room_ids, results) if not ok]
+        if errors:
+            return False, " / ".join(errors)
+        return True, None
+
+
+_clients: dict[tuple[str, str, str], ChatworkClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(token: str, chatwork_config: dict[str, Any]) -> ChatworkClient:
+    """API トークン・接続先ごとに共有するクライアントを返す（なければ作る）。"""
+    key = (
+        token,
+        (chatwork_config.get("api_base_url") or DEFAULT_BASE_URL).rstrip("/"),
+        chatwork_config.get("message_endpoint") or DEFAULT_MESSAGE_ENDPOINT,
+    )
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = ChatworkClient(token, chatwork_config)
+        return client
+
+
+def room_ids_of(chatwork_config: dict[str, Any]) -> list[str]:
+    """chatwork.room_id を送信先ルーム ID のリストにする。文字列・数値・リストのいずれでもよい。"""
+    room_id = chatwork_config.get("room_id")
+    values = room_id if isinstance(room_id, list) else [room_id]
+    return [str(v).strip() for v in values if v is not None and str(v).strip()]
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+在庫数と最低在庫数の比較を NumPy の配列演算でまとめて行う。
+返礼品コードは CodeDictionary で整数 ID に変換し（在庫・最低在庫数で同じ ID を共有する）、
+最低在庫数は ID を添字にした配列（ThresholdTable）に一度だけ変換して使い回す。
+在庫数 <= 最低在庫数 の判定は1回のベクトル演算で行い、結果は ALERT_DTYPE の構造化配列で返す。
+dict への変換はメッセージ組み立て時にアラート分だけ行う。
+返礼品コード列がパターン（pattern:ABC-* 等）の定義は ThresholdRules で解決し、完全一致の定義がないコードにだけ適用する。
+パターンに当てはまった未登録のコードは共有の CodeDictionary に登録せず、比較1回分の LocalCodes に負の ID で持つ
+（複数スレッドから同じ表を使っても辞書を書き換えず、常駐実行でも辞書が増え続けないように）。
+"""
+from itertools import repeat
+from typing import Any, Iterable, Mapping
+
+import numpy as np
+
+from app.threshold_rules import RuleKeys, ThresholdRules, split_rules
+
+# アラート1件分: 返礼品コード ID / 現在在庫数 / 最低在庫数
+ALERT_DTYPE = np.dtype([("code_id", np.int64), ("current_stock", np.int64), ("min_stock", np.int64)])
+
+# CodeDictionary.lookup で未登録のコードに返す ID
+UNKNOWN_ID = -1
+
+# LocalCodes のコードに振る ID の始まり（-2, -3, ... の順）
+LOCAL_ID_START = UNKNOWN_ID - 1
+
+
+class CodeDictionary:
+    """
+    返礼品コード ⇔ 整数 ID の辞書。ID は登録順に 0 から振る。
+    複数ポータル・複数回の比較で同じインスタンスを使えば ID を共有できる。
+    """
+
+    def __init__(self):
+        self._ids: dict[str, int] = {}
+        self._codes: list[str] = []
+
+    def __len__(self) -> int:
+        return len(self._codes)
+
+    def encode(self, codes: Iterable[str]) -> np.ndarray:
+        """コード列を ID 配列に変換する。未登録のコードはここで登録する。"""
+        codes = codes if isinstance(codes, list) else list(codes)
+        ids = self._ids
+        if not ids:
+            ids.update(zip(codes, range(len(codes))))
+            if len(ids) == len(codes):
+                # 空の辞書に重複のないコード列（dict のキー等）を登録した場合、ID は連番そのもの
+                self._codes.extend(codes)
+                return np.arange(len(codes), dtype=np.int64)
+            ids.clear()
+        new_codes = [code for code in dict.fromkeys(codes) if code not in ids]
+        ids.update(zip(new_codes, range(len(self._codes), len(self._codes) + len(new_codes))))
+        self._codes.extend(new_codes)
+        return np.fromiter(map(ids.__getitem__, codes), dtype=np.int64, count=len(codes))
+
+    def lookup(self, codes: Iterable[str]) -> np.ndarray:
+        """コード列を ID 配列に変換する。未登録のコードは登録せず UNKNOWN_ID にする。"""
+        codes = codes if isinstance(codes, list) else list(codes)
+        return np.fromiter(map(self._ids.get, codes, repeat(UNKNOWN_ID)), dtype=np.int64, count=len(codes))
+
+    def decode(self, code_ids: Iterable[int]) -> list[str]:
+        """ID 配列をコードのリストに戻す。"""
+        codes = self._codes
+        return [codes[i] for i in np.asarray(code_ids, dtype=np.int64).tolist()]
+
+
+class LocalCodes:
+    """
+    共有の CodeDictionary に、比較1回分だけのコード（パターンに当てはまった未登録のコード）を加えたもの。
+    extra[k] の ID は LOCAL_ID_START - k。decode だけを持つ。
+    """
+
+    def __init__(self, codes: CodeDictionary, extra: list[str]):
+        self._base = codes
+        self._extra = extra
+
+    def decode(self, code_ids: Iterable[int]) -> list[str]:
+        """ID 配列をコードのリストに戻す。負の ID は extra から引く。"""
+        codes, extra = self._base._codes, self._extra
+        return [codes[i] if i >= 0 else extra[LOCAL_ID_START - i] for i in np.asarray(code_ids, dtype=np.int64).tolist()]
+
+
+class ThresholdTable:
+    """
+    最低在庫数を ID を添字にした配列に変換したもの。
+    同じ最低在庫数定義で何度も比較する場合（複数日付・常駐実行等）は、1回作って使い回す。
+    作成後は codes を書き換えないため、複数スレッドから同時に lookup / compare してよい。
+    パターンの定義は rules に分け、完全一致の定義がないコードを lookup する際に解決する。
+    """
+
+    def __init__(self, min_by_code: Mapping[str, int], codes: CodeDictionary | None = None):
+        exact, patterns = split_rules(min_by_code)
+        self.rules = ThresholdRules(patterns) if patterns else None
+        self.codes = codes if codes is not None else CodeDictionary()
+        min_ids = self.codes.encode(list(exact.keys()))
+        # 末尾の1要素は「定義なし」用。未登録コード・この表より後に登録されたコードはここを参照させる
+        self._size = len(self.codes)
+        self._mins = np.zeros(self._size + 1, dtype=np.int64)
+        self._has_min = np.zeros(self._size + 1, dtype=bool)
+        self._mins[min_ids] = np.fromiter(exact.values(), dtype=np.int64, count=len(exact))
+        self._has_min[min_ids] = True
+        self._defined: frozenset[str] | None = None
+
+    def __len__(self) -> int:
+        return int(self._has_min.sum()) + (len(self.rules) if self.rules is not None else 0)
+
+    def defined_codes(self) -> frozenset[str]:
+        """
+        最低在庫数の定義があるコードの集合（パース時の絞り込み用）。初回に作って保持する。
+        パターンの定義がある場合は、それに当てはまるコードも in で含むとみなす RuleKeys を返す。
+        """
+        if self._defined is None:
+            exact = self.codes.decode(np.flatnonzero(self._has_min[: self._size]))
+            self._defined = frozenset(exact) if self.rules is None else RuleKeys(exact, self.rules)
+        return self._defined
+
+    def lookup(self, codes: Iterable[str]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        コード列の (ID, 最低在庫数, 最低在庫数の定義があるか) を配列で返す。未登録のコードの ID は UNKNOWN_ID。
+        パターンの定義に当てはまった未登録のコードも、codes には登録せず ID は UNKNOWN_ID のまま返す。
+        """
+        codes = codes if isinstance(codes, list) else list(codes)
+        ids = self.codes.lookup(codes)
+        slots = np.where((ids < 0) | (ids >= self._size), self._size, ids)
+        mins, has_min = self._mins[slots], self._has_min[slots]
+        if self.rules is not None:
+            self._apply_rules(codes, ids, mins, has_min)
+        return ids, mins, has_min
+
+    def _apply_rules(self, codes: list[str], ids: np.ndarray, mins: np.ndarray, has_min: np.ndarray) -> None:
+        """完全一致の定義がないコードをパターンの定義で解決し、mins / has_min を書き換える。"""
+        resolve = self.rules.resolve
+        matched: list[int] = []
+        matched_mins: list[int] = []
+        for i in np.flatnonzero(~has_min).tolist():
+            min_stock = resolve(codes[i])
+            if min_stock is not None:
+                matched.append(i)
+                matched_mins.append(min_stock)
+        if not matched:
+            return
+        mins[matched] = matched_mins
+        has_min[matched] = True
+
+    def compare(self, stock_by_code: Mapping[str, int]) -> tuple[np.ndarray, CodeDictionary | LocalCodes]:
+        """
+        在庫数 <= 最低在庫数 の返礼品コードを ALERT_DTYPE の構造化配列で返す。
+        最低在庫数が定義されていないコードは対象外。並び順は stock_by_code の順。
+        戻り値: (アラート, code_id を戻すための辞書)。パターンに当てはまった未登録のコードがあれば辞書は LocalCodes。
+        """
+        stock_codes = list(stock_by_code.keys())
+        stock_ids, stock_mins, has_min = self.lookup(stock_codes)
+        current = np.fromiter(stock_by_code.values(), dtype=np.int64, count=len(stock_by_code))
+        mask = has_min & (current <= stock_mins)
+
+        alerts = np.empty(int(mask.sum()), dtype=ALERT_DTYPE)
+        alerts["code_id"] = stock_ids[mask]
+        alerts["current_stock"] = current[mask]
+        alerts["min_stock"] = stock_mins[mask]
+        codes: CodeDictionary | LocalCodes = self.codes
+        local = np.flatnonzero(alerts["code_id"] < 0)
+        if local.size:
+            positions = np.flatnonzero(mask)[local]
+            alerts["code_id"][local] = LOCAL_ID_START - np.arange(local.size)
+            codes = LocalCodes(self.codes, [stock_codes[i] for i in positions.tolist()])
+        return alerts, codes
+
+
+def compare_stock(
+    stock_by_code: Mapping[str, int],
+    thresholds: Mapping[str, int] | ThresholdTable,
+) -> tuple[np.ndarray, CodeDictionary | LocalCodes]:
+    """
+    在庫数と最低在庫数を比較し、(アラートの構造化配列, code_id を戻すための辞書) を返す。
+    thresholds には最低在庫数の dict か、作成済みの ThresholdTable を渡す。
+    """
+    table = thresholds if isinstance(thresholds, ThresholdTable) else ThresholdTable(thresholds)
+    return table.compare(stock_by_code)
+
+
+def alert_records(alerts: np.ndarray, codes: CodeDictionary | LocalCodes, portal_name: str) -> list[dict[str, Any]]:
+    """構造化配列のアラートを build_alert_message に渡す dict のリストに変換する。"""
+    return [
+        {
+            "portal_name": portal_name,
+            "product_code": product_code,
+            "current_stock": current,
+            "min_stock": min_stock,
+        }
+        for product_code, current, min_stock in zip(
+            codes.decode(alerts["code_id"]), alerts["current_stock"].tolist(), alerts["min_stock"].tolist()
+        )
+    ]
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+大きな CSV/TSV をレコードの境界で分割し、プロセス並列でパースするための補助。
+
+ファイルを mmap し、目安のサイズごとに改行の直後で区切る。区切り位置は、範囲の先頭から数えた
+引用符（"）の数が偶数になる改行だけを選ぶため、引用符で囲まれた値の中の改行では区切らない
+（"" のエスケープは2個ずつ数えられるので偶奇は変わらない）。UTF-8 / CP932 では改行・引用符のバイトが
+マルチバイト文字の途中に現れないため、バイト列のまま判定できる。
+
+引用符が値の途中に単独で現れる（RFC 4180 に沿わない）ファイルでは偶奇がずれるため、区切り位置は
+パース時に確かめる。各範囲は末尾に目印の行を加えて csv.reader で読み、目印が独立した行として読めた
+（範囲の終わりで引用符が閉じていた）ことを RangeRows.ended_cleanly で返す。先頭の範囲はレコードの先頭から
+始まるため、すべての範囲が閉じていれば区切り位置はすべて1プロセスで読んだ場合のレコード境界と一致する。
+閉じていない範囲があった場合と、改行を MAX_QUOTED_BYTES 先まで探しても区切れない場合は、呼び出し元で1プロセスで読み直す。
+"""
+import csv
+import io
+import mmap
+import os
+from itertools import repeat
+from pathlib import Path
+from typing import Any, Callable, Iterator, NamedTuple, TypeVar
+
+T = TypeVar("T")
+
+# 既定値（setting.json の parse_parallel で上書き）
+DEFAULT_MIN_MB = 64
+DEFAULT_CHUNK_MB = 16
+
+# 引用符で囲まれた値（改行を含む）1つの長さの上限の目安。これを超えて区切れなければ分割しない
+MAX_QUOTED_BYTES = 1024 * 1024
+
+_MB = 1024 * 1024
+
+# 範囲の末尾に加える目印の行（私用領域の文字で、実データの行と一致しないもの）
+_END_MARKER = "\ue000csv_chunks:end\ue000"
+
+
+class ParallelOptions(NamedTuple):
+    """
+    分割パースの設定。min_bytes 以上のファイルを chunk_bytes 程度の範囲に分け、workers プロセスでパースする。
+    workers が 0 の場合は CPU 数。
+    """
+
+    min_bytes: int = DEFAULT_MIN_MB * _MB
+    chunk_bytes: int = DEFAULT_CHUNK_MB * _MB
+    workers: int = 0
+
+
+def parallel_options(settings: dict[str, Any]) -> ParallelOptions | None:
+    """setting.json の parse_parallel 設定から ParallelOptions を作る。無効なら None。"""
+    conf = settings.get("parse_parallel") or {}
+    if not conf.get("enabled", True):
+        return None
+    return ParallelOptions(
+        min_bytes=int(max(0.0, float(conf.get("min_mb", DEFAULT_MIN_MB))) * _MB),
+        chunk_bytes=int(max(1.0, float(conf.get("chunk_mb", DEFAULT_CHUNK_MB))) * _MB),
+        workers=max(0, int(conf.get("workers", 0))),
+    )
+
+
+def worker_count(options: ParallelOptions) -> int:
+    """分割パースに使うプロセス数。"""
+    return options.workers or os.cpu_count() or 1
+
+
+def record_end(buf: Any, start: int, pos: int) -> int | None:
+    """
+    start（レコードの先頭）から数えて引用符の外にある、pos 以降の最初の改行の直後の位置を返す。
+    改行がなければ末尾。pos から MAX_QUOTED_BYTES 先までに見つからなければ None。
+    """
+    quotes = buf[start:pos].count(b'"')
+    limit = pos + MAX_QUOTED_BYTES
+    while True:
+        nl = buf.find(b"\n", pos)
+        if nl < 0:
+            return len(buf)
+        quotes += buf[pos : nl + 1].count(b'"')
+        if quotes % 2 == 0:
+            return nl + 1
+        pos = nl + 1
+        if pos > limit:
+            return None
+
+
+def split_ranges(buf: Any, start: int, chunk_bytes: int) -> list[tuple[int, int]] | None:
+    """buf[start:] をおよそ chunk_bytes ごとのレコード境界で区切った (開始, 終了) のリスト。区切れなければ None。"""
+    size = len(buf)
+    ranges = []
+    while start < size:
+        end = size if start + chunk_bytes >= size else record_end(buf, start, start + chunk_bytes)
+        if end is None:
+            return None
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+class RangeRows:
+    """
+    ファイルの [start, end)（start はレコードの先頭）を csv.reader で読む行の反復子。
+    範囲がファイルの途中で終わる場合は末尾に目印の行を加えて読み、目印が独立した行として読めたか
+    （範囲の終わりがレコードの境界だったか）を読み終えた後の ended_cleanly で返す。
+    BOM はファイルの先頭にしかないため、途中からの範囲は BOM なしで読む。
+    """
+
+    def __init__(self, path: Path, start: int, end: int, encoding: str, delimiter: str):
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            data = buf[start:end]
+            size = len(buf)
+        if encoding == "utf-8-sig" and start > 0:
+            encoding = "utf-8"
+        text = data.decode(encoding)
+        check_end = end < size
+        if check_end:
+            text += _END_MARKER + "\n"
+        self.ended_cleanly = not check_end
+        self._reader = csv.reader(io.StringIO(text, newline=""), delimiter=delimiter)
+
+    def __iter__(self) -> Iterator[list[str]]:
+        for row in self._reader:
+            if len(row) == 1 and row[0] == _END_MARKER:
+                self.ended_cleanly = True
+                continue
+            yield row
+
+
+def map_ranges(func: Callable[..., T], path: Path, ranges: list[tuple[int, int]], workers: int, *args: Any) -> list[T]:
+    """
+    範囲ごとに func(path, 開始, 終了, *args) をプロセスプールで実行し、範囲の順に結果を返す。
+    func はモジュールの関数であること（子プロセスで import して呼ぶ）。
+    スレッドと併用しても安全なよう、子プロセスは fork ではなく spawn で起動する（Windows と同じ）。
+    """
+    # 分割パースする場合だけ読み込む（起動時間を短くするため）
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    columns = [repeat(path), [s for s, _ in ranges], [e for _, e in ranges]] + [repeat(a) for a in args]
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(ranges))), mp_context=context) as executor:
+        return list(executor.map(func, *columns))
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+圧縮（gzip）・ZIP した日次在庫数ファイルの読み込み。
+a.csv.gz は a.csv、x.zip の中の sub/b.tsv は b.tsv として、展開せずにストリームで読む。
+ArchiveMember はパース側からは Path と同じように name / stem / suffix / stat / exists で扱えるため、
+列の指定や Choice の _change_stock による組み合わせは通常のファイルと同じ規則で決まる。
+
+list_sources がディレクトリの走査結果の圧縮ファイル・ZIP を中のデータファイルに置き換える。
+開く側は open_binary（バイト列のストリーム）・seekable（XLSX 用。ZIP の中から ZIP を開くためメモリに読む）を使う。
+"""
+import fnmatch
+import io
+import posixpath
+import sys
+from pathlib import Path, PurePosixPath
+from typing import IO, NamedTuple
+
+from app import instrumentation
+from app.dir_walker import ScanOptions, list_data_files
+
+# 中のファイルを読む圧縮ファイル・ZIP の拡張子
+ARCHIVE_EXTENSIONS = (".gz", ".zip")
+
+
+class MemberStat(NamedTuple):
+    """ArchiveMember.stat の結果。st_size は圧縮後のサイズ、更新日時は圧縮ファイル・ZIP のもの。"""
+
+    st_size: int
+    st_mtime: float
+    st_mtime_ns: int
+
+
+class ArchiveMember:
+    """
+    圧縮ファイル・ZIP の中の1ファイル。member は ZIP の中のパス（gzip の場合は None）。
+    str はログ・キャッシュのキー用で、gzip は圧縮ファイルのパス、ZIP は「ZIP のパス!中のパス」。
+    """
+
+    __slots__ = ("archive", "member", "name")
+
+    def __init__(self, archive: Path, member: str | None = None):
+        self.archive = archive
+        self.member = member
+        self.name = posixpath.basename(member) if member is not None else archive.name[: -len(".gz")]
+
+    @property
+    def suffix(self) -> str:
+        return PurePosixPath(self.name).suffix
+
+    @property
+    def stem(self) -> str:
+        return PurePosixPath(self.name).stem
+
+    def __str__(self) -> str:
+        return str(self.archive) if self.member is None else f"{self.archive}!{self.member}"
+
+    def __repr__(self) -> str:
+        return f"ArchiveMember({str(self)!r})"
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, ArchiveMember) and (self.archive, self.member) == (other.archive, other.member)
+
+    def __hash__(self) -> int:
+        return hash((self.archive, self.member))
+
+    def __reduce__(self):
+        return type(self), (self.archive, self.member)
+
+    def resolve(self) -> "ArchiveMember":
+        return ArchiveMember(self.archive.resolve(), self.member)
+
+    def exists(self) -> bool:
+        return self.archive.exists()
+
+    def stat(self) -> MemberStat:
+        st = self.archive.stat()
+        size = st.st_size
+        if self.member is not None:
+            import zipfile
+
+            try:
+                with zipfile.ZipFile(self.archive) as zf:
+                    size = zf.getinfo(self.member).compress_size
+            except (zipfile.BadZipFile, KeyError) as e:
+                raise OSError(f"{self} を読み込めません: {e}") from e
+        return MemberStat(size, st.st_mtime, st.st_mtime_ns)
+
+    def open_binary(self) -> IO[bytes]:
+        """展開しながら読むバイト列のストリームを開く。"""
+        if self.member is None:
+            import gzip
+
+            return gzip.open(self.archive, "rb")
+        import zipfile
+
+        zf = zipfile.ZipFile(self.archive)
+        try:
+            # ZipFile を閉じても、開いた中のファイルを閉じるまでは ZIP ファイル自体は開いたまま
+            return zf.open(self.member)
+        finally:
+            zf.close()
+
+
+Source = Path | ArchiveMember
+
+
+def open_binary(source: Source) -> IO[bytes]:
+    """通常のファイルはそのまま、圧縮ファイル・ZIP の中のファイルは展開しながら読むバイト列のストリームで開く。"""
+    if isinstance(source, ArchiveMember):
+        return source.open_binary()
+    return open(source, "rb")
+
+
+def open_text(source: Source, encoding: str) -> IO[str]:
+    """open_binary をテキストとして開く（文字コードで解釈できないバイトがあれば、読んだ時点で UnicodeDecodeError）。"""
+    if isinstance(source, ArchiveMember):
+        return io.TextIOWrapper(source.open_binary(), encoding=encoding, newline="")
+    return open(source, "r", encoding=encoding, newline="")
+
+
+def seekable(source: Source) -> Path | IO[bytes]:
+    """ZipFile に渡せる形（通常のファイルはパス、圧縮ファイル・ZIP の中のファイルは展開した内容）にする。"""
+    if isinstance(source, ArchiveMember):
+        with source.open_binary() as f:
+            return io.BytesIO(f.read())
+    return source
+
+
+def source_order(source: Source) -> tuple[Path, str]:
+    """並べ替え用のキー。ZIP の中のファイルは ZIP の位置に中のパス順で並ぶ。"""
+    if isinstance(source, ArchiveMember):
+        return source.archive, source.member or ""
+    return source, ""
+
+
+def _ignored(name: str, patterns: tuple[str, ...]) -> bool:
+    lowered = name.lower()
+    return any(fnmatch.fnmatchcase(lowered, p.lower()) for p in patterns)
+
+
+def expand_archives(
+    files: list[Path], extensions: tuple[str, ...], ignore_patterns: tuple[str, ...] = (), warn: bool = True
+) -> list[Source]:
+    """
+    files の圧縮ファイル・ZIP を、中のデータファイル（拡張子が extensions のいずれか）に置き換える。順序は files のまま。
+    ZIP の中はパス順で、ディレクトリ・ignore_patterns に一致する名前・__MACOSX 配下は除く。
+    読めない ZIP は飛ばす（warn なら警告し、file_errors に数える）。
+    """
+    sources: list[Source] = []
+    for path in files:
+        lowered = path.name.lower()
+        if lowered.endswith(".gz"):
+            member = ArchiveMember(path)
+            if member.name.lower().endswith(extensions):
+                sources.append(member)
+        elif lowered.endswith(".zip"):
+            sources.extend(_zip_members(path, extensions, ignore_patterns, warn))
+        elif lowered.endswith(extensions):
+            sources.append(path)
+    return sources
+
+
+def _zip_members(
+    path: Path, extensions: tuple[str, ...], ignore_patterns: tuple[str, ...], warn: bool
+) -> list[ArchiveMember]:
+    import zipfile
+
+    try:
+        with zipfile.ZipFile(path) as zf:
+            names = zf.namelist()
+    except (zipfile.BadZipFile, OSError) as e:
+        if warn:
+            instrumentation.count("file_errors")
+            print(f"警告: {path} を読み込めなかったため、このファイルを飛ばします: {e!r}", file=sys.stderr)
+        return []
+    members = []
+    for name in sorted(names):
+        parts = name.split("/")
+        if name.endswith("/") or parts[0] == "__MACOSX":
+            continue
+        if ignore_patterns and any(_ignored(part, ignore_patterns) for part in parts):
+            continue
+        if parts[-1].lower().endswith(extensions):
+            members.append(ArchiveMember(path, name))
+    return members
+
+
+def list_sources(root: Path, extensions: tuple[str, ...], options: ScanOptions | None = None) -> list[Source]:
+    """
+    list_data_files と同じく root 配下（再帰）のデータファイルを返す。
+    圧縮ファイル（例: a.csv.gz）・ZIP は中のデータファイルに置き換える。
+    """
+    files = list_data_files(root, extensions + ARCHIVE_EXTENSIONS, options)
+    patterns = (options or ScanOptions()).ignore_patterns
+    return expand_archives(files, extensions, patterns)
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+アラートの送信先（シンク）と、バックグラウンドで送信する有界キュー。
+
+シンク（setting.json の delivery.sinks）:
+  - chatwork : ChatWork API に送信する（既定）
+  - json     : 送信単位を JSON Lines で delivery.json_path に追記する
+  - stdout   : 送信単位を標準出力に表示する
+複数指定した場合はすべてに送り、すべて成功した場合だけ送信状態（alert_state）を更新する。
+chatwork を含まない場合は実際には通知していないため送信状態を更新しない（試し出力で以後の通知が止まらないように）。
+chatwork への送信が一部のルーム・メッセージだけ届いて失敗した場合は、届いたもの（ルーム ID とメッセージのダイジェスト）を
+{cache_dir}/chatwork_sent/{ポータル名}.json に記録し、同じ日に同じ内容を送り直すときはそれらを送らない。
+
+run_all_portals.py のインプロセス実行（--workers / --watch）では DeliveryQueue を使い、
+次のポータルのパース・判定と並行して前のポータルのアラートを送信する。キューが一杯の場合は投入側が待つ。
+"""
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from datetime import date, datetime
+from pathlib import Path
+from typing import Any, NamedTuple
+
+from app.alert_state import AlertDiff, AlertStateStore, open_alert_state
+from app.cache_dir import resolve_cache_dir
+
+SINK_NAMES = ("chatwork", "json", "stdout")
+
+# 既定値（setting.json の delivery で上書き）
+DEFAULT_SINKS = ("chatwork",)
+DEFAULT_QUEUE_SIZE = 16
+DEFAULT_JSON_PATH = "deliveries.jsonl"
+
+
+class Delivery(NamedTuple):
+    """
+    1ポータル分の送信内容。payloads は build_alert_payloads で分割済みの文。
+    state_updates は送信に成功した場合に保存する (状態のキー, 差分)、day はその日付。
+    ワーカープロセスから受け渡せるよう値だけを持つ。
+    """
+
+    portal_name: str
+    payloads: list[str]
+    state_updates: list[tuple[str, AlertDiff]]
+    day: date
+
+
+class DeliveryResult(NamedTuple):
+    """1ポータル分の送信結果。"""
+
+    portal_name: str
+    ok: bool
+    error: str | None
+    seconds: float
+
+
+class DeliveryOptions(NamedTuple):
+    """送信の設定。json_path は相対パスなら実行時のカレントディレクトリから。"""
+
+    sinks: tuple[str, ...] = DEFAULT_SINKS
+    queue_size: int = DEFAULT_QUEUE_SIZE
+    json_path: Path = Path(DEFAULT_JSON_PATH)
+
+
+def delivery_options(settings: dict[str, Any]) -> DeliveryOptions:
+    """setting.json の delivery 設定から DeliveryOptions を作る。未対応のシンク名は ValueError。"""
+    conf = settings.get("delivery") or {}
+    sinks = tuple(str(name).strip().lower() for name in conf.get("sinks") or DEFAULT_SINKS)
+    unknown = [name for name in sinks if name not in SINK_NAMES]
+    if unknown:
+        raise ValueError(f"未対応の送信先です: {', '.join(unknown)}（{' / '.join(SINK_NAMES)}）")
+    return DeliveryOptions(
+        sinks=sinks,
+        queue_size=max(1, int(conf.get("queue_size", DEFAULT_QUEUE_SIZE))),
+        json_path=Path(str(conf.get("json_path") or DEFAULT_JSON_PATH)),
+    )
+
+
+def with_sinks(settings: dict[str, Any], sinks: str) -> dict[str, Any]:
+    """--sink（カンマ区切り）で delivery.sinks を置き換えた設定を返す。"""
+    names = [name.strip() for name in sinks.split(",") if name.strip()]
+    return {**settings, "delivery": {**(settings.get("delivery") or {}), "sinks": names}}
+
+
+class ChatWorkSink:
+    """ChatWork API に送信する。一部だけ届いて失敗した送信は、届いたものを sent_dir に記録して次回送らない。"""
+
+    name = "chatwork"
+    notifies = True
+
+    def __init__(self, chatwork_config: dict[str, Any], sent_dir: Path):
+        self._config = chatwork_config
+        self._sent_dir = sent_dir
+
+    def send(self, delivery: Delivery) -> tuple[bool, str | None]:
+        from app.alert_sender import send_to_chatwork
+
+        path = self._sent_dir / f"{delivery.portal_name.lower()}.json"
+        delivered = _load_delivered(path, delivery.day)
+        before = len(delivered)
+        ok, err = send_to_chatwork(self._config, delivery.payloads, delivered)
+        if ok:
+            if before:
+                _remove_quietly(path)
+        elif len(delivered) > before:
+            _save_delivered(path, delivery.day, delivered)
+        return ok, err
+
+
+def _load_delivered(path: Path, day: date) -> set[tuple[str, str]]:
+    """同じ日の送信済みの (ルーム ID, ダイジェスト) を読み込む。ない・読めない場合は空。"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+        if raw.get("date") != day.isoformat():
+            return set()
+        return {(str(room_id), str(digest)) for room_id, digest in raw.get("sent") or []}
+    except (OSError, ValueError, TypeError, AttributeError):
+        return set()
+
+
+def _save_delivered(path: Path, day: date, delivered: set[tuple[str, str]]) -> None:
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"date": day.isoformat(), "sent": sorted(delivered)}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except OSError as e:
+        # 記録できなくても送信は続ける（次回は届いたルームにも送り直す）
+        print(f"警告: {path} に送信済みの記録を保存できませんでした。{e}", file=sys.stderr)
+
+
+def _remove_quietly(path: Path) -> None:
+    try:
+        path.unlink()
+    except OSError:
+        pass
+
+
+class JsonSink:
+    """送信単位を1ポータル1行の JSON Lines で追記する。"""
+
+    name = "json"
+    notifies = False
+
+    def __init__(self, path: Path):
+        self._path = path
+        self._lock = threading.Lock()
+
+    def send(self, delivery: Delivery) -> tuple[bool, str | None]:
+        record = {
+            "sent_at": datetime.now().isoformat(timespec="seconds"),
+            "portal": delivery.portal_name,
+            "date": delivery.day.isoformat(),
+            "payloads": delivery.payloads,
+        }
+        try:
+            with self._lock:
+                self._path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self._path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e:
+            return False, f"{self._path} に書き込めません: {e}"
+        return True, None
+
+
+class StdoutSink:
+    """送信単位を標準出力に表示する。"""
+
+    name = "stdout"
+    notifies = False
+
+    def send(self, delivery: Delivery) -> tuple[bool, str | None]:
+        for i, payload in enumerate(delivery.payloads, 1):
+            print(f"===== {delivery.portal_name} ({i}/{len(delivery.payloads)}) =====\n{payload}", flush=True)
+        return True, None
+
+
+Sink = ChatWorkSink | JsonSink | StdoutSink
+
+
+def create_sinks(settings: dict[str, Any]) -> list[Sink]:
+    """setting.json の delivery.sinks に従ってシンクを作る。未対応のシンク名は ValueError。"""
+    options = delivery_options(settings)
+    sinks: list[Sink] = []
+    for name in dict.fromkeys(options.sinks):
+        if name == "chatwork":
+            sinks.append(ChatWorkSink(settings.get("chatwork") or {}, resolve_cache_dir(settings) / "chatwork_sent"))
+        elif name == "json":
+            sinks.append(JsonSink(options.json_path))
+        else:
+            sinks.append(StdoutSink())
+    return sinks
+
+
+def send_all(sinks: list[Sink], delivery: Delivery) -> tuple[bool, str | None]:
+    """すべてのシンクに送る（途中で失敗しても残りには送る）。戻り値: (すべて成功したか, 失敗したシンクのエラー内容)"""
+    errors = []
+    for sink in sinks:
+        try:
+            ok, err = sink.send(delivery)
+        except Exception as e:
+            # 予期しない例外も送信失敗として扱い、他のシンク・ポータルの送信は続ける
+            ok, err = False, repr(e)
+        if not ok:
+            errors.append(f"{sink.name}: {err}")
+    return not errors, "; ".join(errors) or None
+
+
+def records_state(sinks: list[Sink]) -> bool:
+    """送信に成功した場合に送信状態を更新するか（実際に通知するシンクを含むか）。"""
+    return any(sink.notifies for sink in sinks)
+
+
+def record_state(state_store: AlertStateStore, key: str, diff: AlertDiff, day: date) -> None:
+    """送信状態を保存する。保存できなくても処理は続ける（次回もう一度送る）。"""
+    try:
+        state_store.record(key, diff, day)
+    except sqlite3.Error as e:
+        print(f"警告: アラート送信状態を保存できませんでした。{e}", file=sys.stderr)
+
+
+class DeliveryQueue:
+    """
+    Delivery を受け取り、バックグラウンドのスレッドで順に送信する有界キュー。
+    送信状態の SQLite はこのスレッドで開く（接続はスレッドをまたげない）。close で残りを送り終えてから結果を返す。
+    """
+
+    def __init__(self, settings: dict[str, Any]):
+        options = delivery_options(settings)
+        self._sinks = create_sinks(settings)
+        self._settings = settings
+        self._cache_dir = resolve_cache_dir(settings)
+        self._queue: queue.Queue[Delivery | None] = queue.Queue(maxsize=options.queue_size)
+        self._results: list[DeliveryResult] = []
+        self._thread = threading.Thread(target=self._run, name="delivery", daemon=True)
+        self._thread.start()
+
+    def submit(self, delivery: Delivery) -> None:
+        """送信待ちに加える。キューが一杯の場合は空くまで待つ。"""
+        self._queue.put(delivery)
+
+    def close(self) -> list[DeliveryResult]:
+        """送信待ちをすべて送り終えるまで待ち、送信結果を投入順に返す。"""
+        self._queue.put(None)
+        self._thread.join()
+        return self._results
+
+    def _run(self) -> None:
+        state_store = None
+        if records_state(self._sinks):
+            state_store = open_alert_state(self._cache_dir, self._settings)
+        names = ", ".join(sink.name for sink in self._sinks)
+        try:
+            while True:
+                delivery = self._queue.get()
+                if delivery is None:
+                    break
+                started = time.perf_counter()
+                ok, err = send_all(self._sinks, delivery)
+                if ok and state_store is not None:
+                    for key, diff in delivery.state_updates:
+                        record_state(state_store, key, diff, delivery.day)
+                self._results.append(DeliveryResult(delivery.portal_name, ok, err, time.perf_counter() - started))
+                if ok:
+                    print(f"[送信] {delivery.portal_name}: アラートを送信しました（{names}）。", flush=True)
+                else:
+                    print(f"[送信] {delivery.portal_name}: 送信に失敗しました。{err}", file=sys.stderr, flush=True)
+        finally:
+            if state_store is not None:
+                state_store.close()
+
+
+def print_delivery_report(results: list[DeliveryResult]) -> None:
+    """送信結果の件数・失敗・送信時間の合計を出力する。"""
+    if not results:
+        return
+    failed = [r for r in results if not r.ok]
+    total = sum(r.seconds for r in results)
+    print(f"送信 {len(results)} 件（失敗 {len(failed)}）、送信時間合計 {total:.2f} 秒", flush=True)
+    for r in failed:
+        print(f"警告: ポータル「{r.portal_name}」のアラートを送信できませんでした。{r.error}", file=sys.stderr)
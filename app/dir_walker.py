@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+日次在庫数ディレクトリ配下のデータファイル一覧の取得。
+os.scandir の DirEntry が持つ種別情報を使い、拡張子・除外パターンで絞り込んでからファイル判定するため、
+共有ドライブ上でもファイルごとの stat を最小限にする。サブディレクトリは任意でスレッド並列に列挙する。
+
+一覧はディレクトリごとの更新日時とあわせて {cache_dir}/listings に保存し、
+次回はディレクトリの更新日時（ファイルの追加・削除・名前変更で変わる）が同じなら走査せずに再利用する。
+"""
+import fnmatch
+import hashlib
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Any, NamedTuple
+
+from app import instrumentation
+
+# 既定の除外パターン（Excel が開いている間に作るロックファイル）
+DEFAULT_IGNORE_PATTERNS = ("~$*",)
+
+# 保存形式を変えたら上げる
+LISTING_VERSION = 1
+
+
+class ScanOptions(NamedTuple):
+    """
+    走査の設定。
+    ignore_patterns はファイル名・ディレクトリ名に対する fnmatch 形式（大文字小文字を区別しない）。
+    listing_dir を指定すると一覧を保存・再利用する。rebuild=True の場合は保存済みの一覧を読まない。
+    """
+
+    ignore_patterns: tuple[str, ...] = DEFAULT_IGNORE_PATTERNS
+    workers: int = 1
+    listing_dir: Path | None = None
+    rebuild: bool = False
+
+
+def scan_options(settings: dict[str, Any], portal_config: dict[str, Any], cache_dir: Path, cache_mode: str) -> ScanOptions:
+    """
+    setting.json の scan 設定（ポータルの ignore_patterns で上書き可）から ScanOptions を作る。
+    cache_mode が "off" の場合は一覧を保存しない。
+    """
+    conf = settings.get("scan") or {}
+    patterns = portal_config.get("ignore_patterns", conf.get("ignore_patterns", DEFAULT_IGNORE_PATTERNS))
+    use_listing = cache_mode != "off" and conf.get("listing_cache", True)
+    return ScanOptions(
+        ignore_patterns=tuple(patterns or ()),
+        workers=max(1, int(conf.get("workers", 1))),
+        listing_dir=cache_dir / "listings" if use_listing else None,
+        rebuild=cache_mode == "rebuild",
+    )
+
+
+def _ignored(name: str, patterns: tuple[str, ...]) -> bool:
+    lowered = name.lower()
+    return any(fnmatch.fnmatchcase(lowered, p.lower()) for p in patterns)
+
+
+def _scan_dir(
+    path: str, extensions: tuple[str, ...], patterns: tuple[str, ...]
+) -> tuple[list[str], list[tuple[str, int]]]:
+    """1ディレクトリを走査し、(対象ファイル, (サブディレクトリ, 更新日時 ns)) を返す。"""
+    files: list[str] = []
+    subdirs: list[tuple[str, int]] = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                name = entry.name
+                if patterns and _ignored(name, patterns):
+                    continue
+                try:
+                    # シンボリックリンクのディレクトリはたどらない（Path.rglob と同じ）
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append((entry.path, entry.stat(follow_symlinks=False).st_mtime_ns))
+                    elif name.lower().endswith(extensions) and entry.is_file():
+                        files.append(entry.path)
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return files, subdirs
+
+
+def _walk(root: Path, extensions: tuple[str, ...], options: ScanOptions) -> tuple[list[str], dict[str, int]]:
+    """root 配下を走査し、(対象ファイルのパス, ディレクトリごとの更新日時 ns) を返す。"""
+    files: list[str] = []
+    dir_mtimes = {str(root): root.stat().st_mtime_ns}
+    if options.workers <= 1:
+        pending = [str(root)]
+        while pending:
+            found, subdirs = _scan_dir(pending.pop(), extensions, options.ignore_patterns)
+            files.extend(found)
+            for subdir, mtime in subdirs:
+                dir_mtimes[subdir] = mtime
+                pending.append(subdir)
+        return files, dir_mtimes
+
+    with ThreadPoolExecutor(max_workers=options.workers) as executor:
+        running = {executor.submit(_scan_dir, str(root), extensions, options.ignore_patterns)}
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                found, subdirs = future.result()
+                files.extend(found)
+                for subdir, mtime in subdirs:
+                    dir_mtimes[subdir] = mtime
+                    running.add(executor.submit(_scan_dir, subdir, extensions, options.ignore_patterns))
+    return files, dir_mtimes
+
+
+def _listing_path(listing_dir: Path, root: Path, extensions: tuple[str, ...], patterns: tuple[str, ...]) -> Path:
+    raw = json.dumps([LISTING_VERSION, str(root), list(extensions), list(patterns)], ensure_ascii=False)
+    return listing_dir / f"{hashlib.sha1(raw.encode('utf-8')).hexdigest()}.json"
+
+
+def _load_listing(path: Path) -> list[str] | None:
+    """保存済みの一覧を返す。記録したディレクトリの更新日時が1つでも違えば None。"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        for directory, mtime in saved["dirs"].items():
+            if os.stat(directory).st_mtime_ns != mtime:
+                return None
+        return list(saved["files"])
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def _save_listing(path: Path, files: list[str], dir_mtimes: dict[str, int]) -> None:
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"dirs": dir_mtimes, "files": files}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except OSError:
+        # 保存できなくても次回走査し直すだけ
+        pass
+
+
+def list_data_files(root: Path, extensions: tuple[str, ...], options: ScanOptions | None = None) -> list[Path]:
+    """
+    root 配下（再帰）の、拡張子が extensions のいずれかであるファイルをパス順に返す。
+    extensions は小文字・ドット付き（例: (".csv", ".tsv")）。
+    """
+    options = options or ScanOptions()
+    extensions = tuple(ext.lower() for ext in extensions)
+    if not root.is_dir():
+        return []
+    listing_path = None
+    if options.listing_dir is not None:
+        listing_path = _listing_path(options.listing_dir, root.resolve(), extensions, options.ignore_patterns)
+        if not options.rebuild:
+            cached = _load_listing(listing_path)
+            if cached is not None:
+                instrumentation.count("listing_cache_hits")
+                return [Path(p) for p in cached]
+
+    files, dir_mtimes = _walk(root, extensions, options)
+    files.sort()
+    instrumentation.count("dirs_scanned", len(dir_mtimes))
+    if listing_path is not None:
+        _save_listing(listing_path, files, dir_mtimes)
+    return [Path(p) for p in files]
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+テキスト系ファイル（CSV/TSV/TXT）の文字コード・区切り文字の判定と、ポータル別フォーマットプロファイルの保存。
+ファイル先頭のバイト列だけで判定し、本体は判定した文字コードで1回だけパースする。
+本体は厳密に解釈し、先頭より後ろに判定した文字コードで解釈できないバイトがあれば UnicodeDecodeError になる。
+その場合、呼び出し側は resolve_format(whole_file=True) でファイル全体から判定し直して読み直す。
+判定結果（文字コード・区切り文字・ヘッダー行）はポータルごとに JSON で保存し、
+次回以降は先頭のバイト列がその文字コードで解釈でき、先頭行が一致すればサンプリングを省略する。
+圧縮ファイル・ZIP の中のファイル（app.data_source.ArchiveMember）は展開しながら同じように判定・読み込みする。
+"""
+import codecs
+import json
+import os
+import re
+import threading
+from pathlib import Path
+from typing import IO, NamedTuple
+
+from app import data_source, instrumentation
+
+# 判定に使う先頭バイト数
+SNIFF_BYTES = 64 * 1024
+
+# UTF-8 として解釈できない場合のフォールバック
+FALLBACK_ENCODING = "cp932"
+
+# プロファイルキー生成用（ファイル名中の日付・連番を同一視する）
+_DIGITS = re.compile(r"\d+")
+
+
+class FormatProfile(NamedTuple):
+    """1種類のファイルのフォーマット。header はヘッダーありの場合の先頭行の列名。"""
+
+    encoding: str
+    delimiter: str
+    header: tuple[str, ...] | None = None
+
+
+def detect_delimiter(sample: str) -> str:
+    """先頭行から区切り文字を推定。"""
+    if "\t" in sample and sample.count("\t") >= sample.count(","):
+        return "\t"
+    return ","
+
+
+def sniff_encoding(sample: bytes) -> str:
+    """先頭バイト列から文字コードを判定する。BOM 付き UTF-8 → UTF-8 → CP932 の順。"""
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    return "utf-8" if _decodes(sample, "utf-8") else FALLBACK_ENCODING
+
+
+def _decodes(data: bytes, encoding: str) -> bool:
+    """data が encoding で解釈できるか（末尾がマルチバイト文字の途中で切れていてもよい）。"""
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(data, final=False)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def sniff_whole_encoding(sample: bytes, rest: IO[bytes]) -> str:
+    """
+    ファイル全体（先頭 sample と、続きを読む rest）を厳密に解釈できる文字コードを返す。BOM 付き UTF-8 → UTF-8 → CP932 の順。
+    どれでも解釈できなければ UnicodeDecodeError。
+    """
+    candidates = ["utf-8-sig"] if sample.startswith(codecs.BOM_UTF8) else ["utf-8", FALLBACK_ENCODING]
+    decoders = {encoding: codecs.getincrementaldecoder(encoding)() for encoding in candidates}
+    error = None
+    data = sample
+    while decoders:
+        final = not data
+        for encoding, decoder in list(decoders.items()):
+            try:
+                decoder.decode(data, final=final)
+            except UnicodeDecodeError as e:
+                error = e
+                del decoders[encoding]
+        if final:
+            break
+        data = rest.read(SNIFF_BYTES)
+    for encoding in candidates:
+        if encoding in decoders:
+            return encoding
+    raise error
+
+
+def _first_line(data: bytes) -> bytes:
+    end = data.find(b"\n")
+    return data if end < 0 else data[: end + 1]
+
+
+def _split_header(line: str, delimiter: str) -> tuple[str, ...]:
+    return tuple(line.rstrip("\r\n").split(delimiter))
+
+
+def profile_key(path: data_source.Source) -> str:
+    """ファイル名の数字部分を # に置き換えたものをプロファイルのキーにする（日付・連番違いを同一視）。"""
+    return _DIGITS.sub("#", path.name.lower())
+
+
+class FormatProfileStore:
+    """
+    ポータル単位のフォーマットプロファイル保存先（JSON ファイル）。
+    スレッドから同時に使われてもよいよう、更新はロックして即時に書き出す。
+    """
+
+    def __init__(self, path: Path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._profiles: dict[str, FormatProfile] = {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+            for key, v in raw.items():
+                header = v.get("header")
+                self._profiles[key] = FormatProfile(
+                    v["encoding"], v["delimiter"], tuple(header) if header is not None else None
+                )
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            self._profiles = {}
+
+    def get(self, key: str) -> FormatProfile | None:
+        return self._profiles.get(key)
+
+    def put(self, key: str, profile: FormatProfile) -> None:
+        with self._lock:
+            if self._profiles.get(key) == profile:
+                return
+            self._profiles[key] = profile
+            data = {
+                k: {"encoding": p.encoding, "delimiter": p.delimiter, "header": list(p.header) if p.header else None}
+                for k, p in self._profiles.items()
+            }
+            try:
+                self._path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = self._path.with_name(self._path.name + ".tmp")
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False, indent=2)
+                os.replace(tmp, self._path)
+            except OSError:
+                # キャッシュの保存失敗は処理を止めない
+                pass
+
+
+def _matches(profile: FormatProfile, sample: bytes, has_header: bool) -> bool:
+    """
+    保存済みプロファイルが今回のファイルにも使えるかを先頭のバイト列で確認する。
+    先頭 SNIFF_BYTES バイト全体がその文字コードで解釈できること（ヘッダーなしでも確認する）と、ヘッダーありなら先頭行の列名の一致。
+    """
+    if not _decodes(sample, profile.encoding):
+        return False
+    if has_header:
+        line = _first_line(sample).decode(profile.encoding, errors="replace")
+        return profile.header == _split_header(line, profile.delimiter)
+    return True
+
+
+def resolve_format(
+    path: data_source.Source,
+    has_header: bool,
+    store: FormatProfileStore | None = None,
+    delimiter: str | None = None,
+    key_prefix: str = "",
+    whole_file: bool = False,
+) -> FormatProfile:
+    """
+    ファイルのフォーマットを返す。保存済みプロファイルが先頭のバイト列と一致すればそれを使い、
+    そうでなければ先頭 SNIFF_BYTES バイトから判定して保存する。
+    delimiter を指定した場合は区切り文字の判定を行わない（Choice の TSV 等）。
+    key_prefix は同じ保存先で別用途のファイル（最低在庫数定義等）を区別するためのもの。
+    whole_file=True の場合は保存済みプロファイルを使わず、文字コードをファイル全体から判定し直す
+    （判定した文字コードで解釈できないバイトが先頭より後ろにあった場合の読み直し用。どの文字コードでも解釈できなければ UnicodeDecodeError）。
+    """
+    key = key_prefix + profile_key(path)
+    cached = store.get(key) if store is not None and not whole_file else None
+    with data_source.open_binary(path) as f:
+        sample = f.read(SNIFF_BYTES)
+        if cached is not None and (delimiter is None or cached.delimiter == delimiter):
+            if _matches(cached, sample, has_header):
+                return cached
+        if whole_file:
+            instrumentation.count("encoding_resniffs")
+            encoding = sniff_whole_encoding(sample, f)
+        else:
+            encoding = sniff_encoding(sample)
+    first = _first_line(sample)
+    instrumentation.count("format_sniffs")
+    if encoding == FALLBACK_ENCODING:
+        instrumentation.count("encoding_fallbacks")
+    line = first.decode(encoding, errors="replace")
+    if delimiter is None:
+        delimiter = detect_delimiter(line)
+    header = _split_header(line, delimiter) if has_header else None
+    profile = FormatProfile(encoding, delimiter, header)
+    if store is not None:
+        store.put(key, profile)
+    return profile
+
+
+def open_text(path: data_source.Source, profile: FormatProfile) -> IO[str]:
+    """
+    判定済みの文字コードでテキストとして開く。
+    先頭サンプルより後ろに解釈できないバイトがあれば、読み進めた時点で UnicodeDecodeError になる（置換文字で読み進めない）。
+    """
+    return data_source.open_text(path, profile.encoding)
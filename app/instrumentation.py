@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+処理時間・件数の計測（ステージ別・ファイル別の経過時間と、読み込みバイト数等のカウンター）。
+計測先の RunMetrics は contextvars で保持するため、計測しない場合は各関数が何もしない。
+スレッドプールに処理を渡す場合は submit_in_context を使うと計測先が引き継がれる。
+結果は1ポータル1行の JSON Lines で書き出す。--profile 用の cProfile / tracemalloc 出力もここで行う。
+
+主なカウンター:
+  bytes_read / rows_parsed / rows_skipped（在庫数が数値でない行）/ rows_pruned（最低在庫数の定義がない行）/
+  encoding_fallbacks（CP932 と判定）/ format_sniffs（フォーマット判定を実行）/ parse_cache_hits /
+  file_errors（読み込めずに飛ばしたファイル）/ http_requests / http_retries
+"""
+import contextvars
+import io
+import json
+import sys
+import threading
+import time
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+# --profile 時に書き出す上位件数
+PROFILE_TOP_N = 40
+
+_current: contextvars.ContextVar["RunMetrics | None"] = contextvars.ContextVar("run_metrics", default=None)
+
+
+class RunMetrics:
+    """1ポータル分の計測結果。複数スレッドから同時に加算してよい。"""
+
+    def __init__(self, portal: str):
+        self.portal = portal
+        self.stages: dict[str, float] = {}
+        self.counters: dict[str, int] = {}
+        self.files: list[dict[str, Any]] = []
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_stage(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_file(self, record: dict[str, Any]) -> None:
+        with self._lock:
+            self.files.append(record)
+
+    def to_dict(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "type": "portal",
+                "portal": self.portal,
+                "elapsed": round(time.perf_counter() - self._started, 4),
+                "stages": {k: round(v, 4) for k, v in self.stages.items()},
+                "counters": dict(self.counters),
+                "files": sorted(self.files, key=lambda r: r["path"]),
+            }
+
+
+@contextmanager
+def collecting(metrics: RunMetrics | None) -> Iterator[RunMetrics | None]:
+    """with ブロック内の計測先を metrics にする（None なら計測しない）。"""
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """with ブロックの経過時間をステージ name に加算する。入れ子にした場合はそれぞれに加算される。"""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_stage(name, time.perf_counter() - started)
+
+
+@contextmanager
+def timed_file(path: Path, kind: str) -> Iterator[dict[str, Any]]:
+    """
+    1ファイル（または Choice のファイルの組）の処理時間を記録する。
+    yield した dict に rows 等を追加すると記録に含まれる。ファイルサイズは bytes_read にも加算する。
+    """
+    metrics = _current.get()
+    record: dict[str, Any] = {"path": str(path), "kind": kind}
+    if metrics is None:
+        yield record
+        return
+    try:
+        record["bytes"] = path.stat().st_size
+    except OSError:
+        record["bytes"] = 0
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = round(time.perf_counter() - started, 4)
+        metrics.add_file(record)
+        if not record.get("cached"):
+            metrics.count("bytes_read", record["bytes"])
+
+
+def is_collecting() -> bool:
+    """計測中か（子プロセスに計測を頼むかどうかの判断用）。"""
+    return _current.get() is not None
+
+
+def count(name: str, n: int = 1) -> None:
+    """カウンター name に n を加算する（計測していなければ何もしない）。"""
+    metrics = _current.get()
+    if metrics is not None and n:
+        metrics.count(name, n)
+
+
+def absorb(record: dict[str, Any] | None) -> None:
+    """子プロセスで計測した RunMetrics.to_dict() のカウンターとファイル別の記録を、現在の計測先に加える。"""
+    metrics = _current.get()
+    if metrics is None or record is None:
+        return
+    for name, n in record["counters"].items():
+        metrics.count(name, n)
+    for file_record in record["files"]:
+        metrics.add_file(file_record)
+
+
+def submit_in_context(executor: Executor, fn: Callable[..., Any], *args: Any) -> Future:
+    """現在の計測先を引き継いでスレッドプールに処理を渡す。"""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def summarize(records: list[dict[str, Any]]) -> dict[str, Any]:
+    """ポータルごとの計測結果を合算した1行分の集計を作る。"""
+    stages: dict[str, float] = {}
+    counters: dict[str, int] = {}
+    for record in records:
+        for name, seconds in (record.get("stages") or {}).items():
+            stages[name] = stages.get(name, 0.0) + seconds
+        for name, n in (record.get("counters") or {}).items():
+            counters[name] = counters.get(name, 0) + n
+    slowest = sorted(
+        ({"portal": r.get("portal"), **f} for r in records for f in r.get("files") or []),
+        key=lambda f: f.get("seconds", 0.0),
+        reverse=True,
+    )
+    return {
+        "type": "summary",
+        "portals": len(records),
+        "elapsed": round(sum(r.get("elapsed", 0.0) for r in records), 4),
+        "stages": {k: round(v, 4) for k, v in stages.items()},
+        "counters": counters,
+        "slowest_files": slowest[:10],
+    }
+
+
+def append_jsonl(path: Path, records: list[dict[str, Any]]) -> None:
+    """計測結果を JSON Lines で追記する。"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def read_jsonl(path: Path) -> list[dict[str, Any]]:
+    """append_jsonl で書いた計測結果を読み込む。読めない行は飛ばす。"""
+    records = []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return records
+
+
+@contextmanager
+def profiling(out_dir: Path | None, name: str) -> Iterator[None]:
+    """
+    out_dir を指定した場合、with ブロックを cProfile と tracemalloc で計測して書き出す。
+      {name}.prof（pstats 形式）/ {name}.pstats.txt（累積時間の上位）/ {name}.tracemalloc.txt（確保量の上位とピーク）
+    tracemalloc はプロセス全体が対象のため、スレッドで並列実行した場合は他ポータルの確保も含まれる。
+    """
+    if out_dir is None:
+        yield
+        return
+    # --profile 指定時だけ読み込む
+    import cProfile
+    import pstats
+    import tracemalloc
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(10)
+    profiler: "cProfile.Profile | None" = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # 別スレッドで既にプロファイル中の場合等（Python のバージョンによる）は tracemalloc だけ出力する
+        print(f"警告: cProfile を開始できません（{name}）: {e}", file=sys.stderr)
+        profiler = None
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(str(out_dir / f"{name}.prof"))
+            text = io.StringIO()
+            pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+            (out_dir / f"{name}.pstats.txt").write_text(text.getvalue(), encoding="utf-8")
+
+        # スレッド並列時に先に終わった側が tracemalloc を止めている場合は書き出さない
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            lines = [f"peak: {peak / 1024 / 1024:.1f} MiB", ""]
+            lines.extend(str(stat) for stat in snapshot.statistics("lineno")[:PROFILE_TOP_N])
+            (out_dir / f"{name}.tracemalloc.txt").write_text("\n".join(lines) + "\n", encoding="utf-8")
+            if started_tracing:
+                tracemalloc.stop()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+日次在庫数ファイルのパース結果（商品コード → 在庫数の合算）をローカルの SQLite に保存するキャッシュ。
+キーはファイルのパス・サイズ・更新日時と、パースに使ったマッピング設定。
+同じ日付ディレクトリを再実行したとき、変更のないファイルはパースせずにキャッシュから読み込む。
+合計サイズが上限を超えたら最終利用日時の古いものから削除する。
+"""
+import hashlib
+import json
+import sqlite3
+import time
+import zlib
+from pathlib import Path
+from typing import Any
+
+# パース処理の仕様を変えたら上げる（古いキャッシュを無効にするため）
+PARSER_VERSION = 2
+
+DEFAULT_MAX_MB = 256
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS parsed_files (
+    key TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    data BLOB NOT NULL,
+    bytes INTEGER NOT NULL,
+    last_used REAL NOT NULL
+)
+"""
+
+
+def config_key(config: dict[str, Any]) -> str:
+    """パース結果に影響する設定値からキャッシュキーの一部を作る。"""
+    raw = json.dumps({"version": PARSER_VERSION, **config}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class ParseCache:
+    """
+    パース結果の SQLite キャッシュ。1プロセス（1スレッド）内で使う。
+    rebuild=True の場合は読み込みを行わず、パースし直した結果で上書きする。
+    """
+
+    def __init__(self, db_path: Path, max_bytes: int = DEFAULT_MAX_MB * 1024 * 1024, rebuild: bool = False):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(db_path), timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+        self._max_bytes = max_bytes
+        self._rebuild = rebuild
+
+    @staticmethod
+    def _key(paths: list[Path], config: str) -> tuple[str, str] | None:
+        """ファイル群のパス・サイズ・更新日時と設定からキーを作る。stat できなければ None。"""
+        parts = []
+        for p in paths:
+            try:
+                st = p.stat()
+            except OSError:
+                return None
+            parts.append([str(p.resolve()), st.st_size, st.st_mtime_ns])
+        source = "|".join(part[0] for part in parts)
+        raw = json.dumps([parts, config], ensure_ascii=False)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest(), source
+
+    def get(self, paths: list[Path], config: str) -> dict[str, int] | None:
+        """キャッシュ済みの合算結果を返す。未登録・ファイル変更済み・rebuild 時は None。"""
+        if self._rebuild:
+            return None
+        key = self._key(paths, config)
+        if key is None:
+            return None
+        try:
+            row = self._conn.execute("SELECT data FROM parsed_files WHERE key = ?", (key[0],)).fetchone()
+            if row is None:
+                return None
+            with self._conn:
+                self._conn.execute("UPDATE parsed_files SET last_used = ? WHERE key = ?", (time.time(), key[0]))
+            return json.loads(zlib.decompress(row[0]).decode("utf-8"))
+        except (sqlite3.Error, zlib.error, ValueError):
+            return None
+
+    def put(self, paths: list[Path], config: str, aggregated: dict[str, int]) -> None:
+        """合算結果を保存する。同じファイルの古い結果は削除し、上限を超えたら古いものから削除する。"""
+        key = self._key(paths, config)
+        if key is None:
+            return
+        data = zlib.compress(json.dumps(aggregated, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        try:
+            with self._conn:
+                self._conn.execute("DELETE FROM parsed_files WHERE source = ? AND key <> ?", (key[1], key[0]))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO parsed_files (key, source, data, bytes, last_used) VALUES (?, ?, ?, ?, ?)",
+                    (key[0], key[1], data, len(data), time.time()),
+                )
+            self._evict()
+        except sqlite3.Error:
+            # 保存に失敗しても次回パースし直すだけなので処理は続ける
+            pass
+
+    def _evict(self) -> None:
+        total = self._conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM parsed_files").fetchone()[0]
+        if total <= self._max_bytes:
+            return
+        with self._conn:
+            for key, size in self._conn.execute("SELECT key, bytes FROM parsed_files ORDER BY last_used").fetchall():
+                if total <= self._max_bytes:
+                    break
+                self._conn.execute("DELETE FROM parsed_files WHERE key = ?", (key,))
+                total -= size
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def open_parse_cache(cache_dir: Path, settings: dict[str, Any], mode: str) -> ParseCache | None:
+    """
+    setting.json の parse_cache 設定と実行時の指定からキャッシュを開く。
+    mode: "use"（通常）/ "off"（--no-cache）/ "rebuild"（--rebuild-cache）
+    """
+    conf = settings.get("parse_cache") or {}
+    if mode == "off" or not conf.get("enabled", True):
+        return None
+    max_mb = conf.get("max_mb", DEFAULT_MAX_MB)
+    try:
+        return ParseCache(cache_dir / "parse_cache.sqlite3", int(max_mb) * 1024 * 1024, rebuild=(mode == "rebuild"))
+    except sqlite3.Error:
+        # キャッシュが使えなくても処理は続ける
+        return None
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+日次在庫数の履歴（ポータル・日付ごとの商品コード別合算在庫数）の保存と、減少傾向からの在庫切れ予測。
+
+保存形式（{cache_dir}/history/{ポータル名}/）:
+  - codes.jsonl      : 商品コードの辞書。1行1コード（JSON 文字列）で、行番号がコード ID。追記のみ
+  - {yyyy-mm-dd}.npy : その日の (code_id, stock) の構造化配列。code_id 昇順に並べ、コードでの検索は二分探索で行う
+日付・ポータルごとのファイルに分けるため、追記は1ファイルの書き込みだけで済み、期間での読み出しは該当日のファイルだけを読む。
+
+予測は直近 window_days 日の在庫数に最小二乗法で直線を当てはめ、減少している商品について
+現在の在庫数が最低在庫数に達するまでの日数を全商品まとめて配列演算で求める。
+"""
+import json
+import math
+import os
+import struct
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Any, Mapping, NamedTuple
+
+import numpy as np
+
+from app.compare_engine import CodeDictionary, ThresholdTable
+
+HISTORY_DTYPE = np.dtype([("code_id", np.int32), ("stock", np.int64)])
+
+# 既定値（setting.json の history で上書き）
+DEFAULT_WINDOW_DAYS = 14
+DEFAULT_FORECAST_DAYS = 7
+DEFAULT_MIN_POINTS = 3
+DEFAULT_RETENTION_DAYS = 730
+
+_CODES_FILE = "codes.jsonl"
+
+# .npy（バージョン 1.0）の先頭: マジック 6 バイト + バージョン 2 バイト + ヘッダー長 2 バイト
+_NPY_V1_PREFIX = b"\x93NUMPY\x01\x00"
+_NPY_V1_HEADER = struct.Struct("<H")
+
+
+def _read_partition(path: Path) -> np.ndarray:
+    """
+    1日分のファイルを読み込む。自分で書いたファイルは形式が決まっているため、
+    np.load のヘッダー解析（1ファイルあたり数十マイクロ秒）を省いて本体だけを配列にする。
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if data.startswith(_NPY_V1_PREFIX):
+        offset = len(_NPY_V1_PREFIX) + _NPY_V1_HEADER.size + _NPY_V1_HEADER.unpack_from(data, len(_NPY_V1_PREFIX))[0]
+        if (len(data) - offset) % HISTORY_DTYPE.itemsize == 0:
+            return np.frombuffer(data, dtype=HISTORY_DTYPE, offset=offset)
+    return np.load(path)
+
+
+class HistoryOptions(NamedTuple):
+    """
+    window_days: 傾向を求める期間（日数）/ forecast_days: この日数以内に最低在庫数に達する見込みなら予測として通知（0 で予測しない）
+    min_points: 傾向を求めるのに必要な記録日数 / retention_days: 履歴を残す日数（0 で削除しない）
+    """
+
+    window_days: int = DEFAULT_WINDOW_DAYS
+    forecast_days: int = DEFAULT_FORECAST_DAYS
+    min_points: int = DEFAULT_MIN_POINTS
+    retention_days: int = DEFAULT_RETENTION_DAYS
+
+
+def history_options(settings: dict[str, Any]) -> HistoryOptions:
+    """setting.json の history 設定から HistoryOptions を作る。"""
+    conf = settings.get("history") or {}
+    return HistoryOptions(
+        window_days=max(2, int(conf.get("window_days", DEFAULT_WINDOW_DAYS))),
+        forecast_days=max(0, int(conf.get("forecast_days", DEFAULT_FORECAST_DAYS))),
+        min_points=max(2, int(conf.get("min_points", DEFAULT_MIN_POINTS))),
+        retention_days=max(0, int(conf.get("retention_days", DEFAULT_RETENTION_DAYS))),
+    )
+
+
+class StockHistory:
+    """在庫数の履歴の保存先。ポータルごとのコード辞書は読み込んだものを保持する。"""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._codes: dict[str, CodeDictionary] = {}
+
+    def _portal_dir(self, portal: str) -> Path:
+        return self.root / portal
+
+    def _partition_path(self, portal: str, day: date) -> Path:
+        return self._portal_dir(portal) / f"{day.isoformat()}.npy"
+
+    def codes(self, portal: str) -> CodeDictionary:
+        """ポータルのコード辞書（codes.jsonl の行番号がコード ID）。"""
+        codes = self._codes.get(portal)
+        if codes is None:
+            codes = CodeDictionary()
+            path = self._portal_dir(portal) / _CODES_FILE
+            if path.exists():
+                with open(path, "r", encoding="utf-8") as f:
+                    codes.encode([json.loads(line) for line in f if line.strip()])
+            self._codes[portal] = codes
+        return codes
+
+    def days(self, portal: str) -> list[date]:
+        """記録のある日付を昇順で返す。"""
+        days = []
+        try:
+            names = os.listdir(self._portal_dir(portal))
+        except OSError:
+            return []
+        for name in names:
+            if not name.endswith(".npy"):
+                continue
+            try:
+                days.append(date.fromisoformat(name[:-4]))
+            except ValueError:
+                continue
+        return sorted(days)
+
+    def append(self, portal: str, day: date, stock_by_code: Mapping[str, int], retention_days: int = 0) -> None:
+        """
+        その日の商品コード別在庫数を保存する（同じ日付は上書き）。
+        retention_days を指定した場合は、day よりその日数以上前の記録を削除する。
+        """
+        portal_dir = self._portal_dir(portal)
+        portal_dir.mkdir(parents=True, exist_ok=True)
+        codes = self.codes(portal)
+        known = len(codes)
+        ids = codes.encode(list(stock_by_code.keys()))
+        if len(codes) > known:
+            # 新しいコードを辞書に追記してから、そのコード ID を使う在庫数を書き込む
+            with open(portal_dir / _CODES_FILE, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(c, ensure_ascii=False) + "\n" for c in codes.decode(range(known, len(codes))))
+
+        part = np.empty(len(ids), dtype=HISTORY_DTYPE)
+        part["code_id"] = ids
+        part["stock"] = np.fromiter(stock_by_code.values(), dtype=np.int64, count=len(stock_by_code))
+        part.sort(order="code_id")
+        path = self._partition_path(portal, day)
+        tmp = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npy")
+        np.save(tmp, part)
+        os.replace(tmp, path)
+
+        if retention_days > 0:
+            cutoff = day - timedelta(days=retention_days)
+            for old in self.days(portal):
+                if old >= cutoff:
+                    break
+                try:
+                    self._partition_path(portal, old).unlink()
+                except OSError:
+                    pass
+
+    def load(self, portal: str, start: date, end: date) -> tuple[list[date], np.ndarray]:
+        """
+        start〜end（両端を含む）の記録を (日付のリスト, 在庫数の行列) で返す。
+        行列はコード ID を行・日付を列にした float64 で、記録のない日は NaN。
+        """
+        days = [d for d in self.days(portal) if start <= d <= end]
+        # 日付ごとに連続した領域へ書き込めるよう (日付, コード ID) で作って転置する
+        matrix = np.full((len(days), len(self.codes(portal))), np.nan)
+        for j, day in enumerate(days):
+            part = _read_partition(self._partition_path(portal, day))
+            matrix[j, part["code_id"]] = part["stock"]
+        return days, matrix.T
+
+    def series(self, portal: str, product_code: str, start: date | None = None, end: date | None = None) -> list[tuple[date, int]]:
+        """1商品の (日付, 在庫数) を日付順で返す。各日のファイルは code_id 順のため二分探索で引く。"""
+        code_id = int(self.codes(portal).lookup([product_code])[0])
+        if code_id < 0:
+            return []
+        result = []
+        for day in self.days(portal):
+            if (start is not None and day < start) or (end is not None and day > end):
+                continue
+            part = _read_partition(self._partition_path(portal, day))
+            i = int(np.searchsorted(part["code_id"], code_id))
+            if i < len(part) and part["code_id"][i] == code_id:
+                result.append((day, int(part["stock"][i])))
+        return result
+
+
+def daily_trend(stock: np.ndarray, offsets: np.ndarray, min_points: int = DEFAULT_MIN_POINTS) -> np.ndarray:
+    """
+    在庫数の行列（行: 商品、列: 日付、記録なしは NaN）の各行に最小二乗法で直線を当てはめ、1日あたりの増減を返す。
+    offsets は各列の日付（基準日からの日数）。記録が min_points 日未満の行は NaN。
+    """
+    mask = ~np.isnan(stock)
+    n = mask.sum(axis=1)
+    x = np.where(mask, offsets.astype(np.float64), 0.0)
+    y = np.where(mask, stock, 0.0)
+    sx = x.sum(axis=1)
+    sy = y.sum(axis=1)
+    denom = n * (x * x).sum(axis=1) - sx * sx
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (n * (x * y).sum(axis=1) - sx * sy) / denom
+    slope[(n < min_points) | (denom == 0)] = np.nan
+    return slope
+
+
+def days_until_threshold(current: np.ndarray, mins: np.ndarray, slope: np.ndarray) -> np.ndarray:
+    """現在の在庫数が 1日あたり slope の傾向で最低在庫数に達するまでの日数。減少していない場合は inf。"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        days = (current - mins) / -slope
+    return np.where(slope < 0, days, np.inf)
+
+
+def forecast_depletion(
+    history: StockHistory,
+    portal_name: str,
+    day: date,
+    stock_by_code: Mapping[str, int],
+    thresholds: ThresholdTable,
+    options: HistoryOptions,
+) -> list[dict[str, Any]]:
+    """
+    直近 window_days 日の履歴（day の分を保存済みであること）から、最低在庫数をまだ上回っているが
+    forecast_days 日以内に達する見込みの商品を、到達までの日数が短い順に返す。
+    各要素は alert_records と同じキーに days_until_threshold（切り上げた日数）と daily_decrease（1日あたりの減少数）を加えたもの。
+    """
+    if options.forecast_days <= 0 or not stock_by_code:
+        return []
+    days, matrix = history.load(portal_name, day - timedelta(days=options.window_days - 1), day)
+    if len(days) < options.min_points:
+        return []
+
+    codes = list(stock_by_code.keys())
+    history_ids = history.codes(portal_name).lookup(codes)
+    known = history_ids >= 0
+    rows = np.full((len(codes), len(days)), np.nan)
+    rows[known] = matrix[history_ids[known]]
+    offsets = np.array([(d - day).days for d in days], dtype=np.float64)
+    slope = daily_trend(rows, offsets, options.min_points)
+
+    current = np.fromiter(stock_by_code.values(), dtype=np.int64, count=len(codes))
+    _, mins, has_min = thresholds.lookup(codes)
+    remaining = days_until_threshold(current, mins, slope)
+    hits = np.flatnonzero(has_min & (current > mins) & (remaining <= options.forecast_days))
+    hits = hits[np.argsort(remaining[hits], kind="stable")]
+    return [
+        {
+            "portal_name": portal_name,
+            "product_code": codes[i],
+            "current_stock": int(current[i]),
+            "min_stock": int(mins[i]),
+            "days_until_threshold": max(1, math.ceil(remaining[i])),
+            "daily_decrease": round(float(-slope[i]), 1),
+        }
+        for i in hits.tolist()
+    ]
+
+
+def open_stock_history(cache_dir: Path, settings: dict[str, Any]) -> StockHistory | None:
+    """setting.json の history 設定に従って履歴の保存先を返す。無効なら None。"""
+    conf = settings.get("history") or {}
+    if not conf.get("enabled", True):
+        return None
+    return StockHistory(cache_dir / "history")
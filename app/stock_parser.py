@@ -2,76 +2,253 @@
 """
 日次在庫数ファイル（CSV/TSV/TXT/XLSX）のパースと商品コード別在庫合算。
 日次在庫数ディレクトリを再帰的に検索し、該当ファイルを取得する。
+大きな CSV/TSV/TXT はレコード境界で分割し、プロセス並列でパースして合算する（app.csv_chunks）。
+最低在庫数を定義した商品コードの集合（keys）を渡した場合は、それ以外のコードの行を数値変換・合算の前に捨てる
+（Choice は明細側の行をジョイン表に入れない）。メモリ・処理時間が全商品数ではなく対象商品数に比例する。
+
+1ポータルのファイルが多い場合は、ポータル設定の file_workers（テキスト。読み込み待ちが主なのでスレッド）・
+xlsx_workers（XLSX。CPU が主なのでプロセス）でファイルごとに並行してパースできる。ファイルごとの合計を
+ファイルの順に合算するため、結果は1ファイルずつ読んだ場合と同じ。読み込めないファイルは警告して飛ばし、
+ポータルの他のファイルの処理は続ける。
+
+圧縮ファイル（.csv.gz 等）・ZIP は展開せずに中のファイルをストリームで読む（app.data_source）。
+中のファイル名は通常のファイル名と同じように扱い、拡張子での判別・Choice の組み合わせも同じ規則で行う。
 """
 import csv
+import mmap
+import sys
+from concurrent.futures import BrokenExecutor, Future, ThreadPoolExecutor
+from contextlib import ExitStack
 from pathlib import Path
-from typing import Any
+from typing import AbstractSet, Any, Callable, Iterator
 
-from openpyxl import load_workbook
+from app import csv_chunks, instrumentation
+from app.csv_chunks import ParallelOptions
+from app.data_source import ArchiveMember, Source, list_sources, source_order
+from app.dir_walker import ScanOptions
+from app.format_sniffer import FormatProfileStore, open_text, resolve_format
+from app.parse_cache import ParseCache, config_key
 
 
-# 対象拡張子（日次在庫数ファイル）
+# 対象拡張子（日次在庫数ファイル）。これらを圧縮した .gz・これらを含む .zip も対象（app.data_source.ARCHIVE_EXTENSIONS）
 DATA_EXTENSIONS = (".csv", ".tsv", ".txt", ".xlsx")
 
-# エンコーディングのフォールバック順（テキスト用。BOM 付き UTF-8 を先に試す）
-ENCODINGS = ("utf-8-sig", "utf-8", "cp932")
-
 # Choice ポータル: TSV ジョイン用のカラム位置のデフォルト（0-based）
 CHOICE_DETAILS_PRODUCT_CODE_COL_DEFAULT = 102  # 103列目
 CHOICE_CHANGE_STOCK_COL_DEFAULT = 3  # 4列目
+# Choice ポータル: ファイルの組を並行処理するスレッド数のデフォルト
+CHOICE_JOIN_WORKERS_DEFAULT = 4
+# Choice ポータル: 在庫用 TSV のファイル名（拡張子を除く）の末尾
+CHOICE_CHANGE_STOCK_SUFFIX = "_change_stock"
+# ファイルごとに並行してパースするスレッド数（テキスト）・プロセス数（XLSX）のデフォルト（1 なら1ファイルずつ）
+FILE_WORKERS_DEFAULT = 1
+XLSX_WORKERS_DEFAULT = 1
 
 
-def _detect_delimiter(sample: str) -> str:
-    """先頭行から区切り文字を推定。"""
-    if "\t" in sample and sample.count("\t") >= sample.count(","):
-        return "\t"
-    return ","
+def _find_column(header: list[str], column: str) -> int | None:
+    """ヘッダー行から列名の位置を返す。重複時は後勝ち（DictReader と同じ）。BOM 付きの列名も照合する。"""
+    index = {name: i for i, name in enumerate(header)}
+    found = index.get(column)
+    if found is None:
+        # BOM 付きヘッダーのフォールバック（\ufeff が先頭につくことがある）
+        found = index.get("\ufeff" + column)
+    return found
 
 
-def _read_csv_rows(path: Path, has_header: bool, product_column: str, stock_column: str) -> list[tuple[str, int]]:
-    """CSV/TSV/TXT をパースし、(商品コード, 在庫数) のリストを返す。"""
-    pairs: list[tuple[str, int]] = []
-    for enc in ENCODINGS:
-        try:
-            with open(path, "r", encoding=enc, newline="") as f:
-                sample = f.readline()
-                f.seek(0)
-                delimiter = _detect_delimiter(sample)
-                if has_header:
-                    reader = csv.DictReader(f, delimiter=delimiter)
-                    rows = list(reader)
-                else:
-                    reader = csv.reader(f, delimiter=delimiter)
-                    rows = [{str(i): c for i, c in enumerate(row)} for row in reader]
-                for row in rows:
-                    # BOM 付きヘッダーのフォールバック（\ufeff が先頭につくことがある）
-                    code = row.get(product_column) or row.get("\ufeff" + product_column)
-                    stock_raw = row.get(stock_column) or row.get("\ufeff" + stock_column)
-                    if code is None or code == "" or stock_raw is None:
-                        continue
-                    try:
-                        stock = int(float(str(stock_raw).replace(",", "").strip()))
-                    except (ValueError, TypeError):
-                        continue
-                    key = str(code).strip()
-                    if key:
-                        pairs.append((key, stock))
-                return pairs
-        except (UnicodeDecodeError, csv.Error, OSError):
-            continue
-    return pairs
+def _iter_stock_fields(
+    rows: Iterator[list[str]],
+    code_idx: int,
+    stock_idx: int,
+    counts: list[int],
+    keys: AbstractSet[str] | None = None,
+) -> Iterator[tuple[str, int]]:
+    """
+    CSV の行から (商品コード, 在庫数) を返す。商品コードが空の行・列の足りない行は飛ばす。
+    keys を渡した場合はそれに含まれないコードの行を在庫数の変換前に飛ばす。
+    counts[0] に返した行数、counts[1] に在庫数が数値でなく飛ばした行数、counts[2] に keys で飛ばした行数を加える。
+    """
+    min_len = max(code_idx, stock_idx) + 1
+    parsed = skipped = pruned = 0
+    try:
+        for row in rows:
+            if len(row) < min_len:
+                continue
+            code = row[code_idx].strip()
+            if not code:
+                continue
+            if keys is not None and code not in keys:
+                pruned += 1
+                continue
+            try:
+                stock = int(float(row[stock_idx].replace(",", "").strip()))
+            except (ValueError, OverflowError):
+                skipped += 1
+                continue
+            parsed += 1
+            yield code, stock
+    finally:
+        counts[0] += parsed
+        counts[1] += skipped
+        counts[2] += pruned
+
+
+def _read_csv_rows(
+    path: Source,
+    has_header: bool,
+    product_column: str,
+    stock_column: str,
+    profiles: FormatProfileStore | None = None,
+    keys: AbstractSet[str] | None = None,
+    whole_file: bool = False,
+) -> Iterator[tuple[str, int]]:
+    """
+    CSV/TSV/TXT をストリーミングでパースし、(商品コード, 在庫数) を1行ずつ返す。
+    文字コード・区切り文字は先頭バイト列から一度だけ判定し（profiles があれば保存済みを再利用）、
+    ファイル本体は1回だけ読む。商品コード・在庫数の列位置はヘッダーから一度だけ解決し、行ごとの辞書は作らない。
+    keys を渡した場合はそれに含まれる商品コードの行だけを返す。
+    途中で読み込み・パースに失敗した場合は例外をそのまま送出する（途中までの行をファイルの合計として扱わないため）。
+    whole_file は resolve_format と同じ（UnicodeDecodeError になったファイルの読み直し用）。
+    """
+    counts = [0, 0, 0]
+    try:
+        profile = resolve_format(path, has_header, profiles, whole_file=whole_file)
+        with open_text(path, profile) as f:
+            reader = csv.reader(f, delimiter=profile.delimiter)
+            columns = _resolve_csv_columns(reader, has_header, product_column, stock_column)
+            if columns is None:
+                return
+            yield from _iter_stock_fields(reader, columns[0], columns[1], counts, keys)
+    finally:
+        instrumentation.count("rows_parsed", counts[0])
+        instrumentation.count("rows_skipped", counts[1])
+        instrumentation.count("rows_pruned", counts[2])
+
+
+def _resolve_csv_columns(
+    reader: Iterator[list[str]], has_header: bool, product_column: str, stock_column: str
+) -> tuple[int, int] | None:
+    """(商品コード列, 在庫数列) の位置。ヘッダーありの場合は reader から先頭行を読む。列が見つからなければ None。"""
+    if not has_header:
+        return int(product_column), int(stock_column)
+    header = next(reader, None)
+    if header is None:
+        return None
+    code_idx = _find_column(header, product_column)
+    stock_idx = _find_column(header, stock_column)
+    if code_idx is None or stock_idx is None:
+        return None
+    return code_idx, stock_idx
+
+
+def _read_csv_chunked(
+    path: Path,
+    has_header: bool,
+    product_column: str,
+    stock_column: str,
+    profiles: FormatProfileStore | None,
+    parallel: ParallelOptions,
+    keys: AbstractSet[str] | None = None,
+) -> dict[str, int] | None:
+    """
+    大きな CSV/TSV/TXT をレコード境界で範囲に分け、範囲ごとの商品コード別合計をプロセス並列で求めて合算する。
+    範囲の順に合算するため、結果（辞書の順序も含む）は _read_csv_rows を1行ずつ合算した場合と同じ。
+    プロセス数が1の場合・分割できない（範囲が1つ・区切り位置がレコード境界でなかった）場合と、並列処理に失敗した場合は None を返す（1プロセスで読み直す）。
+    """
+    workers = csv_chunks.worker_count(parallel)
+    if workers < 2:
+        return None
+    try:
+        profile = resolve_format(path, has_header, profiles)
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            start = csv_chunks.record_end(buf, 0, 0) if has_header else 0
+            if start is None:
+                return None
+            chunk_bytes = min(parallel.chunk_bytes, max(1, -(-(len(buf) - start) // workers)))
+            ranges = csv_chunks.split_ranges(buf, start, chunk_bytes)
+        if ranges is None or len(ranges) < 2:
+            return None
+
+        if has_header:
+            # ヘッダー行もレコード1つ分で終わっていることを確かめる
+            header = csv_chunks.RangeRows(path, 0, start, profile.encoding, profile.delimiter)
+            rows = iter(header)
+            columns = _resolve_csv_columns(rows, has_header, product_column, stock_column)
+            if next(rows, None) is not None or not header.ended_cleanly:
+                instrumentation.count("parse_chunk_fallbacks")
+                return None
+            if columns is None:
+                return {}
+        else:
+            columns = (int(product_column), int(stock_column))
+        partials = csv_chunks.map_ranges(
+            _sum_csv_range, path, ranges, workers, profile.encoding, profile.delimiter, columns[0], columns[1], keys
+        )
+    except Exception as e:
+        # 子プロセスの起動失敗等も含め、1プロセスでの読み込みに切り替える
+        print(f"警告: {path} を分割して読み込めなかったため、1プロセスで読み込みます: {e}", file=sys.stderr)
+        return None
+    if not all(ended_cleanly for _, _, ended_cleanly in partials):
+        instrumentation.count("parse_chunk_fallbacks")
+        return None
+
+    instrumentation.count("parse_chunks", len(ranges))
+    aggregated: dict[str, int] = {}
+    get = aggregated.get
+    for partial, (parsed, skipped, pruned), _ in partials:
+        instrumentation.count("rows_parsed", parsed)
+        instrumentation.count("rows_skipped", skipped)
+        instrumentation.count("rows_pruned", pruned)
+        for code, stock in partial.items():
+            aggregated[code] = get(code, 0) + stock
+    return aggregated
 
 
-def _read_xlsx_rows(path: Path, has_header: bool, product_column: str, stock_column: str) -> list[tuple[str, int]]:
-    """XLSX をパースし、(商品コード, 在庫数) のリストを返す。"""
-    pairs: list[tuple[str, int]] = []
-    wb = load_workbook(path, read_only=True, data_only=True)
+def _sum_csv_range(
+    path: Path,
+    start: int,
+    end: int,
+    encoding: str,
+    delimiter: str,
+    code_idx: int,
+    stock_idx: int,
+    keys: AbstractSet[str] | None = None,
+) -> tuple[dict[str, int], list[int], bool]:
+    """
+    ファイルの [start, end) をパースし、(商品コード別合計, _iter_stock_fields の counts, 範囲の終わりがレコード境界だったか) を返す。
+    _read_csv_chunked から子プロセスで呼ばれる。
+    """
+    rows = csv_chunks.RangeRows(path, start, end, encoding, delimiter)
+    counts = [0, 0, 0]
+    partial: dict[str, int] = {}
+    get = partial.get
+    for code, stock in _iter_stock_fields(iter(rows), code_idx, stock_idx, counts, keys):
+        partial[code] = get(code, 0) + stock
+    return partial, counts, rows.ended_cleanly
+
+
+def _file_size(path: Source) -> int:
     try:
-        ws = wb.active
-        rows = list(ws.iter_rows(values_only=True))
-        if not rows:
-            return pairs
-        header = [str(c).strip() if c is not None else "" for c in rows[0]]
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+
+def _read_xlsx_rows(
+    path: Source,
+    has_header: bool,
+    product_column: str,
+    stock_column: str,
+    keys: AbstractSet[str] | None = None,
+) -> Iterator[tuple[str, int]]:
+    """
+    XLSX をストリーミングでパースし、(商品コード, 在庫数) を1行ずつ返す。シートからは2列だけを読み出す。
+    keys を渡した場合はそれに含まれる商品コードの行だけを返す。
+    """
+    # XLSX がある場合だけ読み込む（起動時間を短くするため）
+    from app.xlsx_reader import iter_xlsx_columns
+
+    def resolve_columns(first_row: list[Any]) -> tuple[tuple[int, int], bool]:
+        header = [str(c).strip() if c is not None else "" for c in first_row]
         if has_header:
             try:
                 code_idx = header.index(product_column)
@@ -84,108 +261,279 @@ def _read_xlsx_rows(path: Path, has_header: bool, product_column: str, stock_col
         else:
             code_idx = int(product_column) if product_column.isdigit() else 0
             stock_idx = int(stock_column) if stock_column.isdigit() else 1
-        data_rows = rows[1:] if has_header else rows
-        for row in data_rows:
-            if row is None or len(row) <= max(code_idx, stock_idx):
+        return (code_idx, stock_idx), not has_header
+
+    parsed = skipped = pruned = 0
+    try:
+        for code, stock_raw in iter_xlsx_columns(path, resolve_columns):
+            if code is None:
                 continue
-            code = row[code_idx]
-            stock_raw = row[stock_idx]
-            if code is None or str(code).strip() == "":
+            code = str(code).strip()
+            if not code:
+                continue
+            if keys is not None and code not in keys:
+                pruned += 1
                 continue
             try:
                 stock = int(float(str(stock_raw or "0").replace(",", "").strip()))
-            except (ValueError, TypeError):
+            except (ValueError, TypeError, OverflowError):
+                skipped += 1
                 continue
-            pairs.append((str(code).strip(), stock))
+            parsed += 1
+            yield code, stock
     finally:
-        wb.close()
-    return pairs
+        instrumentation.count("rows_parsed", parsed)
+        instrumentation.count("rows_skipped", skipped)
+        instrumentation.count("rows_pruned", pruned)
 
 
-def _parse_choice_tsv_join(daily_stock_dir: Path, portal_config: dict[str, Any]) -> dict[str, int]:
+def _parse_choice_tsv_join(
+    daily_stock_dir: Path,
+    portal_config: dict[str, Any],
+    profiles: FormatProfileStore | None = None,
+    cache: ParseCache | None = None,
+    scan: ScanOptions | None = None,
+    load_keys: Callable[[], AbstractSet[str]] | None = None,
+) -> dict[str, int]:
     """
     Choice ポータル専用: 2つのTSVを第一カラムでジョインし、返礼品コードと在庫数を取得する。
     - 末尾が _change_stock のTSV: mapping.change_stock_column_index 列目を在庫数
     - 末尾が _change_stock でないTSV: mapping.details_product_code_column_index 列目を返礼品コード
-    stg_ はステージングのため無視し、末尾 _change_stock で判別する。
+    stg_ はステージングのため無視し、末尾 _change_stock で判別する（.gz・.zip の中の TSV も中のファイル名で判別する）。
+    ファイルの組は portal_config.join_workers（既定 CHOICE_JOIN_WORKERS_DEFAULT）のスレッドで並行に処理する。
+    cache を渡すとファイルの組ごとのジョイン結果をキャッシュする。
+    load_keys は parse_portal_stock と同じ（cache を渡した場合は絞り込まずにジョインしてキャッシュし、合算時に絞り込む）。
     """
     mapping = portal_config.get("mapping") or {}
     details_col = mapping.get("details_product_code_column_index", CHOICE_DETAILS_PRODUCT_CODE_COL_DEFAULT)
     stock_col = mapping.get("change_stock_column_index", CHOICE_CHANGE_STOCK_COL_DEFAULT)
-    change_stock_suffix = "_change_stock"
-    tsv_files = list(daily_stock_dir.rglob("*.tsv"))
-    change_stock_paths: list[Path] = []
-    details_paths: dict[str, Path] = {}  # base_without_suffix -> path
+    change_stock_suffix = CHOICE_CHANGE_STOCK_SUFFIX
+    with instrumentation.stage("scan"):
+        tsv_files = list_sources(daily_stock_dir, (".tsv",), scan)
+    keys = load_keys() if load_keys is not None and tsv_files else None
+    # キャッシュするのは絞り込む前の結果（最低在庫数定義を編集してもキャッシュが無効にならないよう、keys はキーに含めない）
+    join_keys = keys if cache is None else None
+    cache_config = config_key({"join": True, "details_col": details_col, "stock_col": stock_col})
+    change_stock_paths: list[Source] = []
+    details_paths: dict[str, Source] = {}  # base_without_suffix -> path
     for p in tsv_files:
-        if not p.is_file():
-            continue
         stem = p.stem
         if stem.endswith(change_stock_suffix):
             change_stock_paths.append(p)
         else:
             details_paths[stem] = p
 
-    aggregated: dict[str, int] = {}
-    for change_stock_path in change_stock_paths:
-        stem = change_stock_path.stem
-        details_base = stem[: -len(change_stock_suffix)]
+    pairs: list[list[Source]] = []
+    for change_stock_path in sorted(change_stock_paths, key=source_order):
+        details_base = change_stock_path.stem[: -len(change_stock_suffix)]
         details_path = details_paths.get(details_base)
-        if not details_path or not details_path.exists():
-            continue
+        if details_path and details_path.exists():
+            pairs.append([change_stock_path, details_path])
 
-        change_stock_rows = _read_tsv_rows(change_stock_path, stock_col, is_stock=True)
-        details_rows = _read_tsv_rows(details_path, details_col, is_stock=False)
-        if not change_stock_rows or not details_rows:
-            continue
+    # キャッシュの参照・保存は呼び出し元スレッドで行い（SQLite 接続はスレッドをまたげない）、未キャッシュの組だけ並行処理する
+    joined_by_pair: list[dict[str, int] | None] = [
+        cache.get(pair, cache_config) if cache is not None else None for pair in pairs
+    ]
+    pending = [i for i, joined in enumerate(joined_by_pair) if joined is None]
+    instrumentation.count("parse_cache_hits", len(pairs) - len(pending))
+    if pending:
+        workers = max(1, min(int(portal_config.get("join_workers", CHOICE_JOIN_WORKERS_DEFAULT)), len(pending)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                i: instrumentation.submit_in_context(
+                    executor, _join_choice_pair, pairs[i][0], pairs[i][1], stock_col, details_col, profiles, join_keys
+                )
+                for i in pending
+            }
+            for i, future in futures.items():
+                try:
+                    joined_by_pair[i] = future.result()
+                except Exception as e:
+                    # 読み込めない組は飛ばし、他の組の処理は続ける（キャッシュしない）
+                    _warn_file_error(pairs[i][0], e)
+                    continue
+                if cache is not None:
+                    cache.put(pairs[i], cache_config, joined_by_pair[i])
 
-        details_by_key = {k: v for k, v in details_rows}
-        for join_key, stock in change_stock_rows:
-            product_code = details_by_key.get(join_key)
-            if product_code and product_code.strip():
-                aggregated[product_code.strip()] = aggregated.get(product_code.strip(), 0) + stock
-    return aggregated
+    # 組の順序どおりに合算する（並行処理の完了順に依存しない）
+    return _merge_partials(joined_by_pair, keys if join_keys is None else None)
 
 
-def _read_tsv_rows(path: Path, target_col: int, is_stock: bool) -> list[tuple[str, str | int]]:
-    """TSV を読み、先頭列をキー、target_col 列を値としたリストを返す。ヘッダーなし。"""
-    result: list[tuple[str, str | int]] = []
-    for enc in ENCODINGS:
+def _join_choice_pair(
+    change_stock_path: Source,
+    details_path: Source,
+    stock_col: int,
+    details_col: int,
+    profiles: FormatProfileStore | None,
+    keys: AbstractSet[str] | None = None,
+) -> dict[str, int]:
+    """
+    _change_stock TSV と明細 TSV を第一カラムでジョインし、返礼品コードごとの在庫数を返す。
+    ファイルサイズの小さい側だけを2列分のハッシュ表にし、もう一方はストリーミングで突き合わせる。
+    keys を渡した場合は、それに含まれる返礼品コードの明細行だけでハッシュ表を作り（対象商品数に比例して小さい）、
+    在庫側はストリーミングで突き合わせる。
+    どちらの向きでも、明細側で同じキーが複数ある場合は後勝ち（従来の辞書化と同じ）。
+    """
+    with instrumentation.timed_file(change_stock_path, "choice_pair") as record:
         try:
-            with open(path, "r", encoding=enc, newline="") as f:
-                reader = csv.reader(f, delimiter="\t")
-                for row in reader:
-                    if len(row) <= max(0, target_col):
-                        continue
-                    key = str(row[0]).strip()
-                    val = row[target_col]
-                    if not key:
-                        continue
-                    if is_stock:
-                        try:
-                            stock = int(float(str(val or "0").replace(",", "").strip()))
-                            result.append((key, stock))
-                        except (ValueError, TypeError):
-                            continue
-                    else:
-                        result.append((key, str(val).strip()))
-                return result
-        except (UnicodeDecodeError, csv.Error, OSError):
+            details_size = details_path.stat().st_size
+            build_stock_side = keys is None and change_stock_path.stat().st_size <= details_size
+        except OSError:
+            return {}
+        record["bytes"] = record.get("bytes", 0) + details_size
+        record["details"] = str(details_path)
+        try:
+            joined = _join_choice_files(
+                change_stock_path, details_path, stock_col, details_col, profiles, build_stock_side, keys
+            )
+        except UnicodeDecodeError:
+            # 先頭で判定した文字コードで解釈できないバイトが後ろにあった: ファイル全体から判定し直して読み直す
+            joined = _join_choice_files(
+                change_stock_path, details_path, stock_col, details_col, profiles, build_stock_side, keys, True
+            )
+        record["codes"] = len(joined)
+        return joined
+
+
+def _join_choice_files(
+    change_stock_path: Source,
+    details_path: Source,
+    stock_col: int,
+    details_col: int,
+    profiles: FormatProfileStore | None,
+    build_stock_side: bool,
+    keys: AbstractSet[str] | None = None,
+    whole_file: bool = False,
+) -> dict[str, int]:
+    """
+    _join_choice_pair の本体。build_stock_side が True なら在庫側、False なら明細側をハッシュ表にする。
+    keys は明細側をハッシュ表にする場合だけ使う（keys にない返礼品コードの行は表に入れない）。
+    whole_file は resolve_format と同じ（両方のファイルに使う）。
+    """
+
+    product_by_key: dict[str, str] = {}
+    if build_stock_side:
+        # 在庫側をキーごとの合計に畳み込み、明細側は一致したキーの返礼品コードだけを保持する
+        stock_by_key = _sum_stock_by_key(change_stock_path, stock_col, profiles, whole_file)
+        if not stock_by_key:
+            return {}
+        for key, product_code in _iter_tsv_rows(details_path, details_col, profiles, whole_file):
+            if key in stock_by_key:
+                product_by_key[key] = product_code.strip()
+        joined: dict[str, int] = {}
+        for key, product_code in product_by_key.items():
+            if product_code:
+                joined[product_code] = joined.get(product_code, 0) + stock_by_key[key]
+        return joined
+
+    pruned = 0
+    for key, product_code in _iter_tsv_rows(details_path, details_col, profiles, whole_file):
+        product_code = product_code.strip()
+        if keys is not None and product_code not in keys:
+            # 後勝ちのため、以前の行で対象だったキーも外す
+            product_by_key.pop(key, None)
+            pruned += 1
             continue
-    return result
+        product_by_key[key] = product_code
+    instrumentation.count("rows_pruned", pruned)
+    if not product_by_key:
+        return {}
+    joined = {}
+    wanted = product_by_key if keys is not None else None
+    for key, stock in _iter_stock_rows(change_stock_path, stock_col, profiles, wanted, whole_file):
+        product_code = product_by_key.get(key)
+        if product_code:
+            joined[product_code] = joined.get(product_code, 0) + stock
+    return joined
+
+
+def _sum_stock_by_key(
+    path: Source, stock_col: int, profiles: FormatProfileStore | None, whole_file: bool = False
+) -> dict[str, int]:
+    """_change_stock TSV をジョインキーごとの在庫数合計に畳み込む。"""
+    stock_by_key: dict[str, int] = {}
+    for key, stock in _iter_stock_rows(path, stock_col, profiles, None, whole_file):
+        stock_by_key[key] = stock_by_key.get(key, 0) + stock
+    return stock_by_key
+
+
+def _iter_stock_rows(
+    path: Source,
+    stock_col: int,
+    profiles: FormatProfileStore | None,
+    wanted: AbstractSet[str] | dict[str, Any] | None = None,
+    whole_file: bool = False,
+) -> Iterator[tuple[str, int]]:
+    """
+    _change_stock TSV の (ジョインキー, 在庫数) を1行ずつ返す。数値でない在庫数の行は飛ばす。
+    wanted を渡した場合はそれに含まれるジョインキーの行だけを、在庫数の変換前に絞り込んで返す。
+    """
+    skipped = pruned = 0
+    try:
+        for key, val in _iter_tsv_rows(path, stock_col, profiles, whole_file):
+            if wanted is not None and key not in wanted:
+                pruned += 1
+                continue
+            try:
+                yield key, int(float((val or "0").replace(",", "").strip()))
+            except (ValueError, OverflowError):
+                skipped += 1
+                continue
+    finally:
+        instrumentation.count("rows_skipped", skipped)
+        instrumentation.count("rows_pruned", pruned)
+
+
+def _iter_tsv_rows(
+    path: Source, target_col: int, profiles: FormatProfileStore | None = None, whole_file: bool = False
+) -> Iterator[tuple[str, str]]:
+    """
+    TSV をストリーミングで読み、(先頭列, target_col 列) を1行ずつ返す。ヘッダーなし。
+    途中で読み込み・パースに失敗した場合は例外をそのまま送出する（_read_csv_rows と同じ）。whole_file も同じ。
+    """
+    min_len = max(0, target_col) + 1
+    parsed = 0
+    try:
+        profile = resolve_format(path, False, profiles, delimiter="\t", whole_file=whole_file)
+        with open_text(path, profile) as f:
+            for row in csv.reader(f, delimiter="\t"):
+                if len(row) < min_len:
+                    continue
+                key = row[0].strip()
+                if key:
+                    parsed += 1
+                    yield key, row[target_col]
+    finally:
+        instrumentation.count("rows_parsed", parsed)
 
 
 def parse_portal_stock(
     daily_stock_dir: Path,
     portal_config: dict[str, Any],
+    profiles: FormatProfileStore | None = None,
+    cache: ParseCache | None = None,
+    scan: ScanOptions | None = None,
+    parallel: ParallelOptions | None = None,
+    load_keys: Callable[[], AbstractSet[str]] | None = None,
 ) -> dict[str, int]:
     """
-    日次在庫数ディレクトリを再帰的に検索し、CSV/TSV/TXT/XLSX をパースする。
+    日次在庫数ディレクトリを再帰的に検索し、CSV/TSV/TXT/XLSX（.gz に圧縮したもの・.zip の中のものも）をパースする。
     商品コードで在庫数を合算した辞書を返す。
     Choice ポータルは tsv_join_mode で TSV 2ファイルのジョイン処理を行う。
     カラム名は portal_config.mapping で指定（product_code_column, stock_column 等）。
+    profiles を渡すとテキストファイルのフォーマット判定結果を保存・再利用する。
+    cache を渡すとファイルごとの合算結果をキャッシュし、変更のないファイルはパースしない。
+    scan はディレクトリ走査の設定（除外パターン・並列数・一覧の保存先）。
+    parallel を渡すと parallel.min_bytes 以上の CSV/TSV/TXT はレコード境界で分割してプロセス並列でパースする。
+    load_keys を渡すと、対象ファイルがあった場合だけ呼び出し、返した商品コード（最低在庫数を定義したもの）の行だけを集計する。
+    対象ファイルがなければ呼ばない（最低在庫数定義を読まずに済ませるため）。
+    cache がなければパース時に行を絞り込む。cache があれば絞り込まずにパースしてファイルごとの結果をキャッシュし、合算時に絞り込む
+    （最低在庫数定義の商品が変わってもキャッシュを使えるよう、キャッシュのキーに商品コードの集合は含めない）。
+    portal_config.file_workers / xlsx_workers を 2 以上にすると、ファイルごとに並行してパースする（_parse_files）。
+    読み込めないファイルは警告して飛ばし、残りのファイルで合算する。
     """
     if portal_config.get("tsv_join_mode"):
-        return _parse_choice_tsv_join(daily_stock_dir, portal_config)
+        return _parse_choice_tsv_join(daily_stock_dir, portal_config, profiles, cache, scan, load_keys)
 
     mapping = portal_config.get("mapping") or {}
     has_header = mapping.get("has_header", portal_config.get("has_header", True))
@@ -196,25 +544,169 @@ def parse_portal_stock(
         product_column = str(mapping.get("product_code_column_index", 0))
         stock_column = str(mapping.get("stock_column_index", 1))
 
+    with instrumentation.stage("scan"):
+        data_files = list_sources(daily_stock_dir, DATA_EXTENSIONS, scan)
+    keys = load_keys() if load_keys is not None and data_files else None
+    # キャッシュするのは絞り込む前の結果（_parse_choice_tsv_join と同じ）
+    parse_keys = keys if cache is None else None
+    cache_config = config_key({"has_header": has_header, "product": product_column, "stock": stock_column})
+
+    # キャッシュの参照・保存は呼び出し元スレッドで行い（SQLite 接続はスレッドをまたげない）、未キャッシュのファイルだけパースする
+    partials: list[dict[str, int] | None] = [None] * len(data_files)
+    pending: list[int] = []
+    for i, path in enumerate(data_files):
+        cached = cache.get([path], cache_config) if cache is not None else None
+        if cached is None:
+            pending.append(i)
+            continue
+        with instrumentation.timed_file(path, path.suffix.lower().lstrip(".")) as record:
+            record["cached"] = True
+        instrumentation.count("parse_cache_hits")
+        partials[i] = cached
+
+    columns = (has_header, product_column, stock_column)
+    for i, partial in _parse_files(data_files, pending, columns, portal_config, profiles, parallel, parse_keys):
+        partials[i] = partial
+        if cache is not None:
+            cache.put([data_files[i]], cache_config, partial)
+
+    # ファイルの順に合算する（並行処理の完了順に依存しない）
+    return _merge_partials(partials, keys if parse_keys is None else None)
+
+
+def _merge_partials(partials: list[dict[str, int] | None], keys: AbstractSet[str] | None) -> dict[str, int]:
+    """ファイル（Choice はファイルの組）ごとの商品コード別合計を順に合算する。keys を渡した場合はそれに含まれる商品コードだけ。"""
     aggregated: dict[str, int] = {}
+    get = aggregated.get
+    for partial in partials:
+        for code, stock in (partial or {}).items():
+            if keys is not None and code not in keys:
+                continue
+            aggregated[code] = get(code, 0) + stock
+    return aggregated
 
-    if not daily_stock_dir.is_dir():
-        return aggregated
 
-    for path in daily_stock_dir.rglob("*"):
-        if not path.is_file():
-            continue
-        suf = path.suffix.lower()
-        if suf not in DATA_EXTENSIONS:
-            continue
+def _parse_files(
+    data_files: list[Source],
+    pending: list[int],
+    columns: tuple[bool, str, str],
+    portal_config: dict[str, Any],
+    profiles: FormatProfileStore | None,
+    parallel: ParallelOptions | None,
+    keys: AbstractSet[str] | None,
+) -> Iterator[tuple[int, dict[str, int]]]:
+    """
+    data_files のうち pending の位置のファイルをパースし、(位置, 商品コード別合計) を pending の順に返す。
+    テキストは portal_config.file_workers のスレッド、XLSX は portal_config.xlsx_workers のプロセスで並行に処理する
+    （どちらも 1 なら呼び出し元スレッドで1ファイルずつ）。
+    読み込めなかったファイル（テキストの途中の行で失敗したものも含む）は警告して file_errors に数え、返さない（キャッシュもされない）。
+    """
+    xlsx = [i for i in pending if data_files[i].suffix.lower() == ".xlsx"]
+    text = [i for i in pending if data_files[i].suffix.lower() != ".xlsx"]
+    xlsx_workers = min(max(1, int(portal_config.get("xlsx_workers", XLSX_WORKERS_DEFAULT))), len(xlsx))
+    file_workers = min(max(1, int(portal_config.get("file_workers", FILE_WORKERS_DEFAULT))), len(text))
+    futures: dict[int, Future] = {}
+    with ExitStack() as stack:
+        if xlsx_workers > 1:
+            # XLSX がある場合だけ読み込む（起動時間を短くするため）。map_ranges と同じく spawn で起動する
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            executor = stack.enter_context(
+                ProcessPoolExecutor(max_workers=xlsx_workers, mp_context=multiprocessing.get_context("spawn"))
+            )
+            collect = instrumentation.is_collecting()
+            for i in xlsx:
+                futures[i] = executor.submit(_sum_xlsx_file, data_files[i], *columns, keys, collect)
+        if file_workers > 1:
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=file_workers))
+            for i in text:
+                futures[i] = instrumentation.submit_in_context(
+                    executor, _sum_file, data_files[i], *columns, profiles, parallel, keys
+                )
 
+        for i in pending:
+            path = data_files[i]
+            try:
+                future = futures.get(i)
+                if future is None:
+                    partial = _sum_file(path, *columns, profiles, parallel, keys)
+                elif data_files[i].suffix.lower() == ".xlsx":
+                    try:
+                        partial, child_metrics = future.result()
+                    except BrokenExecutor:
+                        # 子プロセスが異常終了した場合はこのプロセスで読み直す
+                        partial = _sum_file(path, *columns, profiles, parallel, keys)
+                    else:
+                        instrumentation.absorb(child_metrics)
+                else:
+                    partial = future.result()
+            except Exception as e:
+                _warn_file_error(path, e)
+                continue
+            yield i, partial
+
+
+def _sum_file(
+    path: Source,
+    has_header: bool,
+    product_column: str,
+    stock_column: str,
+    profiles: FormatProfileStore | None,
+    parallel: ParallelOptions | None,
+    keys: AbstractSet[str] | None,
+) -> dict[str, int]:
+    """1ファイルをパースし、商品コード別合計を返す。"""
+    suf = path.suffix.lower()
+    with instrumentation.timed_file(path, suf.lstrip(".")) as record:
+        chunked = None
+        # 分割パースは mmap できる通常のファイルだけ（圧縮ファイル・ZIP の中のファイルは先頭から順に展開して読む）
+        if (
+            suf != ".xlsx"
+            and parallel is not None
+            and not isinstance(path, ArchiveMember)
+            and _file_size(path) >= parallel.min_bytes
+        ):
+            chunked = _read_csv_chunked(path, has_header, product_column, stock_column, profiles, parallel, keys)
+        if chunked is not None:
+            record["chunked"] = True
+            return chunked
         if suf == ".xlsx":
-            pairs = _read_xlsx_rows(path, has_header, product_column, stock_column)
-        else:
-            pairs = _read_csv_rows(path, has_header, product_column, stock_column)
+            return _sum_pairs(_read_xlsx_rows(path, has_header, product_column, stock_column, keys))
+        try:
+            return _sum_pairs(_read_csv_rows(path, has_header, product_column, stock_column, profiles, keys))
+        except UnicodeDecodeError:
+            # 先頭で判定した文字コードで解釈できないバイトが後ろにあった: ファイル全体から判定し直して読み直す
+            return _sum_pairs(_read_csv_rows(path, has_header, product_column, stock_column, profiles, keys, True))
 
-        for code, stock in pairs:
-            if code:
-                aggregated[code] = aggregated.get(code, 0) + stock
 
-    return aggregated
+def _sum_pairs(pairs: Iterator[tuple[str, int]]) -> dict[str, int]:
+    partial: dict[str, int] = {}
+    get = partial.get
+    for code, stock in pairs:
+        partial[code] = get(code, 0) + stock
+    return partial
+
+
+def _sum_xlsx_file(
+    path: Source,
+    has_header: bool,
+    product_column: str,
+    stock_column: str,
+    keys: AbstractSet[str] | None,
+    collect_metrics: bool,
+) -> tuple[dict[str, int], dict[str, Any] | None]:
+    """
+    XLSX 1ファイルを _sum_file でパースし、(商品コード別合計, 計測結果) を返す。_parse_files から子プロセスで呼ばれる。
+    計測結果は collect_metrics の場合だけ返し、呼び出し元で instrumentation.absorb する。
+    """
+    metrics = instrumentation.RunMetrics(str(path)) if collect_metrics else None
+    with instrumentation.collecting(metrics):
+        partial = _sum_file(path, has_header, product_column, stock_column, None, None, keys)
+    return partial, metrics.to_dict() if metrics is not None else None
+
+
+def _warn_file_error(path: Source, error: Exception) -> None:
+    """読み込めなかったファイルを警告する（そのファイルの在庫数は合算しない）。"""
+    instrumentation.count("file_errors")
+    print(f"警告: {path} を読み込めなかったため、このファイルを飛ばします: {error!r}", file=sys.stderr)
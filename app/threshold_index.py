@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+最低在庫数定義をコンパクトなバイナリ形式（サイドカーインデックス）に変換して保存・再利用する。
+元ファイルのサイズ・更新日時が変わらない限り、CSV/XLSX をパースせずにインデックスから読み込む。
+更新日時だけが変わった場合（コピーし直し等）は内容のハッシュを比較し、同じなら再利用する。
+
+ファイル形式（リトルエンディアン）:
+  ヘッダー: マジック(8) / 元ファイルサイズ(u64) / 元ファイル更新日時 ns(i64) / 元ファイル SHA-1(20) /
+            設定ダイジェスト(16) / 件数 n(u32)
+  offsets: (n+1) 個の u32。codes 領域内の各コードの開始位置
+  mins:    n 個の i64。最低在庫数
+  codes:   定義ファイルの順（パターン規則の優先度に使う）の返礼品コードを UTF-8 で NUL 区切りで連結したもの
+読み込みは to_dict で全件を dict に展開する（インデックスで省けるのは CSV/XLSX のパースで、dict への展開は省けない）。
+"""
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from pathlib import Path
+
+MAGIC = b"STHIDX01"
+_HEADER = struct.Struct("<8sQq20s16sI")
+
+# ハッシュ計算時の読み込み単位
+_HASH_CHUNK = 1 << 20
+
+
+def file_sha1(path: Path) -> bytes:
+    """ファイル内容の SHA-1。"""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+def config_digest(raw: str) -> bytes:
+    """インデックスの内容に影響する設定値のダイジェスト。"""
+    return hashlib.md5(raw.encode("utf-8")).digest()
+
+
+class ThresholdIndex:
+    """mmap したサイドカーインデックス。ヘッダーの元ファイルの情報を確かめてから to_dict で読み込む。"""
+
+    def __init__(self, path: Path):
+        if sys.byteorder != "little":
+            raise ValueError("リトルエンディアン環境でのみ使用できます")
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, self.source_size, self.source_mtime_ns, self.source_sha1, self.config, n = _HEADER.unpack_from(
+                self._mm, 0
+            )
+            if magic != MAGIC:
+                raise ValueError("インデックスの形式が不正です")
+            self._n = n
+            offsets_start = _HEADER.size
+            mins_start = offsets_start + 4 * (n + 1)
+            self._codes_start = mins_start + 8 * n
+            view = memoryview(self._mm)
+            self._offsets = view[offsets_start:mins_start].cast("I")
+            self._mins = view[mins_start : self._codes_start].cast("q")
+            if len(self._mm) < self._codes_start + self._offsets[n]:
+                raise ValueError("インデックスが途中で切れています")
+        except (ValueError, struct.error, TypeError):
+            self.close()
+            raise
+
+    def __len__(self) -> int:
+        return self._n
+
+    def to_dict(self) -> dict[str, int]:
+        """全件を定義ファイルの順の dict に展開する。コード列の分割・数値配列の変換はまとめて行う。"""
+        if self._n == 0:
+            return {}
+        blob = self._mm[self._codes_start : self._codes_start + self._offsets[self._n] - 1]
+        codes = blob.decode("utf-8").split("\x00")
+        return dict(zip(codes, self._mins.tolist()))
+
+    def close(self) -> None:
+        for attr in ("_offsets", "_mins"):
+            view = getattr(self, attr, None)
+            if view is not None:
+                view.release()
+        self._mm.close()
+
+
+def write_index(
+    path: Path,
+    thresholds: dict[str, int],
+    source_size: int,
+    source_mtime_ns: int,
+    source_sha1: bytes,
+    config: bytes,
+) -> None:
+    """最低在庫数定義をインデックスファイルに書き出す（thresholds の順のまま。一時ファイル経由で置き換える）。"""
+    encoded = [(code.encode("utf-8"), value) for code, value in thresholds.items() if "\x00" not in code]
+    offsets = array("I", [0])
+    mins = array("q")
+    pos = 0
+    for code, value in encoded:
+        pos += len(code) + 1
+        offsets.append(pos)
+        mins.append(value)
+    if offsets.itemsize != 4 or mins.itemsize != 8 or sys.byteorder != "little":
+        raise ValueError("このプラットフォームではインデックスを作成できません")
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, source_size, source_mtime_ns, source_sha1, config, len(encoded)))
+        f.write(offsets.tobytes())
+        f.write(mins.tobytes())
+        f.write(b"".join(code + b"\x00" for code, _ in encoded))
+    os.replace(tmp, path)
+
+
+def index_path_for(index_dir: Path, source: Path, config: bytes) -> Path:
+    """元ファイルのパスと設定からインデックスの保存先を決める。"""
+    name = hashlib.sha1(str(source.resolve()).encode("utf-8") + config).hexdigest()
+    return index_dir / f"{name}.idx"
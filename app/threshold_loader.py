@@ -4,67 +4,87 @@
 各ポータルの min_stock_base_path で指定した CSV または XLSX ファイルのパスを参照する。
 """
 import csv
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterable
 
-from openpyxl import load_workbook
+from app import instrumentation
+from app.cache_dir import resolve_cache_dir
+from app.format_sniffer import FormatProfileStore, open_text, resolve_format
+from app.threshold_index import ThresholdIndex, config_digest, file_sha1, index_path_for, write_index
 
 # 返礼品コード列の候補（CSV/Excel のヘッダー名）
 PRODUCT_CODE_HEADERS = ("返礼品コード", "商品コード", "出品者SKU", "管理コード")
 MIN_STOCK_HEADER = "最低在庫数"
 
-ENCODINGS = ("utf-8", "utf-8-sig", "cp932")
+# フォーマットプロファイル上のキー接頭辞（日次在庫数ファイルと区別する）
+PROFILE_KEY_PREFIX = "threshold:"
 
+# 読み込み仕様を変えたら上げる（古いインデックスを無効にするため）
+INDEX_VERSION = 2
 
-def _load_from_csv(path: Path) -> dict[str, int]:
-    """CSV から返礼品コード・最低在庫数を読み込む。"""
+# load_all_thresholds で同時に読み込むファイル数
+LOAD_ALL_WORKERS = 8
+
+
+def _load_from_csv(
+    path: Path, profiles: FormatProfileStore | None = None, whole_file: bool = False
+) -> tuple[dict[str, int], bool]:
+    """
+    CSV から返礼品コード・最低在庫数を読み込む。文字コード・区切り文字は先頭バイト列から一度だけ判定する。
+    判定した文字コードで解釈できないバイトが後ろにあった場合は、ファイル全体から判定し直して読み直す（whole_file）。
+    戻り値: (読み込めた分, 最後まで読み込めたか)。途中で失敗した場合は警告し、読み込めた分は今回の実行だけで使う。
+    """
     result: dict[str, int] = {}
-    for enc in ENCODINGS:
-        try:
-            with open(path, "r", encoding=enc, newline="") as f:
-                sample = f.readline()
-                delimiter = "\t" if "\t" in sample and sample.count("\t") >= sample.count(",") else ","
-                f.seek(0)
-                reader = csv.DictReader(f, delimiter=delimiter)
-                headers = [h.strip() for h in (reader.fieldnames or [])]
-                code_col = None
-                min_col = None
-                for h in PRODUCT_CODE_HEADERS:
-                    if h in headers:
-                        code_col = h
-                        break
-                if MIN_STOCK_HEADER in headers:
-                    min_col = MIN_STOCK_HEADER
-                if not code_col or not min_col:
-                    return result
-                for row in reader:
-                    code = (row.get(code_col) or "").strip()
-                    min_val = row.get(min_col)
-                    if not code:
-                        continue
-                    try:
-                        min_stock = int(float(str(min_val or "0").replace(",", "").strip()))
-                    except (ValueError, TypeError):
-                        continue
-                    result[code] = min_stock
-                return result
-        except (UnicodeDecodeError, csv.Error, OSError):
-            continue
-    return result
+    try:
+        profile = resolve_format(path, True, profiles, key_prefix=PROFILE_KEY_PREFIX, whole_file=whole_file)
+        with open_text(path, profile) as f:
+            reader = csv.reader(f, delimiter=profile.delimiter)
+            headers = [h.strip() for h in next(reader, None) or []]
+            code_idx = None
+            for h in PRODUCT_CODE_HEADERS:
+                if h in headers:
+                    code_idx = headers.index(h)
+                    break
+            if code_idx is None or MIN_STOCK_HEADER not in headers:
+                return result, True
+            min_idx = headers.index(MIN_STOCK_HEADER)
+            for row in reader:
+                if len(row) <= code_idx:
+                    continue
+                code = row[code_idx].strip()
+                if not code:
+                    continue
+                # 最低在庫数の列が欠けている行は 0 とみなす
+                min_val = row[min_idx] if min_idx < len(row) else ""
+                try:
+                    min_stock = int(float((min_val or "0").replace(",", "").strip()))
+                except (ValueError, OverflowError):
+                    continue
+                result[code] = min_stock
+    except UnicodeDecodeError as e:
+        if not whole_file:
+            return _load_from_csv(path, profiles, True)
+        print(f"警告: {path} の読み込みに失敗しました: {e}", file=sys.stderr)
+        return result, False
+    except (csv.Error, OSError) as e:
+        print(f"警告: {path} の読み込みに失敗しました: {e}", file=sys.stderr)
+        return result, False
+    return result, True
 
 
 def _load_from_xlsx(path: Path, portal_config: dict[str, Any]) -> dict[str, int]:
-    """Excel から返礼品コード・最低在庫数を読み込む。"""
+    """Excel から返礼品コード・最低在庫数を読み込む。シートからは2列だけを読み出す。"""
+    from app.xlsx_reader import iter_xlsx_columns
+
     mapping = portal_config.get("mapping") or {}
     product_column = mapping.get("product_code_column") or "返礼品コード"
     result: dict[str, int] = {}
-    wb = load_workbook(path, read_only=True, data_only=True)
-    try:
-        ws = wb.active
-        rows = list(ws.iter_rows(values_only=True))
-        if not rows:
-            return result
-        header = [str(c).strip() if c is not None else "" for c in rows[0]]
+
+    def resolve_columns(first_row: list[Any]) -> tuple[tuple[int, int], bool]:
+        header = [str(c).strip() if c is not None else "" for c in first_row]
         code_idx = 0
         for h in (product_column,) + PRODUCT_CODE_HEADERS:
             try:
@@ -76,36 +96,145 @@ def _load_from_xlsx(path: Path, portal_config: dict[str, Any]) -> dict[str, int]
             min_idx = header.index(MIN_STOCK_HEADER)
         except ValueError:
             min_idx = 1 if code_idx == 0 else 0
-        for row in rows[1:]:
-            if row is None or len(row) <= max(code_idx, min_idx):
-                continue
-            code = row[code_idx]
-            min_val = row[min_idx]
-            if code is None or str(code).strip() == "":
-                continue
-            try:
-                min_stock = int(float(str(min_val).replace(",", "").strip()))
-            except (ValueError, TypeError):
-                continue
-            result[str(code).strip()] = min_stock
-    finally:
-        wb.close()
+        return (code_idx, min_idx), False
+
+    for code, min_val in iter_xlsx_columns(path, resolve_columns):
+        if code is None or str(code).strip() == "":
+            continue
+        try:
+            min_stock = int(float(str(min_val).replace(",", "").strip()))
+        except (ValueError, TypeError, OverflowError):
+            continue
+        result[str(code).strip()] = min_stock
     return result
 
 
-def load_thresholds(portal_min_stock_path: str, portal_config: dict[str, Any]) -> dict[str, int]:
+def _parse_thresholds(
+    path: Path, portal_config: dict[str, Any], profiles: FormatProfileStore | None
+) -> tuple[dict[str, int], bool]:
+    """戻り値: (最低在庫数定義, 最後まで読み込めたか)。途中で失敗した結果はインデックスに保存しない。"""
+    suf = path.suffix.lower()
+    if suf == ".csv":
+        return _load_from_csv(path, profiles)
+    if suf in (".xlsx", ".xls"):
+        return _load_from_xlsx(path, portal_config), True
+    return {}, True
+
+
+def _load_with_index(
+    path: Path,
+    portal_config: dict[str, Any],
+    profiles: FormatProfileStore | None,
+    index_dir: Path,
+) -> dict[str, int]:
+    """
+    サイドカーインデックスが元ファイルと一致すればそこから読み込み、なければパースしてインデックスを作る。
+    サイズ・更新日時が一致すれば内容は読まない。更新日時だけ違う場合は内容のハッシュで判定する。
+    """
+    mapping = portal_config.get("mapping") or {}
+    config = config_digest(
+        json.dumps({"version": INDEX_VERSION, "product_code_column": mapping.get("product_code_column") or ""})
+    )
+    index_path = index_path_for(index_dir, path, config)
+    st = path.stat()
+    sha1 = None
+    try:
+        index = ThresholdIndex(index_path)
+    except (OSError, ValueError):
+        index = None
+    if index is not None:
+        try:
+            if index.config == config and index.source_size == st.st_size:
+                if index.source_mtime_ns == st.st_mtime_ns:
+                    instrumentation.count("threshold_index_hits")
+                    return index.to_dict()
+                sha1 = file_sha1(path)
+                if index.source_sha1 == sha1:
+                    reused = index.to_dict()
+                else:
+                    reused = None
+            else:
+                reused = None
+        finally:
+            index.close()
+        if reused is not None:
+            instrumentation.count("threshold_index_hits")
+            # 内容は同じなので更新日時だけ記録し直す
+            _write_index_quietly(index_path, reused, st, sha1, config)
+            return reused
+
+    if sha1 is None:
+        sha1 = file_sha1(path)
+    result, complete = _parse_thresholds(path, portal_config, profiles)
+    # 途中で読み込みに失敗した場合（一時的な読み込みエラー等）は、欠けた定義を次回以降に使わないよう保存しない。
+    # パース中に元ファイルが更新された場合も、古い内容を新しい日時で記録しないよう保存しない
+    after = path.stat()
+    if complete and (after.st_size, after.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+        _write_index_quietly(index_path, result, st, sha1, config)
+    return result
+
+
+def _write_index_quietly(index_path: Path, thresholds: dict[str, int], st, sha1: bytes, config: bytes) -> None:
+    try:
+        write_index(index_path, thresholds, st.st_size, st.st_mtime_ns, sha1, config)
+    except (OSError, ValueError, OverflowError):
+        # インデックスが書けなくても（他プロセスが開いている等）次回パースし直すだけ
+        pass
+
+
+def load_thresholds(
+    portal_min_stock_path: str,
+    portal_config: dict[str, Any],
+    profiles: FormatProfileStore | None = None,
+    index_dir: Path | None = None,
+) -> dict[str, int]:
     """
     ポータル用の最低在庫数定義ファイルを読み込む。
     portal_min_stock_path は CSV または XLSX ファイルへの直接パス。
     setting.json の portals.{ポータル名}.min_stock_base_path で指定する。
     返礼品コードをキー・最低在庫数を値とした辞書を返す。
+    profiles を渡すと CSV のフォーマット判定結果を保存・再利用する。
+    index_dir を渡すとコンパイル済みインデックスを保存し、元ファイルが変わるまで再利用する。
     """
     path = Path(portal_min_stock_path)
     if not path.exists():
         return {}
-    suf = path.suffix.lower()
-    if suf == ".csv":
-        return _load_from_csv(path)
-    if suf in (".xlsx", ".xls"):
-        return _load_from_xlsx(path, portal_config)
-    return {}
+    with instrumentation.timed_file(path, "thresholds") as record:
+        result = None
+        if index_dir is not None:
+            try:
+                result = _load_with_index(path, portal_config, profiles, index_dir)
+            except OSError:
+                pass
+        if result is None:
+            result, _ = _parse_thresholds(path, portal_config, profiles)
+        record["codes"] = len(result)
+        return result
+
+
+def load_all_thresholds(
+    settings: dict[str, Any], portal_names: Iterable[str] | None = None
+) -> dict[str, dict[str, int]]:
+    """
+    setting.json で min_stock_base_path が設定されたポータルの最低在庫数定義をまとめて読み込む。
+    一括実行用。portal_names を渡した場合はそのポータル（大文字小文字は区別しない）だけを読み込む。
+    キーは小文字に正規化したポータル名。インデックスは {cache_dir}/thresholds を使う。
+    """
+    portals = settings.get("portals") or {}
+    cache_dir = resolve_cache_dir(settings)
+    wanted = {name.strip().lower() for name in portal_names} if portal_names is not None else None
+    targets = {
+        name.lower(): (cfg or {})
+        for name, cfg in portals.items()
+        if str((cfg or {}).get("min_stock_base_path") or "").strip() and (wanted is None or name.lower() in wanted)
+    }
+
+    def load(name: str) -> dict[str, int]:
+        cfg = targets[name]
+        profiles = FormatProfileStore(cache_dir / "format_profiles" / f"{name}.json")
+        return load_thresholds(cfg["min_stock_base_path"], cfg, profiles, cache_dir / "thresholds")
+
+    if not targets:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(LOAD_ALL_WORKERS, len(targets))) as executor:
+        return dict(zip(targets, executor.map(load, targets)))
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+最低在庫数定義のパターン規則（前方一致・ワイルドカード）。
+
+返礼品コード列が PATTERN_PREFIX（pattern:）で始まる行は、1商品ではなくコードのまとまりへの規則とみなす。
+  - pattern:ABC-*     : ABC- で始まるコード（前方一致）
+  - pattern:ABC-??-1* : fnmatch と同じワイルドカード（大文字小文字は区別する）
+  - pattern:*         : すべてのコード（既定の最低在庫数）
+接頭辞のない行は * ? [...] を含んでいても（ABC[2] 等）そのコードだけの完全一致の定義として扱う。
+完全一致の行が最優先で、複数の規則に当てはまる場合は具体的なものを使う:
+  固定部分（最初のワイルドカードより前）が長い > ワイルドカード以外の文字が多い > 定義ファイルで後にある。
+
+規則は固定部分の文字列ごとにまとめ、固定部分の長さの降順に辞書で引く（固定部分の前方一致の索引）。
+1コードの解決は、コードの先頭からそれぞれの長さの部分文字列を引くだけで済み、規則の数には比例しない。
+"""
+import fnmatch
+import re
+from typing import Iterable, Mapping, NamedTuple
+
+# 返礼品コード列でパターン規則を表す接頭辞
+PATTERN_PREFIX = "pattern:"
+
+_WILDCARD = re.compile(r"[*?[]")
+_WILDCARD_TOKEN = re.compile(r"\[[^\]]*\]|[*?]")
+
+
+def is_pattern(code: str) -> bool:
+    """返礼品コード列の値がパターン規則（PATTERN_PREFIX で始まる）か。"""
+    return code.startswith(PATTERN_PREFIX)
+
+
+def split_rules(min_by_code: Mapping[str, int]) -> tuple[dict[str, int], dict[str, int]]:
+    """
+    最低在庫数定義を (完全一致のコード → 最低在庫数, パターン → 最低在庫数) に分ける。順序は元のまま。
+    パターンは PATTERN_PREFIX を除いたもの。
+    """
+    exact: dict[str, int] = {}
+    patterns: dict[str, int] = {}
+    for code, min_stock in min_by_code.items():
+        if is_pattern(code):
+            patterns[code[len(PATTERN_PREFIX):].strip()] = min_stock
+        else:
+            exact[code] = min_stock
+    return exact, patterns
+
+
+class _Rule(NamedTuple):
+    # 同じ固定部分の中での優先度（ワイルドカード以外の文字数, 定義ファイルでの順番）
+    rank: tuple[int, int]
+    # 固定部分の後ろを照合する正規表現。前方一致（固定部分 + *）の場合は None
+    regex: re.Pattern | None
+    min_stock: int
+
+
+class ThresholdRules:
+    """パターン規則の索引。resolve でコードに当てはまる最も具体的な規則の最低在庫数を返す。"""
+
+    def __init__(self, patterns: Mapping[str, int]):
+        self.patterns = tuple(patterns)
+        buckets: dict[str, list[_Rule]] = {}
+        for order, (pattern, min_stock) in enumerate(patterns.items()):
+            wildcard = _WILDCARD.search(pattern)
+            prefix = pattern[: wildcard.start()] if wildcard else pattern
+            regex = None if pattern[len(prefix):] == "*" else re.compile(fnmatch.translate(pattern))
+            literal = len(_WILDCARD_TOKEN.sub("", pattern))
+            buckets.setdefault(prefix, []).append(_Rule((literal, order), regex, min_stock))
+        for rules in buckets.values():
+            rules.sort(key=lambda r: r.rank, reverse=True)
+        self._buckets = buckets
+        self._lengths = sorted({len(prefix) for prefix in buckets}, reverse=True)
+
+    def __len__(self) -> int:
+        return len(self.patterns)
+
+    def resolve(self, code: str) -> int | None:
+        """code に当てはまる最も具体的な規則の最低在庫数。当てはまる規則がなければ None。"""
+        buckets = self._buckets
+        size = len(code)
+        for n in self._lengths:
+            if n > size:
+                continue
+            rules = buckets.get(code[:n])
+            if rules is None:
+                continue
+            for rule in rules:
+                if rule.regex is None or rule.regex.match(code):
+                    return rule.min_stock
+        return None
+
+
+class RuleKeys(frozenset):
+    """
+    パース時の絞り込み用の商品コードの集合。完全一致のコードを要素に持ち、in では規則に当てはまるコードも含むとみなす。
+    """
+
+    rules: ThresholdRules
+
+    def __new__(cls, codes: Iterable[str], rules: ThresholdRules):
+        keys = super().__new__(cls, codes)
+        keys.rules = rules
+        return keys
+
+    def __contains__(self, code: object) -> bool:
+        return frozenset.__contains__(self, code) or (isinstance(code, str) and self.rules.resolve(code) is not None)
+
+    def __reduce__(self):
+        return type(self), (frozenset(self), self.rules)
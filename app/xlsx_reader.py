@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+XLSX の先頭（アクティブ）シートから必要な列だけを行単位で読み出すストリーミングリーダー。
+openpyxl を経由せず、ZIP 内のシート XML を一定サイズずつ展開して1行ずつ処理する。
+共有文字列テーブルのみメモリに保持し、シート全体は保持しない。
+stock_parser と threshold_loader で共用する。圧縮ファイル・ZIP の中の XLSX（app.data_source.ArchiveMember）はメモリに読んでから開く。
+
+Excel / openpyxl が出力する標準的な形式（全セルに r 属性があり名前空間接頭辞なし）は
+必要な列のセルだけを正規表現で拾う高速経路で読み、それ以外は iterparse で読む。
+"""
+import html
+import posixpath
+import re
+import zipfile
+from pathlib import Path
+from typing import Any, Callable, Iterator, Sequence
+from xml.etree.ElementTree import iterparse
+
+from app import data_source
+
+_NS_MAIN = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_NS_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_NS_PKG_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+_TAG_ROW = _NS_MAIN + "row"
+_TAG_V = _NS_MAIN + "v"
+_TAG_IS = _NS_MAIN + "is"
+_TAG_T = _NS_MAIN + "t"
+_TAG_R = _NS_MAIN + "r"
+_TAG_SI = _NS_MAIN + "si"
+_TAG_SHEET_DATA = _NS_MAIN + "sheetData"
+
+# 高速経路で一度に展開するシート XML のバイト数
+CHUNK_BYTES = 1 << 20
+
+_RE_SHEET_DATA = re.compile(rb"<sheetData\b[^>]*?(/?)>")
+_RE_ROW_START = rb"<row\b[^>]*>"
+_RE_ATTR_T = re.compile(rb'\bt="(\w+)"')
+_RE_V = re.compile(rb"<v>([^<]*)</v>")
+_RE_T = re.compile(rb"<t\b[^>]*>([^<]*)</t>")
+_RE_RPH = re.compile(rb"<rPh\b.*?</rPh>", re.S)
+_RE_FIRST_ROW = re.compile(rb"<row\b[^>]*?(?:/>|>(.*?)</row>)", re.S)
+_RE_ALL_CELLS = re.compile(rb'<c r="([A-Z]+)\d+"([^>]*?)(?:/>|>(.*?)</c>)', re.S)
+
+# 列記号（"AB" 等）→ 0 始まりの列番号のキャッシュ
+_COLUMN_INDEX: dict[str, int] = {}
+
+# resolve_columns の戻り値: (読み出す列番号, 先頭行もデータとして扱うか)
+ColumnResolver = Callable[[list[Any]], tuple[Sequence[int], bool]]
+
+
+def _column_index(ref: str) -> int:
+    """セル参照（"AB12"）または列記号（"AB"）から 0 始まりの列番号を返す。"""
+    letters = ref.rstrip("0123456789")
+    idx = _COLUMN_INDEX.get(letters)
+    if idx is None:
+        idx = 0
+        for ch in letters:
+            idx = idx * 26 + (ord(ch) - 64)
+        idx -= 1
+        _COLUMN_INDEX[letters] = idx
+    return idx
+
+
+def _cast_number(text: str) -> int | float:
+    """数値セルを openpyxl と同じ規則で int / float に変換する。"""
+    if "." in text or "E" in text or "e" in text:
+        return float(text)
+    return int(text)
+
+
+def _cell_value(cell, shared_strings: list[str]) -> Any:
+    """セル要素の値を openpyxl（data_only=True）と同じ型で返す。"""
+    t = cell.get("t")
+    if t == "inlineStr":
+        node = cell.find(_TAG_IS)
+        return _rich_text(node) if node is not None else None
+    v = cell.find(_TAG_V)
+    if v is None or v.text is None:
+        return None
+    text = v.text
+    if t is None or t == "n":
+        return _cast_number(text)
+    if t == "s":
+        return shared_strings[int(text)]
+    if t == "b":
+        return text == "1"
+    return text
+
+
+def _rich_text(node) -> str:
+    """<si> / <is> 要素の文字列。リッチテキストは各 <r> の <t> を連結する（ふりがな <rPh> は除く）。"""
+    t = node.find(_TAG_T)
+    if t is not None:
+        return t.text or ""
+    return "".join((r.findtext(_TAG_T) or "") for r in node.iter(_TAG_R))
+
+
+def _read_shared_strings(zf: zipfile.ZipFile, name: str | None) -> list[str]:
+    if not name or name not in zf.namelist():
+        return []
+    strings: list[str] = []
+    with zf.open(name) as f:
+        for _, elem in iterparse(f):
+            if elem.tag == _TAG_SI:
+                strings.append(_rich_text(elem))
+                elem.clear()
+    return strings
+
+
+def _resolve_parts(zf: zipfile.ZipFile) -> tuple[str, str | None]:
+    """workbook.xml と関連付けから、アクティブシートと共有文字列の ZIP 内パスを返す。"""
+    names = set(zf.namelist())
+    workbook = "xl/workbook.xml"
+    rels_name = "xl/_rels/workbook.xml.rels"
+    targets: dict[str, str] = {}
+    shared_strings = None
+    if rels_name in names:
+        with zf.open(rels_name) as f:
+            for _, elem in iterparse(f):
+                if elem.tag != _NS_PKG_REL + "Relationship":
+                    continue
+                target = elem.get("Target") or ""
+                path = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("xl", target))
+                targets[elem.get("Id") or ""] = path
+                if (elem.get("Type") or "").endswith("/sharedStrings"):
+                    shared_strings = path
+
+    active_tab = 0
+    sheet_ids: list[str] = []
+    with zf.open(workbook) as f:
+        for _, elem in iterparse(f):
+            if elem.tag == _NS_MAIN + "workbookView":
+                active_tab = int(elem.get("activeTab") or 0)
+            elif elem.tag == _NS_MAIN + "sheet":
+                sheet_ids.append(elem.get(_NS_REL + "id") or "")
+    if not sheet_ids:
+        raise ValueError("ワークシートがありません")
+    if not 0 <= active_tab < len(sheet_ids):
+        active_tab = 0
+    sheet = targets.get(sheet_ids[active_tab]) or "xl/worksheets/sheet1.xml"
+    return sheet, shared_strings
+
+
+def _row_values(row, shared_strings: list[str]) -> list[Any]:
+    """行の全セルを列位置どおりに並べたリストにする（ヘッダー行用）。"""
+    values: list[Any] = []
+    pos = -1
+    for cell in row:
+        ref = cell.get("r")
+        pos = _column_index(ref) if ref else pos + 1
+        if pos >= len(values):
+            values.extend([None] * (pos + 1 - len(values)))
+        values[pos] = _cell_value(cell, shared_strings)
+    return values
+
+
+def _pick(row, columns: Sequence[int], shared_strings: list[str]) -> tuple[Any, ...]:
+    """行から指定列の値だけを取り出す。通常は列位置と子要素の位置が一致するため、まずそこを確認する。"""
+    picked: list[Any] = []
+    for col in columns:
+        value = None
+        if col < len(row):
+            cell = row[col]
+            ref = cell.get("r")
+            if ref is None or _column_index(ref) == col:
+                picked.append(_cell_value(cell, shared_strings))
+                continue
+        # 空セルが省略されている行は先頭から探す
+        pos = -1
+        for cell in row:
+            ref = cell.get("r")
+            pos = _column_index(ref) if ref else pos + 1
+            if pos == col:
+                value = _cell_value(cell, shared_strings)
+                break
+            if pos > col:
+                break
+        picked.append(value)
+    return tuple(picked)
+
+
+def _column_letters(index: int) -> str:
+    """0 始まりの列番号を列記号に変換する。"""
+    letters = ""
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def _fast_cell_value(attrs: bytes, inner: bytes | None, shared_strings: list[str]) -> Any:
+    """正規表現で切り出したセルの値を _cell_value と同じ型で返す。"""
+    if not inner:
+        return None
+    m = _RE_ATTR_T.search(attrs)
+    t = m.group(1) if m else None
+    if t == b"inlineStr":
+        text = b"".join(_RE_T.findall(_RE_RPH.sub(b"", inner))).decode("utf-8")
+        return html.unescape(text) if "&" in text else text
+    m = _RE_V.search(inner)
+    if m is None:
+        return None
+    text = m.group(1).decode("utf-8")
+    if t is None or t == b"n":
+        return _cast_number(text)
+    if t == b"s":
+        return shared_strings[int(text)]
+    if t == b"b":
+        return text == "1"
+    return html.unescape(text) if "&" in text else text
+
+
+def _iter_row_chunks(f, first: bytes) -> Iterator[bytes]:
+    """<sheetData> 内の XML を、行の途中で切れないよう </row> 単位に揃えて返す。"""
+    buf = first
+    while True:
+        end = buf.find(b"</sheetData>")
+        if end >= 0:
+            yield buf[:end]
+            return
+        data = f.read(CHUNK_BYTES)
+        if not data:
+            yield buf
+            return
+        buf += data
+        cut = buf.rfind(b"</row>")
+        if cut >= 0 and buf.find(b"</sheetData>") < 0:
+            cut += len(b"</row>")
+            yield buf[:cut]
+            buf = buf[cut:]
+
+
+def _iter_fast(f, head: bytes, resolve_columns: ColumnResolver, shared_strings: list[str]) -> Iterator[tuple[Any, ...]]:
+    """r 属性付きの標準的なシート XML を正規表現で読む。先頭行のみ全列、以降は必要な列のセルだけを拾う。"""
+    m = _RE_SHEET_DATA.search(head)
+    if m is None or m.group(1):
+        return
+    columns: Sequence[int] | None = None
+    targets: dict[bytes, list[int]] = {}
+    pattern = re.compile(_RE_ROW_START)
+    row: list[Any] | None = None
+
+    for chunk in _iter_row_chunks(f, head[m.end():]):
+        pos = 0
+        if columns is None:
+            first = _RE_FIRST_ROW.search(chunk)
+            if first is None:
+                continue
+            header: list[Any] = []
+            for cm in _RE_ALL_CELLS.finditer(first.group(1) or b""):
+                col = _column_index(cm.group(1).decode())
+                if col >= len(header):
+                    header.extend([None] * (col + 1 - len(header)))
+                header[col] = _fast_cell_value(cm.group(2), cm.group(3), shared_strings)
+            columns, include_first = resolve_columns(header)
+            if include_first:
+                yield tuple(header[c] if c < len(header) else None for c in columns)
+            for i, c in enumerate(columns):
+                targets.setdefault(_column_letters(c).encode(), []).append(i)
+            if targets:
+                cells = _RE_ALL_CELLS.pattern.replace(b"([A-Z]+)", b"(" + b"|".join(targets) + b")", 1)
+                pattern = re.compile(_RE_ROW_START + b"|" + cells, re.S)
+            pos = first.end()
+
+        for cm in pattern.finditer(chunk, pos):
+            letters = cm.group(1) if targets else None
+            if letters is None:
+                # 行の開始。直前の行を確定する
+                if row is not None:
+                    yield tuple(row)
+                row = [None] * len(columns)
+                continue
+            value = _fast_cell_value(cm.group(2), cm.group(3), shared_strings)
+            for i in targets[letters]:
+                row[i] = value
+    if row is not None:
+        yield tuple(row)
+
+
+def _is_fast_path_sheet(head: bytes) -> bool:
+    """先頭部分を見て、高速経路で読める形式（名前空間接頭辞なし・全セル r 属性が先頭）かを判定する。"""
+    if b"<sheetData" not in head:
+        return False
+    cells = head.count(b"<c ") + head.count(b"<c>") + head.count(b"<c/>")
+    return cells == head.count(b'<c r="')
+
+
+def _iter_slow(f, resolve_columns: ColumnResolver, shared_strings: list[str]) -> Iterator[tuple[Any, ...]]:
+    """任意形式のシート XML を iterparse で1行ずつ読む。処理済みの行要素は都度破棄する。"""
+    columns: Sequence[int] | None = None
+    sheet_data = None
+    for event, elem in iterparse(f, events=("start", "end")):
+        if event == "start":
+            if elem.tag == _TAG_SHEET_DATA:
+                sheet_data = elem
+            continue
+        if elem.tag != _TAG_ROW:
+            continue
+        if columns is None:
+            columns, include_first = resolve_columns(_row_values(elem, shared_strings))
+            if include_first:
+                yield _pick(elem, columns, shared_strings)
+        else:
+            yield _pick(elem, columns, shared_strings)
+        elem.clear()
+        if sheet_data is not None:
+            sheet_data.remove(elem)
+
+
+def iter_xlsx_columns(path: data_source.Source, resolve_columns: ColumnResolver) -> Iterator[tuple[Any, ...]]:
+    """
+    XLSX のアクティブシートを1行ずつ読み、必要な列の値だけをタプルで返す。
+    resolve_columns は先頭行（全列の値のリスト）を受け取り、(読み出す列番号, 先頭行もデータか) を返す。
+    列番号は A 列を 0 とする（openpyxl の iter_rows と同じ）。
+    値は openpyxl（data_only=True）と同じく文字列・int・float・bool・None のいずれか。
+    """
+    with zipfile.ZipFile(data_source.seekable(path)) as zf:
+        sheet_name, shared_strings_name = _resolve_parts(zf)
+        shared_strings = _read_shared_strings(zf, shared_strings_name)
+        with zf.open(sheet_name) as f:
+            head = f.read(CHUNK_BYTES)
+            if _is_fast_path_sheet(head):
+                yield from _iter_fast(f, head, resolve_columns, shared_strings)
+                return
+        with zf.open(sheet_name) as f:
+            yield from _iter_slow(f, resolve_columns, shared_strings)
@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+"""
+性能計測用スクリプト群。プロジェクト直下から python -m benchmarks.<モジュール名> で実行する。
+"""
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+ChatWork 送信の負荷試験。
+chatwork-stub/stub_server.py を子プロセスで起動し、合成したアラートを alert_sender.send_to_chatwork で大量に送る。
+ポータルごとのアラート（build_alert_payloads で分割した送信単位）を1回の send_to_chatwork とし、--concurrency 並列で送る。
+スタブ側の遅延・利用制限（429）・障害（5xx）を指定すると、送信間隔制御・再送を含めた次の値を計測できる。
+5xx は投稿済みの可能性があるため既定では再送しない（--retry-ambiguous で再送する）。
+  - 送信（send_to_chatwork 1回）ごとの所要時間の p50 / p95 / p99 と、成功・失敗の件数
+  - スループット（送信できたメッセージ数・アラート数 / 秒）
+  - HTTP リクエスト数・再送数（instrumentation の http_requests / http_retries）
+  - スタブのリクエストログから、ステータス別の件数とサーバー側の応答時間の p50 / p95 / p99
+
+クライアント側の送信間隔制御（chatwork.rate_limit）は既定では無効にして送れるだけ送る。
+ChatWork と同じ制限で試す場合は --client-token-limit 300/300 --client-room-limit 10/10 を指定する。
+
+実行例:
+  python -m benchmarks.bench_chatwork
+  python -m benchmarks.bench_chatwork --alerts 20000 --portals 100 --rooms 3 --concurrency 8 \\
+      --latency lognormal:0.05,0.5 --token-limit 500/5 --fail-rate 0.05 --output bench_chatwork.json
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from app import instrumentation
+from app.alert_sender import CHATWORK_TOKEN_ENV, build_alert_payloads, send_to_chatwork
+from app.chatwork_client import DEFAULT_MESSAGE_ENDPOINT
+
+ROOT = Path(__file__).resolve().parent.parent
+STUB_SERVER = ROOT / "chatwork-stub" / "stub_server.py"
+
+# クライアント側の送信間隔制御を無効にする場合の値（実質無制限）
+UNLIMITED = {"token_requests": 10**9, "token_period_sec": 1, "room_messages": 10**9, "room_period_sec": 1}
+
+
+def _git_revision() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _percentiles(values: list[float]) -> dict[str, float | None]:
+    """p50 / p95 / p99（ミリ秒）。値がなければ None。"""
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(np.asarray(values, dtype=np.float64), [50, 95, 99]).tolist()
+    return {"p50": round(p50, 2), "p95": round(p95, 2), "p99": round(p99, 2)}
+
+
+def _parse_client_limit(spec: str | None, count_key: str, period_key: str) -> dict[str, float]:
+    if not spec:
+        return {count_key: UNLIMITED[count_key], period_key: UNLIMITED[period_key]}
+    count, _, period = spec.partition("/")
+    return {count_key: int(count), period_key: float(period)}
+
+
+def build_deliveries(alerts: int, portals: int) -> list[tuple[str, int, list[str]]]:
+    """アラートをポータルに均等に割り振り、(ポータル名, アラート数, 送信単位) のリストを作る。"""
+    deliveries = []
+    per_portal, extra = divmod(alerts, portals)
+    code = 0
+    for p in range(portals):
+        n = per_portal + (1 if p < extra else 0)
+        if n == 0:
+            continue
+        name = f"portal{p:02d}"
+        records = [
+            {"portal_name": name, "product_code": f"SKU-{code + i:07d}", "current_stock": (code + i) % 10, "min_stock": 10}
+            for i in range(n)
+        ]
+        code += n
+        deliveries.append((name, n, build_alert_payloads(records, {})))
+    return deliveries
+
+
+def start_stub(args: argparse.Namespace, log_path: Path) -> tuple[subprocess.Popen, str]:
+    """スタブサーバーを空いているポートで起動し、(プロセス, 接続先 URL) を返す。"""
+    command = [sys.executable, str(STUB_SERVER), "--port", "0", "--log", str(log_path), "--latency", args.latency]
+    if args.token_limit:
+        command += ["--token-limit", args.token_limit]
+    if args.room_limit:
+        command += ["--room-limit", args.room_limit]
+    if args.fail_rate:
+        command += ["--fail-rate", str(args.fail_rate)]
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, text=True, encoding="utf-8")
+    # 1行目の待ち受けの表示から接続先を読む（起動に失敗した場合は終了して空行になる）
+    line = proc.stdout.readline() if proc.stdout is not None else ""
+    match = re.search(r"http://\S+", line)
+    if match is None:
+        proc.kill()
+        raise RuntimeError(f"スタブサーバーを起動できませんでした: {line.strip() or proc.wait()}")
+    return proc, match.group(0)
+
+
+def stop_stub(proc: subprocess.Popen) -> None:
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def read_stub_log(log_path: Path) -> tuple[dict[str, int], list[float]]:
+    """スタブのリクエストログから (ステータス別の件数, 応答時間のミリ秒) を読む。"""
+    statuses: dict[str, int] = {}
+    latencies: list[float] = []
+    try:
+        with open(log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                key = str(entry["status"])
+                statuses[key] = statuses.get(key, 0) + 1
+                latencies.append(float(entry["latency_ms"]))
+    except OSError:
+        pass
+    return dict(sorted(statuses.items())), latencies
+
+
+def run_load(args: argparse.Namespace, base_url: str) -> dict[str, Any]:
+    """送信を --concurrency 並列で行い、送信ごとの結果と全体の計測値を返す。"""
+    rate_limit = {
+        **_parse_client_limit(args.client_token_limit, "token_requests", "token_period_sec"),
+        **_parse_client_limit(args.client_room_limit, "room_messages", "room_period_sec"),
+    }
+    chatwork_config = {
+        "api_base_url": base_url,
+        "room_id": [str(1000 + i) for i in range(args.rooms)],
+        "message_endpoint": DEFAULT_MESSAGE_ENDPOINT,
+        "rate_limit": rate_limit,
+        "retry": {
+            "max_retries": args.max_retries,
+            "backoff_sec": args.backoff_sec,
+            "max_backoff_sec": args.max_backoff_sec,
+            "retry_ambiguous": args.retry_ambiguous,
+        },
+    }
+    deliveries = build_deliveries(args.alerts, args.portals)
+
+    def send(payloads: list[str]) -> tuple[bool, float, str | None]:
+        started = time.perf_counter()
+        ok, err = send_to_chatwork(chatwork_config, payloads)
+        return ok, (time.perf_counter() - started) * 1000, err
+
+    metrics = instrumentation.RunMetrics("bench_chatwork")
+    started = time.perf_counter()
+    with instrumentation.collecting(metrics), ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [instrumentation.submit_in_context(executor, send, payloads) for _, _, payloads in deliveries]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+
+    ok_deliveries = [d for d, (ok, _, _) in zip(deliveries, results) if ok]
+    messages = sum(len(payloads) for _, _, payloads in ok_deliveries) * args.rooms
+    sent_alerts = sum(n for _, n, _ in ok_deliveries)
+    errors = [err for ok, _, err in results if not ok]
+    counters = metrics.to_dict()["counters"]
+    return {
+        "deliveries": len(deliveries),
+        "failed": len(errors),
+        "messages": messages,
+        "alerts": sent_alerts,
+        "seconds": round(elapsed, 3),
+        "messages_per_sec": round(messages / elapsed, 1) if elapsed > 0 else None,
+        "alerts_per_sec": round(sent_alerts / elapsed, 1) if elapsed > 0 else None,
+        "http_requests": counters.get("http_requests", 0),
+        "http_retries": counters.get("http_retries", 0),
+        "delivery_ms": _percentiles([ms for _, ms, _ in results]),
+        "errors": errors[:5],
+    }
+
+
+def print_report(result: dict[str, Any]) -> None:
+    def ms(p: dict[str, float | None]) -> str:
+        return " / ".join(f"{k} {v:.1f}" if v is not None else f"{k} -" for k, v in p.items()) + " ms"
+
+    print(
+        f"送信 {result['deliveries']} 回（失敗 {result['failed']}）、メッセージ {result['messages']} 通・"
+        f"アラート {result['alerts']} 件を {result['seconds']:.2f} 秒"
+    )
+    print(f"  スループット     {result['messages_per_sec']} 通/秒、{result['alerts_per_sec']} 件/秒")
+    print(f"  HTTP リクエスト  {result['http_requests']}（再送 {result['http_retries']}）")
+    print(f"  送信ごとの時間   {ms(result['delivery_ms'])}")
+    print(f"  スタブの応答時間 {ms(result['stub_ms'])}")
+    print(f"  スタブのステータス {', '.join(f'{k}: {v}' for k, v in result['stub_statuses'].items()) or 'なし'}")
+    for err in result["errors"]:
+        print(f"  失敗: {err[:200]}", file=sys.stderr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ChatWork 送信の負荷試験（ローカルのスタブサーバーに送る）")
+    parser.add_argument("--alerts", type=int, default=5000, help="アラートの総数（既定 5000）")
+    parser.add_argument("--portals", type=int, default=50, help="ポータル数 = send_to_chatwork の回数（既定 50）")
+    parser.add_argument("--rooms", type=int, default=2, help="送信先ルーム数（既定 2）")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時に送るポータル数（既定 4）")
+    parser.add_argument("--latency", default="uniform:0.01,0.05", help="スタブの応答遅延の分布（既定 uniform:0.01,0.05）")
+    parser.add_argument("--token-limit", help="スタブ側のトークンごとの利用制限（回数/秒数）")
+    parser.add_argument("--room-limit", help="スタブ側のルームごとの利用制限（回数/秒数）")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="スタブが 5xx を返す割合（既定 0）")
+    parser.add_argument("--client-token-limit", help="クライアント側の chatwork.rate_limit（トークン。回数/秒数。既定 無制限）")
+    parser.add_argument("--client-room-limit", help="クライアント側の chatwork.rate_limit（ルーム。回数/秒数。既定 無制限）")
+    parser.add_argument("--max-retries", type=int, default=5, help="chatwork.retry.max_retries（既定 5）")
+    parser.add_argument("--backoff-sec", type=float, default=0.05, help="chatwork.retry.backoff_sec（既定 0.05）")
+    parser.add_argument("--max-backoff-sec", type=float, default=2.0, help="chatwork.retry.max_backoff_sec（既定 2）")
+    parser.add_argument("--retry-ambiguous", action="store_true", help="chatwork.retry.retry_ambiguous（5xx も再送する）")
+    parser.add_argument("--seed", type=int, default=0, help="スタブの乱数のシード（既定 0）")
+    parser.add_argument("--output", help="結果を JSON で書き出すパス")
+    args = parser.parse_args()
+    if min(args.alerts, args.portals, args.rooms, args.concurrency) < 1:
+        print("エラー: --alerts / --portals / --rooms / --concurrency は 1 以上で指定してください", file=sys.stderr)
+        sys.exit(1)
+
+    # 送信先はスタブのため、トークンは任意の値でよい
+    os.environ.setdefault(CHATWORK_TOKEN_ENV, "bench-token")
+    with tempfile.TemporaryDirectory() as tmp:
+        log_path = Path(tmp) / "requests.jsonl"
+        try:
+            proc, base_url = start_stub(args, log_path)
+        except (OSError, RuntimeError) as e:
+            print(f"エラー: {e}", file=sys.stderr)
+            sys.exit(1)
+        try:
+            result = run_load(args, base_url)
+        finally:
+            stop_stub(proc)
+        statuses, stub_latencies = read_stub_log(log_path)
+    result["stub_statuses"] = statuses
+    result["stub_ms"] = _percentiles(stub_latencies)
+    print_report(result)
+
+    if args.output:
+        report = {
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "options": {k: v for k, v in vars(args).items() if k != "output"},
+            "result": result,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果を書き出しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
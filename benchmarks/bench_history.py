@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+在庫数履歴（app.stock_history）のベンチマーク。
+ポータル数 × 日数 × 商品数の合成履歴（商品ごとに一定の割合で減少し、ときどき補充される）を作り、次の処理時間を計測する。
+  - append     : 1ポータル・1日分の追加（全ポータル・全日数の平均）
+  - load_year  : 全ポータルの1年分（--days 日分）を行列として読み出す
+  - forecast   : 全ポータルの在庫切れ予測（直近 window_days 日）
+  - series     : 1商品の全期間の推移（全ポータル分）
+全ポータル1年分の読み出しが --budget-sec を超えた場合は終了コード 1 で終わる。
+
+実行例:
+  python -m benchmarks.bench_history
+  python -m benchmarks.bench_history --portals 25 --days 365 --codes 5000 --output bench_history.json
+"""
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from app.compare_engine import ThresholdTable
+from app.stock_history import HistoryOptions, StockHistory, forecast_depletion
+
+# 全ポータル1年分の読み出しの上限（秒）
+DEFAULT_BUDGET_SEC = 1.0
+
+
+def build_history(root: Path, portals: int, days: int, codes: int, seed: int = 0) -> tuple[StockHistory, list[str], date, float]:
+    """合成履歴を作り、(履歴, ポータル名, 最終日, 1日分の追加の平均秒数) を返す。"""
+    rng = np.random.default_rng(seed)
+    history = StockHistory(root)
+    names = [f"portal{i:02d}" for i in range(portals)]
+    product_codes = [f"SKU-{i:07d}" for i in range(codes)]
+    end = date(2025, 12, 31)
+    elapsed = 0.0
+    for name in names:
+        stock = rng.integers(100, 2000, size=codes)
+        decrease = rng.integers(0, 20, size=codes)
+        for offset in range(days - 1, -1, -1):
+            refill = rng.random(codes) < 0.02
+            stock = np.where(refill, stock + rng.integers(500, 1500, size=codes), np.maximum(stock - decrease, 0))
+            started = time.perf_counter()
+            history.append(name, end - timedelta(days=offset), dict(zip(product_codes, stock.tolist())))
+            elapsed += time.perf_counter() - started
+    return history, names, end, elapsed / (portals * days)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="在庫数履歴のベンチマーク")
+    parser.add_argument("--portals", type=int, default=25, help="ポータル数（既定 25）")
+    parser.add_argument("--days", type=int, default=365, help="日数（既定 365）")
+    parser.add_argument("--codes", type=int, default=2000, help="1ポータルあたりの商品数（既定 2000）")
+    parser.add_argument("--budget-sec", type=float, default=DEFAULT_BUDGET_SEC, help=f"全ポータル1年分の読み出しの上限（既定 {DEFAULT_BUDGET_SEC}）")
+    parser.add_argument("--work-dir", help="履歴の置き場所（未指定時は一時ディレクトリ。指定時は残す）")
+    parser.add_argument("--output", help="結果を JSON で書き出すパス")
+    args = parser.parse_args()
+
+    results: dict[str, Any] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(args.work_dir) if args.work_dir else Path(tmp)
+        started = time.perf_counter()
+        history, names, end, append_sec = build_history(root, args.portals, args.days, args.codes)
+        print(f"[{args.portals} ポータル × {args.days} 日 × {args.codes} 商品] 生成 {time.perf_counter() - started:.1f} 秒", flush=True)
+        results["append_sec"] = round(append_sec, 5)
+
+        # 辞書の読み込みを含めて計測するため、新しいインスタンスで読む
+        history = StockHistory(root)
+        started = time.perf_counter()
+        cells = 0
+        for name in names:
+            _, matrix = history.load(name, end - timedelta(days=args.days - 1), end)
+            cells += matrix.size
+        results["load_year_sec"] = round(time.perf_counter() - started, 4)
+
+        options = HistoryOptions()
+        started = time.perf_counter()
+        forecasts = 0
+        for name in names:
+            _, matrix = history.load(name, end, end)
+            codes = history.codes(name)
+            stock_by_code = dict(zip(codes.decode(range(len(codes))), matrix[:, 0].astype(np.int64).tolist()))
+            table = ThresholdTable({code: 100 for code in stock_by_code})
+            forecasts += len(forecast_depletion(history, name, end, stock_by_code, table, options))
+        results["forecast_sec"] = round(time.perf_counter() - started, 4)
+
+        started = time.perf_counter()
+        points = sum(len(history.series(name, "SKU-0000000")) for name in names)
+        results["series_sec"] = round(time.perf_counter() - started, 4)
+
+    print(f"  append（1日分の平均）  {results['append_sec'] * 1000:>9.2f} ms")
+    print(f"  load_year             {results['load_year_sec']:>9.3f} 秒  セル数={cells}")
+    print(f"  forecast              {results['forecast_sec']:>9.3f} 秒  予測={forecasts}")
+    print(f"  series                {results['series_sec']:>9.3f} 秒  点数={points}")
+
+    if args.output:
+        report = {
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "portals": args.portals,
+            "days": args.days,
+            "codes": args.codes,
+            **results,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果を書き出しました: {args.output}")
+
+    if results["load_year_sec"] > args.budget_sec:
+        print(f"エラー: 1年分の読み出しが上限を超えました（{results['load_year_sec']:.3f} 秒 > {args.budget_sec:g} 秒）", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+main.py の起動時間のベンチマーク（run_all_portals.py はポータルごとに main.py を起動するため、その分だけ繰り返しかかる）。
+  - import      : python -X importtime -c "import main" の main の累積時間
+  - empty_run   : 日次在庫数ファイルのないポータルで main.py を実行した時の経過時間
+あわせて、ファイルのないポータルの実行で遅延読み込みにしたモジュール（DEFERRED_MODULES）が読み込まれていないことを確かめる。
+import が --budget-ms を超えるか、遅延読み込みのモジュールが読み込まれていれば終了コード 1 で終わる。
+
+実行例:
+  python -m benchmarks.bench_startup
+  python -m benchmarks.bench_startup --repeat 10 --budget-ms 60 --output bench_startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# import main の累積時間の上限（ミリ秒）
+DEFAULT_BUDGET_MS = 80.0
+
+# 在庫数ファイルのないポータルの実行では読み込まないモジュール
+DEFERRED_MODULES = (
+    "numpy",
+    "jinja2",
+    "requests",
+    "dotenv",
+    "openpyxl",
+    "app.compare_engine",
+    "app.chatwork_client",
+    "app.xlsx_reader",
+    "cProfile",
+    "tracemalloc",
+)
+
+
+def parse_importtime(stderr: str) -> dict[str, int]:
+    """-X importtime の出力を {モジュール名: 累積マイクロ秒} にする（同名は最初の1件）。"""
+    result: dict[str, int] = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3:
+            continue
+        try:
+            cumulative = int(parts[1])
+        except ValueError:
+            continue
+        result.setdefault(parts[2].strip(), cumulative)
+    return result
+
+
+def _run(args: list[str], cwd: Path) -> tuple[float, subprocess.CompletedProcess]:
+    env = dict(os.environ, PYTHONIOENCODING="utf-8")
+    started = time.perf_counter()
+    proc = subprocess.run([sys.executable, *args], cwd=cwd, env=env, capture_output=True, text=True, encoding="utf-8")
+    return time.perf_counter() - started, proc
+
+
+def _git_revision() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def measure(repeat: int, work_dir: Path) -> dict[str, Any]:
+    """import main と、ファイルのないポータルの実行をそれぞれ repeat 回計測して最短値を返す。"""
+    portal_dir = work_dir / "2025-10-10" / "Bench"
+    portal_dir.mkdir(parents=True, exist_ok=True)
+    settings_path = work_dir / "setting.json"
+    settings = {
+        "cache_dir": str(work_dir / "cache"),
+        "portals": {"bench": {"min_stock_base_path": str(work_dir / "thresholds.csv"), "mapping": {}}},
+    }
+    settings_path.write_text(json.dumps(settings), encoding="utf-8")
+
+    import_ms = []
+    for _ in range(repeat):
+        _, proc = _run(["-X", "importtime", "-c", "import main"], ROOT)
+        if proc.returncode != 0:
+            raise RuntimeError(f"import main に失敗しました: {proc.stderr[-2000:]}")
+        import_ms.append(parse_importtime(proc.stderr).get("main", 0) / 1000)
+
+    run_ms = []
+    loaded: set[str] = set()
+    for _ in range(repeat):
+        seconds, proc = _run(["-X", "importtime", str(ROOT / "main.py"), str(portal_dir), str(settings_path)], ROOT)
+        if proc.returncode != 0:
+            raise RuntimeError(f"main.py の実行に失敗しました: {proc.stderr[-2000:]}")
+        run_ms.append(seconds * 1000)
+        loaded |= set(parse_importtime(proc.stderr)) & set(DEFERRED_MODULES)
+
+    return {
+        "import_ms": round(min(import_ms), 2),
+        "empty_run_ms": round(min(run_ms), 2),
+        "deferred_loaded": sorted(loaded),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="main.py の起動時間のベンチマーク")
+    parser.add_argument("--repeat", type=int, default=5, help="繰り返し回数（最短時間を採用）")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS, help=f"import main の上限（既定 {DEFAULT_BUDGET_MS}）")
+    parser.add_argument("--output", help="結果を JSON で書き出すパス")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        result = measure(max(1, args.repeat), Path(tmp))
+
+    print(f"  import main       {result['import_ms']:>9.1f} ms（上限 {args.budget_ms:.0f} ms）")
+    print(f"  empty_run         {result['empty_run_ms']:>9.1f} ms")
+    if args.output:
+        report = {
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "budget_ms": args.budget_ms,
+            **result,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果を書き出しました: {args.output}")
+
+    failed = False
+    if result["import_ms"] > args.budget_ms:
+        print(f"エラー: import main が上限を超えました（{result['import_ms']:.1f} ms > {args.budget_ms:.0f} ms）", file=sys.stderr)
+        failed = True
+    if result["deferred_loaded"]:
+        print(f"エラー: 起動時に読み込まれています: {', '.join(result['deferred_loaded'])}", file=sys.stderr)
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+全ポータル形式のベンチマーク。
+setting.json の mapping に合わせた合成データ（benchmarks.synthetic）を行数ごとに生成し、次の処理時間を計測する。
+  - parse      : parse_portal_stock（キャッシュなし）
+  - parse_cached: parse_portal_stock（パース結果キャッシュが効いた状態）
+  - parse_parallel: parse_portal_stock（ファイルを分割してプロセス並列でパース。csv / tsv_cp932 / headerless のみ）
+  - parse_gzip : parse_portal_stock（同じデータのファイルを .gz に圧縮した場合。展開しながら読む）
+  - parse_broken: parse_portal_stock（途中で読み込みに失敗する同じ内容のファイルを加えた場合。キャッシュあり）
+                 壊れたファイルが合算・キャッシュされないことも確かめる
+  - thresholds : load_thresholds（インデックスなし）
+  - thresholds_indexed: load_thresholds（サイドカーインデックスが効いた状態）
+  - parse_pushdown: parse_portal_stock（最低在庫数を定義した商品コードの行だけを集計）
+  - parse_pushdown_sparse: 同上（定義が商品コードの 1/SPARSE_STEP だけの場合）
+  - parse_pushdown_cache_miss: 同上（パース結果キャッシュあり・未キャッシュ。キャッシュする結果は絞り込まずにパースする）
+  - parse_pushdown_cached: 同上（parse_pushdown_cache_miss の後に定義を parse_pushdown_sparse のものに変えた場合。キャッシュから読んで絞り込む）
+  - compare    : 在庫数と最低在庫数の比較（compare_stock）
+  - compare_rules: 同上（最低在庫数定義をコード100件ごとの前方一致の規則 + 既定の * にし、SPARSE_STEP 件に1件だけ完全一致を残した場合）
+  - message    : build_alert_payloads（全アラート分を送信単位に分割）
+結果は JSON で書き出し、別の実行結果と比べられるようにする。
+
+実行例:
+  python -m benchmarks.bench_suite --sizes 10000,100000 --output bench_suite.json
+  python -m benchmarks.bench_suite --sizes 1000000 --formats csv,choice --repeat 1
+  python -m benchmarks.bench_suite --sizes 3000000 --formats csv --parse-workers 8
+"""
+import argparse
+import csv
+import gzip
+import json
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable
+
+from benchmarks.synthetic import FORMATS, generate_stock_dir, generate_thresholds, mapping_columns
+
+from app.alert_sender import build_alert_payloads
+from app.compare_engine import ThresholdTable, alert_records, compare_stock
+from app.csv_chunks import ParallelOptions
+from app.parse_cache import ParseCache
+from app.stock_parser import parse_portal_stock
+from app.threshold_loader import load_thresholds
+
+DEFAULT_SIZES = "10000,100000"
+DEFAULT_PARSE_WORKERS = 4
+
+# parse_pushdown_sparse で最低在庫数を定義したコードから間引く間隔
+SPARSE_STEP = 100
+
+# 分割パースの対象になる形式（テキストのファイル1つずつ読むもの）
+_CHUNKABLE_FORMATS = ("csv", "tsv_cp932", "headerless")
+
+# parse_broken で読み込みに失敗するファイルの名前の先頭
+_BROKEN_PREFIX = "broken_"
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# setting.json にヘッダーなしのポータルがない場合に使う設定
+_HEADERLESS_FALLBACK = {"has_header": False, "mapping": {"product_code_column_index": 1, "stock_column_index": 3}}
+
+
+def select_cases(settings: dict[str, Any], formats: list[str]) -> list[tuple[str, str, dict[str, Any]]]:
+    """形式ごとに、setting.json から対応するポータル設定を選ぶ。戻り値は (形式, ポータル名, 設定) のリスト。"""
+    portals = {name.lower(): cfg or {} for name, cfg in (settings.get("portals") or {}).items()}
+    headered = [
+        name for name, cfg in portals.items()
+        if not cfg.get("tsv_join_mode")
+        and (cfg.get("mapping") or {}).get("has_header", cfg.get("has_header", True))
+        and all(mapping_columns(cfg))
+        and (cfg.get("mapping") or {}).get("stock_column")
+    ]
+    headerless = [
+        name for name, cfg in portals.items()
+        if not (cfg.get("mapping") or {}).get("has_header", cfg.get("has_header", True))
+    ]
+    choice = [name for name, cfg in portals.items() if cfg.get("tsv_join_mode")]
+
+    def headered_portal(i: int) -> str:
+        preferred = ["amazon"] + [n for n in headered if n != "amazon"]
+        candidates = [n for n in preferred if n in portals and n in headered] or ["amazon"]
+        return candidates[min(i, len(candidates) - 1)]
+
+    cases = []
+    for fmt in formats:
+        if fmt == "csv":
+            name = headered_portal(0)
+        elif fmt == "tsv_cp932":
+            name = headered_portal(1)
+        elif fmt == "xlsx":
+            name = headered_portal(2)
+        elif fmt == "headerless":
+            name = headerless[0] if headerless else "headerless"
+        else:
+            name = choice[0] if choice else "choice"
+        cfg = portals.get(name)
+        if fmt == "headerless" and not headerless:
+            cfg = _HEADERLESS_FALLBACK
+        elif fmt == "choice" and not choice:
+            cfg = {"tsv_join_mode": True}
+        cases.append((fmt, name, cfg or {}))
+    return cases
+
+
+def _time(func: Callable[[], Any], repeat: int) -> tuple[float, Any]:
+    """repeat 回実行して最短時間と最後の戻り値を返す。"""
+    best = float("inf")
+    value = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        value = func()
+        best = min(best, time.perf_counter() - started)
+    return best, value
+
+
+def _git_revision() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_case(
+    work_dir: Path,
+    fmt: str,
+    portal_name: str,
+    portal_config: dict[str, Any],
+    rows: int,
+    repeat: int,
+    parse_workers: int = DEFAULT_PARSE_WORKERS,
+) -> list[dict[str, Any]]:
+    """1形式・1行数分のデータを生成して各処理を計測する。"""
+    stock_dir = work_dir / f"{fmt}_{rows}" / portal_name
+    started = time.perf_counter()
+    generate_stock_dir(stock_dir, fmt, portal_config, rows)
+    threshold_path = generate_thresholds(work_dir / f"{fmt}_{rows}_thresholds.csv", rows)
+    print(f"[{fmt} / {portal_name} / {rows} 行] 生成 {time.perf_counter() - started:.1f} 秒", flush=True)
+
+    results = []
+
+    def record(stage: str, seconds: float, items: int) -> None:
+        results.append({
+            "format": fmt,
+            "portal": portal_name,
+            "rows": rows,
+            "stage": stage,
+            "seconds": round(seconds, 4),
+            "items": items,
+        })
+        print(f"  {stage:<26} {seconds:>9.3f} 秒  n={items}", flush=True)
+
+    seconds, stock_by_code = _time(lambda: parse_portal_stock(stock_dir, portal_config), repeat)
+    record("parse", seconds, len(stock_by_code))
+
+    cache = ParseCache(work_dir / f"{fmt}_{rows}_parse_cache.sqlite3")
+    try:
+        parse_portal_stock(stock_dir, portal_config, None, cache)
+        seconds, cached = _time(lambda: parse_portal_stock(stock_dir, portal_config, None, cache), repeat)
+    finally:
+        cache.close()
+    if cached != stock_by_code:
+        raise RuntimeError(f"{fmt}: キャッシュ経由の結果が一致しません")
+    record("parse_cached", seconds, len(cached))
+
+    if fmt in _CHUNKABLE_FORMATS and parse_workers > 1:
+        parallel = ParallelOptions(min_bytes=0, workers=parse_workers)
+        seconds, chunked = _time(lambda: parse_portal_stock(stock_dir, portal_config, None, None, None, parallel), repeat)
+        if chunked != stock_by_code or list(chunked) != list(stock_by_code):
+            raise RuntimeError(f"{fmt}: 分割パースの結果が一致しません")
+        record("parse_parallel", seconds, len(chunked))
+
+    gzip_dir = work_dir / f"{fmt}_{rows}_gzip" / portal_name
+    _gzip_dir(stock_dir, gzip_dir)
+    seconds, unzipped = _time(lambda: parse_portal_stock(gzip_dir, portal_config), repeat)
+    if unzipped != stock_by_code:
+        raise RuntimeError(f"{fmt}: 圧縮ファイルのパース結果が一致しません")
+    record("parse_gzip", seconds, len(unzipped))
+
+    broken_dir = work_dir / f"{fmt}_{rows}_broken" / portal_name
+    _broken_dir(stock_dir, broken_dir)
+    cache_path = work_dir / f"{fmt}_{rows}_broken_cache.sqlite3"
+    cache = ParseCache(cache_path)
+    try:
+        seconds, broken = _time(lambda: parse_portal_stock(broken_dir, portal_config, None, cache), repeat)
+    finally:
+        cache.close()
+    if broken != stock_by_code:
+        raise RuntimeError(f"{fmt}: 読み込みに失敗したファイルが合算されています")
+    with sqlite3.connect(str(cache_path)) as conn:
+        sources = [row[0] for row in conn.execute("SELECT source FROM parsed_files")]
+    if any(_BROKEN_PREFIX in source for source in sources):
+        raise RuntimeError(f"{fmt}: 読み込みに失敗したファイルがキャッシュされています")
+    record("parse_broken", seconds, len(broken))
+
+    seconds, thresholds = _time(lambda: load_thresholds(str(threshold_path), portal_config), repeat)
+    record("thresholds", seconds, len(thresholds))
+
+    index_dir = work_dir / f"{fmt}_{rows}_index"
+    load_thresholds(str(threshold_path), portal_config, None, index_dir)
+    seconds, _ = _time(lambda: load_thresholds(str(threshold_path), portal_config, None, index_dir), repeat)
+    record("thresholds_indexed", seconds, len(thresholds))
+
+    all_keys = ThresholdTable(thresholds).defined_codes()
+    sparse_keys = frozenset(sorted(all_keys)[::SPARSE_STEP])
+    for stage, keys in (("parse_pushdown", all_keys), ("parse_pushdown_sparse", sparse_keys)):
+        seconds, pushed = _time(lambda: parse_portal_stock(stock_dir, portal_config, load_keys=lambda: keys), repeat)
+        if pushed != {code: stock for code, stock in stock_by_code.items() if code in keys}:
+            raise RuntimeError(f"{fmt}: 絞り込んだパースの結果が一致しません")
+        record(stage, seconds, len(pushed))
+
+    # キャッシュには絞り込む前の結果を保存するため、定義の商品が変わってもパースし直さない
+    cache = ParseCache(work_dir / f"{fmt}_{rows}_pushdown_cache.sqlite3")
+    try:
+        seconds, pushed = _time(
+            lambda: parse_portal_stock(stock_dir, portal_config, None, cache, load_keys=lambda: all_keys), 1
+        )
+        record("parse_pushdown_cache_miss", seconds, len(pushed))
+        seconds, pushed = _time(
+            lambda: parse_portal_stock(stock_dir, portal_config, None, cache, load_keys=lambda: sparse_keys), repeat
+        )
+    finally:
+        cache.close()
+    if pushed != {code: stock for code, stock in stock_by_code.items() if code in sparse_keys}:
+        raise RuntimeError(f"{fmt}: キャッシュ経由で絞り込んだ結果が一致しません")
+    record("parse_pushdown_cached", seconds, len(pushed))
+
+    seconds, (alerts, codes) = _time(lambda: compare_stock(stock_by_code, thresholds), repeat)
+    record("compare", seconds, len(alerts))
+
+    # 前方一致の規則: pattern:SKU-00001* のようにコードの末尾2桁を * にしたもの（コード100件分）
+    block_mins = {code[:-2]: min_stock for code, min_stock in thresholds.items()}
+    exact = dict(list(thresholds.items())[::SPARSE_STEP])
+    rules = {"pattern:*": 0, **{f"pattern:{block}*": min_stock for block, min_stock in block_mins.items()}, **exact}
+    seconds, (rule_alerts, rule_codes) = _time(lambda: compare_stock(stock_by_code, ThresholdTable(rules)), repeat)
+    expected = [
+        code for code, stock in stock_by_code.items()
+        if stock <= exact.get(code, block_mins.get(code[:-2], 0))
+    ]
+    if rule_codes.decode(rule_alerts["code_id"]) != expected:
+        raise RuntimeError(f"{fmt}: 規則による比較の結果が一致しません")
+    record("compare_rules", seconds, len(rule_alerts))
+
+    records = alert_records(alerts, codes, portal_name)
+    seconds, payloads = _time(lambda: build_alert_payloads(records, {}), repeat)
+    record("message", seconds, sum(len(p) for p in payloads))
+    return results
+
+
+def _gzip_dir(src: Path, dst: Path) -> None:
+    """src 直下のファイルをそれぞれ .gz に圧縮して dst に置く。"""
+    dst.mkdir(parents=True, exist_ok=True)
+    for path in sorted(src.iterdir()):
+        with open(path, "rb") as f, gzip.open(dst / f"{path.name}.gz", "wb", compresslevel=6) as out:
+            out.write(f.read())
+
+
+def _broken_dir(src: Path, dst: Path) -> None:
+    """
+    src 直下のファイルを dst にコピーし、それぞれ途中で読み込みに失敗するコピー（名前の先頭に _BROKEN_PREFIX）も置く。
+    テキストは最後にフィールドサイズの上限を超える行を足し（それまでの行は正常に読める）、XLSX は後半を切り捨てる。
+    """
+    dst.mkdir(parents=True, exist_ok=True)
+    for path in sorted(src.iterdir()):
+        shutil.copyfile(path, dst / path.name)
+        data = path.read_bytes()
+        if path.suffix.lower() == ".xlsx":
+            data = data[: len(data) // 2]
+        else:
+            data += b"x" * (csv.field_size_limit() + 1) + b"\n"
+        (dst / f"{_BROKEN_PREFIX}{path.name}").write_bytes(data)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="全ポータル形式の合成データベンチマーク")
+    parser.add_argument("--settings", default=str(ROOT / "setting.json"), help="mapping を読む setting.json")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"行数（カンマ区切り、既定 {DEFAULT_SIZES}）")
+    parser.add_argument("--formats", default=",".join(FORMATS), help=f"形式（カンマ区切り、既定 {','.join(FORMATS)}）")
+    parser.add_argument("--repeat", type=int, default=3, help="各処理の繰り返し回数（最短時間を採用）")
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        default=DEFAULT_PARSE_WORKERS,
+        help=f"parse_parallel のプロセス数（既定 {DEFAULT_PARSE_WORKERS}。1 以下で計測しない）",
+    )
+    parser.add_argument("--work-dir", help="生成データの置き場所（未指定時は一時ディレクトリ。指定時は残す）")
+    parser.add_argument("--output", help="結果を JSON で書き出すパス")
+    args = parser.parse_args()
+
+    formats = [f.strip() for f in args.formats.split(",") if f.strip()]
+    unknown = [f for f in formats if f not in FORMATS]
+    if unknown:
+        print(f"エラー: 未対応の形式です: {', '.join(unknown)}", file=sys.stderr)
+        sys.exit(1)
+    try:
+        sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    except ValueError:
+        print(f"エラー: --sizes は整数のカンマ区切りで指定してください: {args.sizes}", file=sys.stderr)
+        sys.exit(1)
+
+    with open(args.settings, "r", encoding="utf-8") as f:
+        settings = json.load(f)
+    cases = select_cases(settings, formats)
+
+    report: dict[str, Any] = {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "git_revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "parse_workers": args.parse_workers,
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = Path(args.work_dir) if args.work_dir else Path(tmp)
+        for rows in sizes:
+            for fmt, portal_name, portal_config in cases:
+                results = run_case(work_dir, fmt, portal_name, portal_config, rows, args.repeat, args.parse_workers)
+                report["results"].extend(results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果を書き出しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+XLSX 読み込みの比較ベンチマーク。
+従来の openpyxl 経路（iter_rows で全セルを読み込んでから2列を取り出す）と、
+app.xlsx_reader による2列だけのストリーミング読み込みを、同じブックで計測する。
+
+実行例:
+  python -m benchmarks.bench_xlsx_reader --rows 200000 --cols 20
+  python -m benchmarks.bench_xlsx_reader --memory --output bench_xlsx.json
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from benchmarks.xlsx_writer import write_xlsx
+
+from app.stock_parser import _read_xlsx_rows
+
+PRODUCT_COLUMN = "商品コード"
+STOCK_COLUMN = "在庫数"
+
+
+def _generate(path: Path, rows: int, cols: int) -> None:
+    def gen():
+        yield [PRODUCT_COLUMN, STOCK_COLUMN] + [f"列{i}" for i in range(cols - 2)]
+        for i in range(rows):
+            extra = [f"テキスト{i % 1000}" if j % 2 else i * j for j in range(cols - 2)]
+            yield [f"SKU-{i % 50000:06d}", i % 13] + extra
+
+    write_xlsx(path, gen())
+
+
+def _read_openpyxl(path: Path) -> int:
+    """ベースライン: 従来実装と同じく全行を list 化してから2列を取り出す。"""
+    from openpyxl import load_workbook
+
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = list(wb.active.iter_rows(values_only=True))
+        header = [str(c).strip() if c is not None else "" for c in rows[0]]
+        code_idx, stock_idx = header.index(PRODUCT_COLUMN), header.index(STOCK_COLUMN)
+        total = 0
+        for row in rows[1:]:
+            if row[code_idx] is not None:
+                total += int(row[stock_idx] or 0)
+        return total
+    finally:
+        wb.close()
+
+
+def _read_streaming(path: Path) -> int:
+    return sum(stock for _, stock in _read_xlsx_rows(path, True, PRODUCT_COLUMN, STOCK_COLUMN))
+
+
+def _measure(func, path: Path, memory: bool) -> dict:
+    if memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    total = func(path)
+    elapsed = time.perf_counter() - started
+    result = {"seconds": round(elapsed, 3), "checksum": total}
+    if memory:
+        result["peak_mib"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+        tracemalloc.stop()
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="XLSX 読み込みベンチマーク（openpyxl vs ストリーミング）")
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--cols", type=int, default=20)
+    parser.add_argument("--path", help="既存のブックを使う場合のパス（未指定時は一時ファイルを生成）")
+    parser.add_argument("--memory", action="store_true", help="tracemalloc でピークメモリも計測する（時間は長くなる）")
+    parser.add_argument("--skip-openpyxl", action="store_true", help="ベースラインの計測を省略する")
+    parser.add_argument("--output", help="結果を JSON で書き出すパス")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(args.path) if args.path else Path(tmp) / "bench.xlsx"
+        if not args.path:
+            started = time.perf_counter()
+            _generate(path, args.rows, args.cols)
+            print(f"生成: {args.rows} 行 x {args.cols} 列 ({time.perf_counter() - started:.1f} 秒)", flush=True)
+
+        results: dict = {"rows": args.rows, "cols": args.cols, "file_bytes": path.stat().st_size}
+        results["streaming"] = _measure(_read_streaming, path, args.memory)
+        print(f"streaming: {results['streaming']}", flush=True)
+        if not args.skip_openpyxl:
+            results["openpyxl"] = _measure(_read_openpyxl, path, args.memory)
+            print(f"openpyxl : {results['openpyxl']}", flush=True)
+            if results["openpyxl"]["checksum"] != results["streaming"]["checksum"]:
+                print("エラー: 読み込み結果が一致しません。", file=sys.stderr)
+                sys.exit(1)
+            speedup = results["openpyxl"]["seconds"] / max(results["streaming"]["seconds"], 1e-9)
+            results["speedup"] = round(speedup, 1)
+            print(f"高速化倍率: {speedup:.1f}x")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
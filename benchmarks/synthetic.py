@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+ベンチマーク用の合成データ生成。
+setting.json のポータル設定（mapping）に合わせて、本番と同じ形の日次在庫数ファイルと最低在庫数定義 CSV を作る。
+
+形式:
+  - csv        : Amazon 形式。UTF-8 BOM 付き・カンマ区切り・ヘッダーあり。在庫数は "1,500" のような桁区切りを含む
+  - tsv_cp932  : CP932・タブ区切り・ヘッダーあり
+  - headerless : ヘッダーなし・列番号指定（product_code_column_index / stock_column_index）
+  - choice     : Choice 形式。103 列の明細 TSV と _change_stock TSV の組（第一カラムでジョイン）
+  - xlsx       : ヘッダーありの XLSX
+"""
+import csv
+import random
+from pathlib import Path
+from typing import Any, Iterator
+
+from benchmarks.xlsx_writer import write_xlsx
+
+from app.stock_parser import CHOICE_CHANGE_STOCK_COL_DEFAULT, CHOICE_DETAILS_PRODUCT_CODE_COL_DEFAULT
+
+FORMATS = ("csv", "tsv_cp932", "headerless", "choice", "xlsx")
+
+# 明細 TSV の列数（Choice の stg_product_details と同じ）
+CHOICE_DETAILS_COLUMNS = 103
+
+# 同じ商品コードが複数行に現れるよう、コードの種類は行数のこの割合にする
+UNIQUE_CODE_RATIO = 0.5
+
+# 最低在庫数を定義するコードの割合
+THRESHOLD_COVERAGE = 0.8
+
+_NAMES = ("りんご", "みかん", "牛肉セット", "米 10kg", "海産物詰め合わせ", "ハンドタオル", "地ビール", "干し芋")
+
+
+def product_codes(rows: int) -> list[str]:
+    """行数に応じた商品コードの一覧（重複なし）。"""
+    return [f"SKU-{i:07d}" for i in range(max(1, int(rows * UNIQUE_CODE_RATIO)))]
+
+
+def _stock_rows(rows: int, seed: int) -> Iterator[tuple[str, int, str]]:
+    """(商品コード, 在庫数, 商品名) を rows 行返す。"""
+    rng = random.Random(seed)
+    codes = product_codes(rows)
+    for i in range(rows):
+        yield codes[rng.randrange(len(codes))], rng.randrange(0, 2000), _NAMES[i % len(_NAMES)]
+
+
+def mapping_columns(portal_config: dict[str, Any]) -> tuple[str, str]:
+    """ヘッダーありのポータル設定から (商品コード列名, 在庫数列名) を返す。"""
+    mapping = portal_config.get("mapping") or {}
+    return mapping.get("product_code_column") or "商品コード", mapping.get("stock_column") or "在庫数"
+
+
+def _write_csv(path: Path, portal_config: dict[str, Any], rows: int, seed: int) -> None:
+    product_column, stock_column = mapping_columns(portal_config)
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["商品名", product_column, "ASIN", stock_column, "価格", "出品日", "コンディション", "備考"])
+        for i, (code, stock, name) in enumerate(_stock_rows(rows, seed)):
+            writer.writerow([name, code, f"B0{i:08d}", f"{stock:,}", 10000 + i % 5000, "2025/10/10", "新品", ""])
+
+
+def _write_tsv_cp932(path: Path, portal_config: dict[str, Any], rows: int, seed: int) -> None:
+    product_column, stock_column = mapping_columns(portal_config)
+    with open(path, "w", encoding="cp932", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(["返礼品名", product_column, "寄附金額", stock_column, "受付状態"])
+        for code, stock, name in _stock_rows(rows, seed):
+            writer.writerow([name, code, 10000, stock, "受付中"])
+
+
+def _write_headerless(path: Path, portal_config: dict[str, Any], rows: int, seed: int) -> None:
+    mapping = portal_config.get("mapping") or {}
+    code_idx = int(mapping.get("product_code_column_index", 0))
+    stock_idx = int(mapping.get("stock_column_index", 1))
+    width = max(code_idx, stock_idx) + 3
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        for code, stock, name in _stock_rows(rows, seed):
+            row = [name] * width
+            row[code_idx] = code
+            row[stock_idx] = stock
+            writer.writerow(row)
+
+
+def _write_choice(out_dir: Path, portal_config: dict[str, Any], rows: int, seed: int) -> None:
+    mapping = portal_config.get("mapping") or {}
+    details_col = int(mapping.get("details_product_code_column_index", CHOICE_DETAILS_PRODUCT_CODE_COL_DEFAULT))
+    stock_col = int(mapping.get("change_stock_column_index", CHOICE_CHANGE_STOCK_COL_DEFAULT))
+    stock_rows = list(_stock_rows(rows, seed))
+    with open(out_dir / "stg_product_details.tsv", "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        for key, (code, _, name) in enumerate(stock_rows, start=100000):
+            row = [""] * max(CHOICE_DETAILS_COLUMNS, details_col + 1)
+            row[0] = key
+            row[1] = name
+            row[2] = 10000
+            row[details_col] = code
+            writer.writerow(row)
+    with open(out_dir / "stg_product_details_change_stock.tsv", "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        for key, (_, stock, _) in enumerate(stock_rows, start=100000):
+            row = [""] * max(4, stock_col + 1)
+            row[0] = key
+            row[1] = "2025-10-10 00:00:00"
+            row[stock_col] = stock
+            writer.writerow(row)
+
+
+def _write_xlsx(path: Path, portal_config: dict[str, Any], rows: int, seed: int) -> None:
+    product_column, stock_column = mapping_columns(portal_config)
+
+    def gen():
+        yield ["返礼品名", product_column, "寄附金額", stock_column, "受付状態"]
+        for code, stock, name in _stock_rows(rows, seed):
+            yield [name, code, 10000, stock, "受付中"]
+
+    write_xlsx(path, gen())
+
+
+def generate_stock_dir(out_dir: Path, fmt: str, portal_config: dict[str, Any], rows: int, seed: int = 0) -> Path:
+    """out_dir に指定形式の日次在庫数ファイルを rows 行分作り、out_dir を返す。"""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if fmt == "csv":
+        _write_csv(out_dir / "stock_report.csv", portal_config, rows, seed)
+    elif fmt == "tsv_cp932":
+        _write_tsv_cp932(out_dir / "stock_report.tsv", portal_config, rows, seed)
+    elif fmt == "headerless":
+        _write_headerless(out_dir / "stock_report.txt", portal_config, rows, seed)
+    elif fmt == "choice":
+        _write_choice(out_dir, portal_config, rows, seed)
+    elif fmt == "xlsx":
+        _write_xlsx(out_dir / "stock_report.xlsx", portal_config, rows, seed)
+    else:
+        raise ValueError(f"未対応の形式です: {fmt}")
+    return out_dir
+
+
+def generate_thresholds(path: Path, rows: int, seed: int = 0) -> Path:
+    """最低在庫数定義 CSV（返礼品コード, 最低在庫数）を作る。コードの THRESHOLD_COVERAGE 割に定義する。"""
+    rng = random.Random(seed + 1)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["返礼品コード", "最低在庫数"])
+        for code in product_codes(rows):
+            if rng.random() < THRESHOLD_COVERAGE:
+                writer.writerow([code, rng.randrange(0, 1500)])
+    return path
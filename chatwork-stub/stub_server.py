@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+ChatWork API（POST /v2/rooms/{room_id}/messages）のローカルスタブサーバー。Docker なしで標準ライブラリだけで動く。
+stub.sh（常に 200 を返す）と違い、同時接続・遅延・利用制限（429）・障害（5xx）を再現できるため、
+app.chatwork_client の送信間隔制御・再送の確認や負荷試験（benchmarks.bench_chatwork）に使う。
+
+  - 遅延: --latency で応答までの待ち時間の分布を指定する
+      fixed:0.2 / uniform:0.05,0.3 / normal:0.2,0.05 / lognormal:0.15,0.5（中央値, σ）/ exp:0.2（平均）
+  - 利用制限: --token-limit（API トークンごと）・--room-limit（ルームごと）に「回数/秒数」を指定すると、
+    その時間枠で回数を超えたリクエストに 429 を返す。応答には ChatWork と同じ
+    x-ratelimit-limit / x-ratelimit-remaining / x-ratelimit-reset（UNIX 時刻）ヘッダーを付ける
+  - 障害: --fail-rate の割合で --fail-status のいずれかのステータスを返す
+  - リクエストログ: --log のパスに1リクエスト1行の JSON Lines で追記する（--log-body で本文も）
+X-ChatWorkToken ヘッダーのないリクエストには 401 を返す。終了時（Ctrl+C / SIGTERM）にステータス別の件数を表示する。
+
+実行例:
+  python chatwork-stub/stub_server.py --port 8080
+  python chatwork-stub/stub_server.py --port 8080 --latency lognormal:0.15,0.5 --token-limit 300/300 --room-limit 10/10 \\
+      --fail-rate 0.02 --log requests.jsonl
+setting.json の chatwork.api_base_url を http://127.0.0.1:8080 にすると送信先になる。
+"""
+import argparse
+import json
+import math
+import random
+import re
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable
+from urllib.parse import parse_qs
+
+MESSAGE_PATH = re.compile(r"^/v2/rooms/(\d+)/messages/?$")
+
+DEFAULT_FAIL_STATUSES = "500,502,503"
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """--latency の指定から、乱数生成器を受け取って待ち時間（秒）を返す関数を作る。"""
+    kind, _, args = spec.partition(":")
+    if not args:
+        kind, args = "fixed", spec
+    try:
+        values = [float(v) for v in args.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"遅延の指定が不正です: {spec}") from None
+    shapes: dict[str, tuple[int, Callable[[random.Random], float]]] = {
+        "fixed": (1, lambda rng: values[0]),
+        "uniform": (2, lambda rng: rng.uniform(values[0], values[1])),
+        "normal": (2, lambda rng: rng.gauss(values[0], values[1])),
+        "lognormal": (2, lambda rng: values[0] * math.exp(rng.gauss(0.0, values[1]))),
+        "exp": (1, lambda rng: rng.expovariate(1.0 / values[0]) if values[0] > 0 else 0.0),
+    }
+    if kind not in shapes or len(values) != shapes[kind][0]:
+        raise argparse.ArgumentTypeError(
+            f"遅延の指定が不正です: {spec}（fixed:秒 / uniform:最小,最大 / normal:平均,標準偏差 / lognormal:中央値,σ / exp:平均）"
+        )
+    sample = shapes[kind][1]
+    return lambda rng: max(0.0, sample(rng))
+
+
+def parse_limit(spec: str) -> tuple[int, float]:
+    """--token-limit / --room-limit の「回数/秒数」を (回数, 秒数) にする。"""
+    count, _, period = spec.partition("/")
+    try:
+        limit = (int(count), float(period))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"利用制限の指定が不正です: {spec}（例: 300/300）") from None
+    if limit[0] < 1 or limit[1] <= 0:
+        raise argparse.ArgumentTypeError(f"利用制限の指定が不正です: {spec}（回数は 1 以上、秒数は正の数）")
+    return limit
+
+
+def parse_statuses(spec: str) -> list[int]:
+    try:
+        statuses = [int(s) for s in spec.split(",") if s.strip()]
+    except ValueError:
+        statuses = []
+    if not statuses or not all(500 <= s <= 599 for s in statuses):
+        raise argparse.ArgumentTypeError(f"障害のステータスは 5xx のカンマ区切りで指定してください: {spec}")
+    return statuses
+
+
+class FixedWindowLimiter:
+    """キーごとに period 秒の時間枠で limit 回まで許可する（ChatWork と同じく枠の終わりでリセット）。"""
+
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        self._windows: dict[str, tuple[float, int]] = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key: str, now: float) -> tuple[bool, int, float]:
+        """1回分を数える。戻り値: (許可したか, 残り回数, リセット時刻)"""
+        with self._lock:
+            start, used = self._windows.get(key, (now, 0))
+            if now >= start + self.period:
+                start, used = now, 0
+            allowed = used < self.limit
+            if allowed:
+                used += 1
+            self._windows[key] = (start, used)
+            return allowed, self.limit - used, start + self.period
+
+
+class StubState:
+    """サーバー全体の設定・利用制限・リクエストログ。ハンドラーのスレッドから共有する。"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.latency = args.latency
+        self.token_limiter = FixedWindowLimiter(*args.token_limit) if args.token_limit else None
+        self.room_limiter = FixedWindowLimiter(*args.room_limit) if args.room_limit else None
+        self.fail_rate = args.fail_rate
+        self.fail_statuses = args.fail_status
+        self.log_body = args.log_body
+        self.statuses: Counter[int] = Counter()
+        self._rng = random.Random(args.seed)
+        self._rng_lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self._log = open(args.log, "a", encoding="utf-8") if args.log else None
+        self._message_id = 0
+
+    def draw(self) -> tuple[float, float]:
+        """(遅延の秒数, 障害判定用の乱数) を引く。"""
+        with self._rng_lock:
+            return self.latency(self._rng), self._rng.random()
+
+    def fail_status(self) -> int:
+        with self._rng_lock:
+            return self._rng.choice(self.fail_statuses)
+
+    def next_message_id(self) -> str:
+        with self._rng_lock:
+            self._message_id += 1
+            return str(self._message_id)
+
+    def record(self, entry: dict[str, Any]) -> None:
+        with self._log_lock:
+            self.statuses[entry["status"]] += 1
+            if self._log is not None:
+                self._log.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                self._log.flush()
+
+    def close(self) -> None:
+        if self._log is not None:
+            self._log.close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-Alive で接続を使い回せるようにする（requests.Session と同じ条件で試すため）
+    protocol_version = "HTTP/1.1"
+    server_version = "ChatworkStub/1.0"
+    state: StubState
+
+    def do_POST(self) -> None:
+        received = time.time()
+        started = time.perf_counter()
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        token = self.headers.get("X-ChatWorkToken") or ""
+        match = MESSAGE_PATH.match(self.path)
+        room_id = match.group(1) if match else None
+        message = parse_qs(body.decode("utf-8", errors="replace")).get("body", [""])[0]
+
+        headers: dict[str, str] = {}
+        latency, roll = self.state.draw()
+        if match is None:
+            status, payload = 404, {"errors": ["Not Found"]}
+        elif not token:
+            status, payload = 401, {"errors": ["Invalid API token"]}
+        elif not message:
+            status, payload = 400, {"errors": ["Parameter [body] is required"]}
+        else:
+            status, payload = self._limit(token, room_id, received, headers)
+            if status == 200 and roll < self.state.fail_rate:
+                status, payload = self.state.fail_status(), {"errors": ["injected fault"]}
+            elif status == 200:
+                payload = {"message_id": self.state.next_message_id()}
+
+        time.sleep(latency)
+        self._respond(status, payload, headers)
+        entry = {
+            "ts": datetime.fromtimestamp(received).isoformat(timespec="milliseconds"),
+            "token": token[:4] + "***" if token else "",
+            "room_id": room_id,
+            "status": status,
+            "latency_ms": round((time.perf_counter() - started) * 1000, 2),
+            "body_length": len(message),
+        }
+        if self.state.log_body:
+            entry["body"] = message
+        self.state.record(entry)
+
+    def _limit(self, token: str, room_id: str, now: float, headers: dict[str, str]) -> tuple[int, dict[str, Any]]:
+        """トークン・ルームの利用制限を数える。超えていれば 429。ヘッダーはトークンの制限のもの。"""
+        if self.state.token_limiter is not None:
+            allowed, remaining, reset = self.state.token_limiter.hit(token, now)
+            headers["x-ratelimit-limit"] = str(self.state.token_limiter.limit)
+            headers["x-ratelimit-remaining"] = str(max(0, remaining))
+            headers["x-ratelimit-reset"] = str(math.ceil(reset))
+            if not allowed:
+                return 429, {"errors": ["Rate limit exceeded"]}
+        if self.state.room_limiter is not None:
+            allowed, _, reset = self.state.room_limiter.hit(room_id, now)
+            if not allowed:
+                headers["x-ratelimit-reset"] = str(math.ceil(reset))
+                return 429, {"errors": ["Rate limit exceeded (room)"]}
+        return 200, {}
+
+    def do_GET(self) -> None:
+        self._respond(404, {"errors": ["Not Found"]}, {})
+
+    def _respond(self, status: int, payload: dict[str, Any], headers: dict[str, str]) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # アクセスログは --log の JSON Lines に出す
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ChatWork API のローカルスタブサーバー")
+    parser.add_argument("--host", default="127.0.0.1", help="待ち受けるアドレス（既定 127.0.0.1）")
+    parser.add_argument("--port", type=int, default=8080, help="待ち受けるポート（既定 8080。0 なら空いているポート）")
+    parser.add_argument("--latency", type=parse_latency, default=parse_latency("fixed:0"), help="応答までの遅延の分布（既定 fixed:0）")
+    parser.add_argument("--token-limit", type=parse_limit, help="API トークンごとの利用制限（回数/秒数。例: 300/300）")
+    parser.add_argument("--room-limit", type=parse_limit, help="ルームごとの利用制限（回数/秒数。例: 10/10）")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="5xx を返す割合（0〜1、既定 0）")
+    parser.add_argument(
+        "--fail-status", type=parse_statuses, default=parse_statuses(DEFAULT_FAIL_STATUSES),
+        help=f"障害時に返すステータス（カンマ区切り、既定 {DEFAULT_FAIL_STATUSES}）",
+    )
+    parser.add_argument("--log", help="リクエストログ（JSON Lines）を追記するパス")
+    parser.add_argument("--log-body", action="store_true", help="リクエストログにメッセージ本文も含める")
+    parser.add_argument("--seed", type=int, help="遅延・障害の乱数のシード（再現用）")
+    args = parser.parse_args()
+    if not 0.0 <= args.fail_rate <= 1.0:
+        print(f"エラー: --fail-rate は 0〜1 で指定してください: {args.fail_rate}", file=sys.stderr)
+        sys.exit(1)
+
+    state = StubState(args)
+    handler = type("Handler", (StubHandler,), {"state": state})
+    try:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+    except OSError as e:
+        print(f"エラー: {args.host}:{args.port} で待ち受けできません: {e}", file=sys.stderr)
+        sys.exit(1)
+    server.daemon_threads = True
+
+    def stop(signum: int, frame: Any) -> None:
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    host, port = server.server_address[:2]
+    # 1行目は負荷試験から接続先を読み取るため、この形式を変えない
+    print(f"ChatWork スタブ: http://{host}:{port} で待ち受けています", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        state.close()
+        summary = ", ".join(f"{status}: {n}" for status, n in sorted(state.statuses.items())) or "なし"
+        print(f"ChatWork スタブ: 終了しました（{summary}）", file=sys.stderr, flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,19 +7,44 @@
   - 日次在庫数ディレクトリ（必須）: 例 G:\\...\\2025-10-10\\Amazon
     末尾のディレクトリ名（Amazon）が対象ポータル名となる
   - 設定ファイルパス（任意、省略時は setting.json）
+  - --no-cache: パース結果キャッシュを使わない
+  - --rebuild-cache: キャッシュを読まずにパースし直し、結果で上書きする
+  - --metrics PATH: ステージ別・ファイル別の処理時間とカウンターを JSON Lines で追記する
+  - --profile DIR: cProfile / tracemalloc の結果をポータル名のファイルで書き出す
+  - --sink NAMES: アラートの送信先（chatwork / json / stdout のカンマ区切り）。setting.json の delivery.sinks より優先
+
+起動を速くするため、numpy / jinja2 / requests / python-dotenv 等は必要になった時点で読み込む
+（日次在庫数ファイルがなければ最低在庫数定義も読まずに終了する）。
 """
+import argparse
 import json
+import sqlite3
 import sys
+from datetime import date
 from pathlib import Path
+from typing import TYPE_CHECKING, Callable, NamedTuple
 
-from dotenv import load_dotenv
-
-load_dotenv()
-
-from app.alert_sender import build_alert_message, send_to_chatwork
+from app import instrumentation
+from app.alert_sender import build_alert_payloads
+from app.alert_state import (
+    DEFAULT_RENOTIFY_DAYS,
+    FORECAST_STATE_SUFFIX,
+    AlertDiff,
+    diff_alerts,
+    open_alert_state,
+)
+from app.cache_dir import resolve_cache_dir
+from app.csv_chunks import parallel_options
+from app.delivery import Delivery, create_sinks, record_state, records_state, send_all, with_sinks
+from app.dir_walker import scan_options
+from app.format_sniffer import FormatProfileStore
+from app.parse_cache import open_parse_cache
 from app.stock_parser import parse_portal_stock
 from app.threshold_loader import load_thresholds
 
+if TYPE_CHECKING:
+    from app.compare_engine import ThresholdTable
+
 
 def load_settings(settings_path: Path) -> dict:
     """setting.json を読み込む。"""
@@ -38,16 +63,66 @@ def _find_portal_config(portals: dict, portal_name: str) -> dict | None:
     return None
 
 
-def run(daily_stock_dir: Path, settings_path: Path) -> None:
+def _data_date(daily_stock_dir: Path) -> date:
+    """日次在庫数ディレクトリの親（yyyy-MM-dd）の日付。日付でなければ今日。"""
+    try:
+        return date.fromisoformat(daily_stock_dir.parent.name)
+    except ValueError:
+        return date.today()
+
+
+def _record_history(
+    settings: dict,
+    cache_dir: Path,
+    portal_name: str,
+    day: date,
+    stock_by_code: dict[str, int],
+    table: "ThresholdTable",
+) -> list[dict]:
+    """在庫数を履歴に追加し、在庫切れ予測を返す。履歴が無効・保存できない場合は予測しない。"""
+    from app.stock_history import forecast_depletion, history_options, open_stock_history
+
+    history = open_stock_history(cache_dir, settings)
+    if history is None:
+        return []
+    options = history_options(settings)
+    try:
+        with instrumentation.stage("history"):
+            history.append(portal_name, day, stock_by_code, options.retention_days)
+            return forecast_depletion(history, portal_name, day, stock_by_code, table, options)
+    except (OSError, ValueError) as e:
+        print(f"警告: 在庫数の履歴を保存・参照できませんでした。{e}", file=sys.stderr)
+        return []
+
+
+class Evaluation(NamedTuple):
     """
-    日次在庫数ディレクトリの末尾をポータル名とし、
-    1. 日次在庫数ファイルを再帰検索し、setting.json で定義したカラムから商品コードと在庫数を取得
-    2. 最低在庫数定義CSV/Excel を参照
-    3. 在庫数 <= 最低在庫数 の返礼品コードをアラート対象（最低在庫数CSVに無い返礼品コードはスキップ）
-    4. アラートがあれば ChatWork 送信
+    1ポータル・1日分の判定結果（evaluate の戻り値）。
+    records は alert_records の形式のアラート。stock_by_code は最低在庫数を定義した商品コードの分だけ。
+    日次在庫数ファイルに（対象商品の）データがない場合は stock_by_code が空で table は None。
+    """
+
+    portal_name: str
+    stock_by_code: dict[str, int]
+    records: list[dict]
+    table: "ThresholdTable | None"
+
+
+def evaluate(
+    daily_stock_dir: Path,
+    settings: dict,
+    cache_mode: str = "use",
+    thresholds: "dict[str, int] | ThresholdTable | None" = None,
+) -> Evaluation:
+    """
+    日次在庫数ディレクトリの末尾をポータル名とし、送信・状態の保存をせずにアラート対象だけを求める（run の 1〜3）。
+    1. 最低在庫数定義CSV/Excel を参照（日次在庫数ファイルがある場合だけ）
+    2. 日次在庫数ファイルを再帰検索し、setting.json で定義したカラムから、最低在庫数を定義した商品コードの在庫数だけを取得
+    3. 在庫数 <= 最低在庫数 の返礼品コードをアラート対象（最低在庫数CSVに無い返礼品コードはパース時にスキップ済み）
+    cache_mode はパース結果キャッシュの扱い（"use" / "off" / "rebuild"）。
+    thresholds を渡した場合は最低在庫数定義ファイルを読まずにそれを使う（load_all_thresholds で一括読み込み済みの場合）。
+    作成済みの ThresholdTable も渡せる。
     """
-    settings = load_settings(settings_path)
-    chatwork_config = settings.get("chatwork") or {}
     portals = settings.get("portals") or {}
 
     # 末尾のディレクトリ名をポータル名とし、小文字に正規化して比較
@@ -62,59 +137,191 @@ def run(daily_stock_dir: Path, settings_path: Path) -> None:
         print(f"エラー: ポータル「{portal_name}」に min_stock_base_path が設定されていません。", file=sys.stderr)
         sys.exit(1)
 
-    # 1. 日次在庫数ディレクトリを再帰的に検索し、設定で指定したカラムから商品コードと在庫数を取得
-    stock_by_code = parse_portal_stock(daily_stock_dir, portal_config)
-
-    # 2. 最低在庫数定義ファイル（portals.{ポータル名}.min_stock_base_path で指定した CSV/XLSX）を読み込み
-    min_by_code = load_thresholds(portal_min_stock_path, portal_config)
-
-    # 3. 在庫数 <= 最低在庫数 の返礼品コードをアラート対象にする。最低在庫数CSVに存在しない返礼品コードはスキップ
-    alerts: list[dict] = []
-    for product_code, current in stock_by_code.items():
-        if product_code not in min_by_code:
-            continue
-        min_stock = min_by_code[product_code]
-        if current <= min_stock:
-            alerts.append({
-                "portal_name": portal_name,
-                "product_code": product_code,
-                "current_stock": current,
-                "min_stock": min_stock,
-            })
-
-    if not alerts:
+    # テキストファイルの文字コード・区切り文字の判定結果はポータルごとに保存し、次回以降再利用する
+    cache_dir = resolve_cache_dir(settings)
+    profiles = FormatProfileStore(cache_dir / "format_profiles" / f"{portal_name}.json")
+
+    # 1. 最低在庫数定義ファイル（portals.{ポータル名}.min_stock_base_path で指定した CSV/XLSX）を読み込み
+    #    元ファイルが変わっていなければコンパイル済みインデックスから読み込む
+    #    パースで対象ファイルが見つかった時点で呼ばれる（対象ファイルがなければ最低在庫数定義は読まない）
+    tables: list["ThresholdTable"] = []
+
+    def load_keys() -> frozenset[str]:
+        with instrumentation.stage("thresholds"):
+            from app.compare_engine import ThresholdTable
+
+            if thresholds is not None:
+                min_by_code = thresholds
+            else:
+                min_by_code = load_thresholds(portal_min_stock_path, portal_config, profiles, cache_dir / "thresholds")
+            table = min_by_code if isinstance(min_by_code, ThresholdTable) else ThresholdTable(min_by_code)
+            tables.append(table)
+            return table.defined_codes()
+
+    # 2. 日次在庫数ディレクトリを再帰的に検索し、設定で指定したカラムから商品コードと在庫数を取得
+    #    最低在庫数を定義した商品コード以外の行は数値変換・合算の前に捨てる。変更のないファイルはパース結果キャッシュから読み込む
+    with instrumentation.stage("parse"):
+        parse_cache = open_parse_cache(cache_dir, settings, cache_mode)
+        try:
+            scan = scan_options(settings, portal_config, cache_dir, cache_mode)
+            stock_by_code = parse_portal_stock(
+                daily_stock_dir, portal_config, profiles, parse_cache, scan, parallel_options(settings), load_keys
+            )
+        finally:
+            if parse_cache is not None:
+                parse_cache.close()
+
+    # 対象ファイルがない（または対象商品の有効な行がない）場合はアラートも回復もない
+    if not stock_by_code:
+        return Evaluation(portal_name, stock_by_code, [], None)
+    # データがある場合は load_keys が呼ばれている
+    table = tables[0]
+
+    # 3. 在庫数 <= 最低在庫数 の返礼品コードをアラート対象にする
+    #    返礼品コードを整数 ID に変換し、配列演算でまとめて判定する
+    with instrumentation.stage("compare"):
+        from app.compare_engine import alert_records
+
+        alerts, codes = table.compare(stock_by_code)
+        records = alert_records(alerts, codes, portal_name)
+    instrumentation.count("alerts", len(records))
+    return Evaluation(portal_name, stock_by_code, records, table)
+
+
+def run(
+    daily_stock_dir: Path,
+    settings_path: Path,
+    settings: dict | None = None,
+    cache_mode: str = "use",
+    thresholds: "dict[str, int] | ThresholdTable | None" = None,
+    deliver: Callable[[Delivery], None] | None = None,
+) -> None:
+    """
+    evaluate でアラート対象を求めたうえで、
+    前回通知から変化のないものは除き、回復したもの・在庫切れ予測を加えて、通知するものがあれば送信先（delivery.sinks）に送る。
+    settings を渡した場合は setting.json を読み直さない（run_all_portals のインプロセス実行用）。
+    cache_mode・thresholds は evaluate と同じ。
+    deliver を渡した場合はその場で送らず Delivery を渡す（送信と送信状態の保存は呼び出し側の DeliveryQueue が行う）。
+    """
+    if settings is None:
+        settings = load_settings(settings_path)
+    chatwork_config = settings.get("chatwork") or {}
+    evaluation = evaluate(daily_stock_dir, settings, cache_mode, thresholds)
+    if not evaluation.stock_by_code:
+        print(f"日次在庫数ファイルに最低在庫数を定義した商品のデータがないため、判定を省略しました: {daily_stock_dir}")
         return
+    portal_name, stock_by_code, records, table = evaluation
+    cache_dir = resolve_cache_dir(settings)
 
-    # 4. テンプレートと setting.json の API で ChatWork 送信
-    message = build_alert_message(alerts, chatwork_config)
-    ok, err = send_to_chatwork(chatwork_config, message)
-    if ok:
-        print("ChatWork にアラートを送信しました。")
-    else:
-        print(f"ChatWork への送信に失敗しました。{err}", file=sys.stderr)
-        sys.exit(1)
+    # 日次の合算在庫数を履歴に追加し、減少傾向から最低在庫数に近く達しそうなものを予測する
+    forecasts = _record_history(settings, cache_dir, portal_name, _data_date(daily_stock_dir), stock_by_code, table)
+    instrumentation.count("forecasts", len(forecasts))
+
+    # 前回の通知状態と比べ、新規・悪化・回復したもの（と再通知日数を過ぎたもの）だけを送る
+    # 在庫切れ予測は「ポータル名:forecast」の状態で管理し、新規と再通知日数を過ぎたものだけを送る
+    forecast_key = f"{portal_name}{FORECAST_STATE_SUFFIX}"
+    state_store = open_alert_state(cache_dir, settings)
+    try:
+        diff = AlertDiff(records, [])
+        forecast_diff = AlertDiff(forecasts, [])
+        if state_store is not None:
+            renotify_days = int((settings.get("alert_state") or {}).get("renotify_days", DEFAULT_RENOTIFY_DAYS))
+            try:
+                with instrumentation.stage("alert_state"):
+                    # 前回のアラートは最低在庫数の定義に照らして解決する（定義から削除されたものは回復、在庫データにないものは再通知）
+                    defined = table.defined_codes()
+                    previous = state_store.load(portal_name)
+                    diff = diff_alerts(
+                        portal_name, records, stock_by_code, previous, date.today(), renotify_days, defined=defined
+                    )
+                    forecast_diff = diff_alerts(
+                        forecast_key,
+                        forecasts,
+                        stock_by_code,
+                        state_store.load(forecast_key),
+                        date.today(),
+                        renotify_days,
+                        notify_worsened=False,
+                        defined=defined,
+                        remind_missing=False,
+                    )
+            except sqlite3.Error as e:
+                print(f"警告: アラート送信状態を読み込めないため、全件を送信します。{e}", file=sys.stderr)
+                state_store.close()
+                state_store = None
+        if not diff.notify and not diff.recovered and not forecast_diff.notify:
+            if records or forecasts:
+                print(f"前回から変化のないアラート {len(records) + len(forecasts)} 件の送信を省略しました。")
+            if state_store is not None and forecast_diff.recovered:
+                record_state(state_store, forecast_key, forecast_diff, date.today())
+            return
+
+        # 4. テンプレートと setting.json の API で送信先に送る（予測から外れたものは通知しない）
+        with instrumentation.stage("message"):
+            payloads = build_alert_payloads(diff.notify, chatwork_config, diff.recovered, forecast_diff.notify)
+        delivery = Delivery(portal_name, payloads, [(portal_name, diff), (forecast_key, forecast_diff)], date.today())
+        if deliver is not None:
+            deliver(delivery)
+            print("アラートを送信待ちに加えました。")
+            return
+        try:
+            sinks = create_sinks(settings)
+        except ValueError as e:
+            print(f"エラー: {e}", file=sys.stderr)
+            sys.exit(1)
+        with instrumentation.stage("send"):
+            ok, err = send_all(sinks, delivery)
+        if not ok:
+            print(f"アラートの送信に失敗しました。{err}", file=sys.stderr)
+            sys.exit(1)
+        print(f"アラートを送信しました（{', '.join(sink.name for sink in sinks)}）。")
+        # 送信に成功した場合だけ通知状態を更新する（失敗時は次回もう一度送る）
+        if state_store is not None and records_state(sinks):
+            for key, key_diff in delivery.state_updates:
+                record_state(state_store, key, key_diff, delivery.day)
+    finally:
+        if state_store is not None:
+            state_store.close()
 
 
 def main() -> None:
-    if len(sys.argv) < 2:
-        print(
-            "用法: python main.py <日次在庫数ディレクトリ> [setting.json のパス]\n"
-            "  例: python main.py \"G:\\共有ドライブ\\★OD\\99_Ops\\アーカイブ(Stock)\\2025-10-10\\Amazon\"",
-            file=sys.stderr,
-        )
-        sys.exit(1)
+    parser = argparse.ArgumentParser(
+        description="1ポータル分の在庫しきい値アラートを実行する。",
+        epilog='例: python main.py "G:\\共有ドライブ\\★OD\\99_Ops\\アーカイブ(Stock)\\2025-10-10\\Amazon"',
+    )
+    parser.add_argument("daily_stock_dir", help="日次在庫数ディレクトリ（末尾のディレクトリ名がポータル名）")
+    parser.add_argument("settings", nargs="?", help="setting.json のパス")
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument("--no-cache", action="store_true", help="パース結果キャッシュを使わない")
+    cache_group.add_argument("--rebuild-cache", action="store_true", help="キャッシュを読まずにパースし直して上書きする")
+    parser.add_argument("--metrics", metavar="PATH", help="ステージ別・ファイル別の計測結果を JSON Lines で追記するパス")
+    parser.add_argument("--profile", metavar="DIR", help="cProfile / tracemalloc の結果を書き出すディレクトリ")
+    parser.add_argument("--sink", metavar="NAMES", help="アラートの送信先（chatwork / json / stdout のカンマ区切り）")
+    args = parser.parse_args()
 
-    daily_stock_dir = Path(sys.argv[1]).resolve()
+    daily_stock_dir = Path(args.daily_stock_dir).resolve()
     if not daily_stock_dir.is_dir():
         print(f"エラー: ディレクトリが見つかりません: {daily_stock_dir}", file=sys.stderr)
         sys.exit(1)
 
-    settings_path = Path(sys.argv[2]) if len(sys.argv) > 2 else Path(__file__).resolve().parent / "setting.json"
+    settings_path = Path(args.settings) if args.settings else Path(__file__).resolve().parent / "setting.json"
     if not settings_path.exists():
         print(f"エラー: 設定ファイルが見つかりません: {settings_path}", file=sys.stderr)
         sys.exit(1)
 
-    run(daily_stock_dir, settings_path)
+    settings = load_settings(settings_path)
+    if args.sink:
+        settings = with_sinks(settings, args.sink)
+    cache_mode = "off" if args.no_cache else "rebuild" if args.rebuild_cache else "use"
+    metrics = instrumentation.RunMetrics(daily_stock_dir.name) if args.metrics else None
+    profile_dir = Path(args.profile) if args.profile else None
+    try:
+        with instrumentation.collecting(metrics), instrumentation.profiling(profile_dir, daily_stock_dir.name):
+            run(daily_stock_dir, settings_path, settings, cache_mode)
+    finally:
+        # 送信失敗等で終了する場合も計測結果は書き出す
+        if metrics is not None:
+            instrumentation.append_jsonl(Path(args.metrics), [metrics.to_dict()])
 
 
 if __name__ == "__main__":
@@ -1,26 +1,577 @@
 # -*- coding: utf-8 -*-
 """
-複数ポータルをシリアルに処理するランナー。
+複数ポータルを処理するランナー。
 引数で与えたディレクトリ配下のポータル名ディレクトリを、
 setting.json の min_stock_base_path が空でないものに限りアルファベット順で処理する。
 
 引数なしの場合: デフォルトで G:\\共有ドライブ\\★OD\\99_Ops\\アーカイブ(Stock) を対象とし、
 その配下の日付ディレクトリ（yyyy-MM-dd）のうち直近のものを使用する。
+
+--workers N を指定した場合は main.py をサブプロセスで起動せず、main.run を
+プロセスプール（--executor thread でスレッドプール）上でインプロセス実行する。
+ポータルごとの出力はバッファしてアルファベット順に表示し、最後に終了コードと経過時間の一覧を出す。
+
+--metrics PATH を指定すると、ポータルごとの計測結果（ステージ別・ファイル別の処理時間とカウンター）と
+全ポータルの集計を JSON Lines で追記する。--profile DIR でポータルごとの cProfile / tracemalloc 結果を書き出す。
+
+--workers / --watch のインプロセス実行では、各ポータルのアラートをその場で送らずに親プロセスの送信キュー
+（app.delivery.DeliveryQueue）に渡し、バックグラウンドのスレッドで送る。次のポータルのパース・判定と前のポータルの
+送信が重なる。送信結果は終了時にまとめて出力する。--sink で送信先（chatwork / json / stdout）を切り替えられる。
+
+--watch を指定すると常駐し、アーカイブルート（第1引数、省略時は既定のアーカイブディレクトリ）を監視する。
+日付ディレクトリにポータルのファイルが揃い、watch.stable_sec 秒変化がなくなった時点でそのポータルだけを処理する。
+最低在庫数定義（ThresholdTable）とアラート文のテンプレートはメモリに保持し、定義ファイルが更新された場合だけ読み直す。
+
+--from DATE [--to DATE] を指定するとバックフィルとして、アーカイブルート（第1引数）配下の期間内の日付ディレクトリを
+日付 × ポータルの単位で --workers 並列（既定は CPU 数）に判定する。最低在庫数定義は最初に1回だけ読み込む。
+ChatWork には送信せず、送信状態・在庫数の履歴も更新しない。結果は --report のファイル（JSON / CSV）にまとめて書き出す。
 """
+import argparse
+import io
 import json
+import os
 import re
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime
 from pathlib import Path
+from typing import Any, Callable, NamedTuple
 
 DEFAULT_ARCHIVE_ROOT = r"G:\共有ドライブ\★OD\99_Ops\アーカイブ(Stock)"
 DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
 
 
-def _resolve_base_dir() -> Path:
+class PortalResult(NamedTuple):
+    """
+    1ポータル分の実行結果。output は (ストリーム名, テキスト) の出力順リスト。metrics は計測結果（計測時のみ）。
+    deliveries は送信を親プロセスに任せた場合の送信内容（app.delivery.Delivery）。
+    """
+
+    portal_name: str
+    exit_code: int
+    elapsed: float
+    output: list[tuple[str, str]]
+    metrics: dict | None = None
+    deliveries: tuple = ()
+
+
+class _ThreadLocalStream(io.TextIOBase):
+    """
+    sys.stdout / sys.stderr の差し替え用。
+    スレッドごとにキャプチャ先が設定されていればそこへ、なければ元のストリームへ書き込む。
+    スレッドプールでも各ポータルの出力が混ざらないようにするためのもの。
+    """
+
+    def __init__(self, name: str, original):
+        self._name = name
+        self._original = original
+        self._local = threading.local()
+
+    def capture(self, sink: list[tuple[str, str]] | None) -> None:
+        self._local.sink = sink
+
+    def write(self, text: str) -> int:
+        sink = getattr(self._local, "sink", None)
+        if sink is None:
+            return self._original.write(text)
+        sink.append((self._name, text))
+        return len(text)
+
+    def flush(self) -> None:
+        if getattr(self._local, "sink", None) is None:
+            self._original.flush()
+
+
+def _install_capture_streams() -> tuple[_ThreadLocalStream, _ThreadLocalStream]:
+    """sys.stdout / sys.stderr をスレッド別キャプチャ対応のストリームに差し替える（冪等）。"""
+    if not isinstance(sys.stdout, _ThreadLocalStream):
+        sys.stdout = _ThreadLocalStream("stdout", sys.stdout)
+    if not isinstance(sys.stderr, _ThreadLocalStream):
+        sys.stderr = _ThreadLocalStream("stderr", sys.stderr)
+    return sys.stdout, sys.stderr
+
+
+def _exit_code_of(e: SystemExit) -> int:
+    """SystemExit の code を終了コードに変換する。"""
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code, file=sys.stderr)
+    return 1
+
+
+def _run_captured(
+    label: str,
+    func: Callable[[], Any],
+    collect_metrics: bool = False,
+    profile_dir: Path | None = None,
+) -> tuple[PortalResult, Any]:
+    """
+    func を現在のプロセス内で実行し、出力と終了コードを PortalResult にまとめて (結果, func の戻り値) を返す。
+    sys.exit や予期しない例外はここで捕捉し（戻り値は None）、他のポータルの処理には影響させない。
+    """
+    from app import instrumentation
+
+    stdout, stderr = _install_capture_streams()
+    output: list[tuple[str, str]] = []
+    stdout.capture(output)
+    stderr.capture(output)
+    exit_code = 0
+    value = None
+    metrics = instrumentation.RunMetrics(label) if collect_metrics else None
+    started = time.perf_counter()
+    try:
+        with instrumentation.collecting(metrics), instrumentation.profiling(profile_dir, label):
+            value = func()
+    except SystemExit as e:
+        exit_code = _exit_code_of(e)
+    except Exception:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        stdout.capture(None)
+        stderr.capture(None)
+    result = PortalResult(
+        label,
+        exit_code,
+        time.perf_counter() - started,
+        output,
+        metrics.to_dict() if metrics is not None else None,
+    )
+    return result, value
+
+
+def _run_portal_in_process(
+    portal_dir: Path,
+    settings_path: Path,
+    settings: dict,
+    cache_mode: str,
+    thresholds: dict[str, int] | None = None,
+    collect_metrics: bool = False,
+    profile_dir: Path | None = None,
+    defer_delivery: bool = False,
+) -> PortalResult:
+    """
+    main.run を現在のプロセス内で実行し、出力と終了コードを PortalResult にまとめる。
+    defer_delivery の場合はアラートを送らず、送信内容を PortalResult.deliveries で返す。
+    """
+    import main as portal_main
+
+    deliveries: list = []
+
+    def run() -> None:
+        deliver = deliveries.append if defer_delivery else None
+        portal_main.run(portal_dir, settings_path, settings, cache_mode, thresholds, deliver)
+
+    result = _run_captured(portal_dir.name, run, collect_metrics, profile_dir)[0]
+    return result._replace(deliveries=tuple(deliveries))
+
+
+def _run_portal_subprocess(
+    portal_dir: Path,
+    settings_path: Path,
+    cache_mode: str,
+    collect_metrics: bool = False,
+    profile_dir: Path | None = None,
+    sinks: str | None = None,
+) -> PortalResult:
+    """従来どおり main.py をサブプロセスで起動する。出力はそのまま端末に流す。送信も各プロセスで行う。"""
+    from app.instrumentation import read_jsonl
+
+    main_py = Path(__file__).resolve().parent / "main.py"
+    extra_args = {"off": ["--no-cache"], "rebuild": ["--rebuild-cache"]}.get(cache_mode, [])
+    if profile_dir is not None:
+        extra_args += ["--profile", str(profile_dir)]
+    if sinks:
+        extra_args += ["--sink", sinks]
+    with tempfile.TemporaryDirectory() as tmp:
+        metrics_path = Path(tmp) / "metrics.jsonl"
+        if collect_metrics:
+            extra_args += ["--metrics", str(metrics_path)]
+        started = time.perf_counter()
+        ret = subprocess.run(
+            [sys.executable, str(main_py), str(portal_dir), str(settings_path), *extra_args],
+            cwd=str(Path(__file__).resolve().parent),
+        )
+        elapsed = time.perf_counter() - started
+        records = read_jsonl(metrics_path) if collect_metrics else []
+    return PortalResult(portal_dir.name, ret.returncode, elapsed, [], records[0] if records else None)
+
+
+def _replay_output(output: list[tuple[str, str]]) -> None:
+    """バッファしたポータルの出力を元のストリームへ書き出す。"""
+    for stream_name, text in output:
+        stream = sys.stderr if stream_name == "stderr" else sys.stdout
+        stream.write(text)
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+
+def _print_summary(results: list[PortalResult]) -> None:
+    """ポータルごとの終了コードと経過時間を表形式で出力する。"""
+    if not results:
+        return
+    width = max(len("ポータル"), *(len(r.portal_name) for r in results))
+    print(f"{'ポータル'.ljust(width)}  終了コード  経過(秒)")
+    for r in results:
+        status = "OK" if r.exit_code == 0 else "NG"
+        print(f"{r.portal_name.ljust(width)}  {r.exit_code:>4} {status}  {r.elapsed:>8.2f}")
+    failed = sum(1 for r in results if r.exit_code != 0)
+    total = sum(r.elapsed for r in results)
+    print(f"合計 {len(results)} ポータル（失敗 {failed}）、処理時間合計 {total:.2f} 秒", flush=True)
+
+
+def _submit_deliveries(delivery_queue, result: PortalResult) -> None:
+    """ポータルの送信内容を送信キューに渡す。キューが一杯の場合は空くまで待つ。"""
+    for delivery in result.deliveries:
+        delivery_queue.submit(delivery)
+
+
+def _finish_delivery(delivery_queue) -> None:
+    """送信待ちをすべて送り終えるまで待ち、送信結果をまとめて出力する。"""
+    from app.delivery import print_delivery_report
+
+    print_delivery_report(delivery_queue.close())
+
+
+def _write_metrics(path: Path, results: list[PortalResult]) -> None:
+    """ポータルごとの計測結果と、全ポータルを合算した集計を JSON Lines で追記する。"""
+    from app.instrumentation import append_jsonl, summarize
+
+    records = [r.metrics for r in results if r.metrics is not None]
+    append_jsonl(path, [*records, summarize(records)])
+    print(f"計測結果を書き出しました: {path}", flush=True)
+
+
+def _create_executor(
+    kind: str, workers: int, initializer: Callable[..., None] | None = None, initargs: tuple = ()
+) -> Executor:
+    """
+    --executor の指定に応じたプールを生成する。initializer は各ワーカーの開始時に1回呼ばれる。
+    送信キュー等のスレッドが動いていても安全なよう、プロセスは fork ではなく spawn で起動する（Windows と同じ）。
+    """
+    if kind == "thread":
+        _install_capture_streams()
+        return ThreadPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+    import multiprocessing
+
+    context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=initializer, initargs=initargs)
+
+
+def _run_in_process(
+    to_process: list[Path],
+    settings_path: Path,
+    settings: dict,
+    workers: int,
+    executor_kind: str,
+    cache_mode: str,
+    collect_metrics: bool = False,
+    profile_dir: Path | None = None,
+) -> list[PortalResult]:
+    """
+    ポータルをプール上で並列に処理し、アルファベット順で出力を表示する。
+    最低在庫数定義は処理するポータルの分だけを先にまとめて読み込み、各ワーカーに渡す。
+    アラートは結果を受け取った順に送信キューに渡し、後続のポータルの処理と並行して送る。
+    """
+    from app.delivery import DeliveryQueue
+    from app.threshold_loader import load_all_thresholds
+
+    all_thresholds = load_all_thresholds(settings, [p.name for p in to_process])
+    results: list[PortalResult] = []
+    delivery_queue = DeliveryQueue(settings)
+    try:
+        with _create_executor(executor_kind, workers) as executor:
+            futures = [
+                executor.submit(
+                    _run_portal_in_process,
+                    portal_dir,
+                    settings_path,
+                    settings,
+                    cache_mode,
+                    all_thresholds.get(portal_dir.name.strip().lower()),
+                    collect_metrics,
+                    profile_dir,
+                    True,
+                )
+                for portal_dir in to_process
+            ]
+            for portal_dir, future in zip(to_process, futures):
+                print(f"--- ポータル: {portal_dir.name} ---", flush=True)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # ワーカープロセス自体が落ちた場合もポータル単位の失敗として扱う
+                    result = PortalResult(portal_dir.name, 1, 0.0, [("stderr", f"ワーカー異常終了: {e}\n")])
+                _replay_output(result.output)
+                if result.exit_code != 0:
+                    print(f"警告: ポータル「{result.portal_name}」でエラー (exit {result.exit_code})", file=sys.stderr)
+                _submit_deliveries(delivery_queue, result)
+                results.append(result)
+    finally:
+        # 例外・Ctrl-C で中断した場合も、キューに渡したアラートは送り終えて結果を出力する（_watch と同じ）
+        _finish_delivery(delivery_queue)
+    return results
+
+
+class _ResidentThresholds:
+    """--watch 用: ポータルごとの ThresholdTable を保持し、最低在庫数定義ファイルのサイズ・更新日時が変わった場合だけ読み直す。"""
+
+    def __init__(self, settings: dict):
+        from app.cache_dir import resolve_cache_dir
+
+        self._cache_dir = resolve_cache_dir(settings)
+        self._tables: dict[str, tuple[tuple[int, int], object]] = {}
+
+    def get(self, portal_name: str, portal_config: dict):
+        """ポータルの ThresholdTable を返す。定義ファイルが読めない場合は None（main.run 側で読み込む）。"""
+        from app.compare_engine import ThresholdTable
+        from app.format_sniffer import FormatProfileStore
+        from app.threshold_loader import load_thresholds
+
+        path = Path(portal_config["min_stock_base_path"])
+        try:
+            st = path.stat()
+        except OSError:
+            return None
+        key = (st.st_size, st.st_mtime_ns)
+        cached = self._tables.get(portal_name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        profiles = FormatProfileStore(self._cache_dir / "format_profiles" / f"{portal_name}.json")
+        table = ThresholdTable(load_thresholds(str(path), portal_config, profiles, self._cache_dir / "thresholds"))
+        self._tables[portal_name] = (key, table)
+        return table
+
+
+def _watch(
+    archive_root: Path,
+    settings_path: Path,
+    settings: dict,
+    targets: dict[str, dict],
+    cache_mode: str,
+    collect_metrics: bool = False,
+    metrics_path: Path | None = None,
+    profile_dir: Path | None = None,
+) -> None:
+    """
+    アーカイブルートを監視し、ファイルが揃ったポータルから順にインプロセスで処理する（Ctrl+C で終了）。
+    targets は対象ポータル（小文字のポータル名 → ポータル設定）。
+    アラートは送信キューに渡してバックグラウンドで送り、終了時に残りを送り終えてから送信結果を出力する。
+    """
+    from app.alert_sender import load_template
+    from app.archive_watcher import ArchiveTracker, create_watcher, watch_options
+    from app.cache_dir import resolve_cache_dir
+    from app.delivery import DeliveryQueue
+    from app.dir_walker import scan_options
+
+    options = watch_options(settings)
+    cache_dir = resolve_cache_dir(settings)
+    tracker = ArchiveTracker(
+        archive_root,
+        targets,
+        lambda portal_config: scan_options(settings, portal_config, cache_dir, "off"),
+        options.stable_sec,
+    )
+    thresholds = _ResidentThresholds(settings)
+    # テンプレートの誤りは起動時に分かるよう、先にコンパイルしておく
+    load_template()
+    watcher = create_watcher(options.mode)
+    delivery_queue = DeliveryQueue(settings)
+    print(
+        f"監視を開始しました（{watcher.name}、{options.stable_sec:g} 秒変化がなければ処理）: {archive_root}",
+        flush=True,
+    )
+    try:
+        while True:
+            now = time.monotonic()
+            ready = tracker.poll(now)
+            watcher.watch(tracker.watch_dirs())
+            results = []
+            for portal_dir in ready:
+                portal_name = portal_dir.name.strip().lower()
+                print(f"--- ポータル: {portal_dir.parent.name}/{portal_dir.name} ---", flush=True)
+                result = _run_portal_in_process(
+                    portal_dir,
+                    settings_path,
+                    settings,
+                    cache_mode,
+                    thresholds.get(portal_name, targets[portal_name]),
+                    collect_metrics,
+                    profile_dir,
+                    True,
+                )
+                _replay_output(result.output)
+                if result.exit_code != 0:
+                    print(f"警告: ポータル「{result.portal_name}」でエラー (exit {result.exit_code})", file=sys.stderr)
+                _submit_deliveries(delivery_queue, result)
+                results.append(result)
+            if results:
+                _print_summary(results)
+                if metrics_path is not None:
+                    _write_metrics(metrics_path, results)
+
+            deadline = tracker.next_deadline()
+            timeout = options.poll_interval_sec
+            if deadline is not None:
+                timeout = min(timeout, max(0.0, deadline - time.monotonic()))
+            watcher.wait(timeout)
+    except KeyboardInterrupt:
+        print("監視を終了しました。", flush=True)
+    finally:
+        watcher.close()
+        _finish_delivery(delivery_queue)
+
+
+# バックフィルのワーカーが参照する最低在庫数定義（ポータル名 → ThresholdTable）。ワーカーの開始時に1回だけ受け取る
+_backfill_tables: dict[str, Any] = {}
+
+
+def _init_backfill_worker(tables: dict[str, Any]) -> None:
+    global _backfill_tables
+    _backfill_tables = tables
+
+
+def _backfill_units(archive_root: Path, date_from: str, date_to: str, targets: set[str]) -> list[tuple[str, Path]]:
+    """date_from〜date_to（両端を含む）の日付ディレクトリ配下の対象ポータルを、(日付, ポータル名ディレクトリ) の日付・ポータル名順で返す。"""
+    units = []
+    date_dirs = sorted(
+        d for d in archive_root.iterdir()
+        if d.is_dir() and DATE_PATTERN.match(d.name) and date_from <= d.name <= date_to
+    )
+    for date_dir in date_dirs:
+        portal_dirs = sorted(
+            (p for p in date_dir.iterdir() if p.is_dir() and p.name.lower() in targets), key=lambda p: p.name.lower()
+        )
+        units.extend((date_dir.name, portal_dir) for portal_dir in portal_dirs)
+    return units
+
+
+def _evaluate_unit(
+    day: str, portal_dir: Path, settings: dict, cache_mode: str, collect_metrics: bool = False
+) -> tuple[PortalResult, dict | None]:
+    """
+    1日付・1ポータル分を main.evaluate で判定する（送信・送信状態・履歴の更新はしない）。
+    戻り値は (実行結果, {"codes": 商品コード数, "alerts": アラート}) で、失敗時の後者は None。
+    """
+    import main as portal_main
+
+    portal_name = portal_dir.name.strip().lower()
+
+    def evaluate() -> dict:
+        evaluation = portal_main.evaluate(portal_dir, settings, cache_mode, _backfill_tables.get(portal_name))
+        return {"codes": len(evaluation.stock_by_code), "alerts": evaluation.records}
+
+    return _run_captured(f"{day}/{portal_dir.name}", evaluate, collect_metrics)
+
+
+def _backfill(
+    archive_root: Path,
+    settings: dict,
+    targets: dict[str, dict],
+    date_from: str,
+    date_to: str,
+    workers: int,
+    executor_kind: str,
+    cache_mode: str,
+    collect_metrics: bool = False,
+) -> tuple[list[PortalResult], list[dict]]:
+    """
+    date_from〜date_to の日付ディレクトリを対象ポータルごとに判定する。
+    最低在庫数定義は最初に1回だけ読み込んで ThresholdTable にし、各ワーカーに1回だけ渡す。
+    戻り値は (日付・ポータルごとの実行結果, 日付・ポータルごとの判定結果)。
+    """
+    from app.compare_engine import ThresholdTable
+    from app.threshold_loader import load_all_thresholds
+
+    units = _backfill_units(archive_root, date_from, date_to, set(targets))
+    if not units:
+        print(f"バックフィル: {date_from}〜{date_to} に対象ポータルのディレクトリがありません: {archive_root}", flush=True)
+        return [], []
+    portals_in_units = {portal_dir.name.strip().lower() for _, portal_dir in units}
+    tables = {
+        name: ThresholdTable(min_by_code)
+        for name, min_by_code in load_all_thresholds(settings, portals_in_units).items()
+    }
+    print(f"バックフィル: {date_from}〜{date_to} の {len(units)} 件を {workers} ワーカーで判定します。", flush=True)
+
+    results: list[PortalResult] = []
+    entries: list[dict] = []
+    with _create_executor(executor_kind, workers, _init_backfill_worker, (tables,)) as executor:
+        futures = [
+            executor.submit(_evaluate_unit, day, portal_dir, settings, cache_mode, collect_metrics)
+            for day, portal_dir in units
+        ]
+        for (day, portal_dir), future in zip(units, futures):
+            label = f"{day}/{portal_dir.name}"
+            try:
+                result, value = future.result()
+            except Exception as e:
+                # ワーカープロセス自体が落ちた場合も日付・ポータル単位の失敗として扱う
+                result, value = PortalResult(label, 1, 0.0, [("stderr", f"ワーカー異常終了: {e}\n")]), None
+            alerts = value["alerts"] if value is not None else []
+            if value is not None:
+                print(f"{label}: 商品 {value['codes']} 件、アラート {len(alerts)} 件", flush=True)
+            _replay_output(result.output)
+            if result.exit_code != 0:
+                print(f"警告: {label} でエラー (exit {result.exit_code})", file=sys.stderr)
+            results.append(result)
+            entries.append({
+                "date": day,
+                "portal": portal_dir.name,
+                "exit_code": result.exit_code,
+                "elapsed": round(result.elapsed, 3),
+                "codes": value["codes"] if value is not None else None,
+                "alerts": alerts,
+            })
+    return results, entries
+
+
+def _write_backfill_report(path: Path, date_from: str, date_to: str, entries: list[dict]) -> None:
+    """
+    バックフィルの結果を1ファイルにまとめて書き出す。
+    拡張子が .csv の場合はアラート1件1行の CSV（Excel で開けるよう BOM 付き UTF-8）、それ以外は JSON。
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.suffix.lower() == ".csv":
+        import csv
+
+        with open(path, "w", encoding="utf-8-sig", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["日付", "ポータル", "返礼品コード", "在庫数", "最低在庫数"])
+            for entry in entries:
+                for alert in entry["alerts"]:
+                    writer.writerow(
+                        [entry["date"], entry["portal"], alert["product_code"], alert["current_stock"], alert["min_stock"]]
+                    )
+    else:
+        report = {
+            "generated_at": datetime.now().isoformat(timespec="seconds"),
+            "from": date_from,
+            "to": date_to,
+            "summary": {
+                "units": len(entries),
+                "failed": sum(1 for e in entries if e["exit_code"] != 0),
+                "dates": len({e["date"] for e in entries}),
+                "alerts": sum(len(e["alerts"]) for e in entries),
+            },
+            "units": entries,
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"バックフィルの結果を書き出しました: {path}", flush=True)
+
+
+def _resolve_base_dir(base_dir_arg: str | None) -> Path:
     """引数で指定されたベースディレクトリ、または未指定時は直近日付ディレクトリを返す。"""
-    if len(sys.argv) >= 2:
-        return Path(sys.argv[1]).resolve()
+    if base_dir_arg:
+        return Path(base_dir_arg).resolve()
 
     archive_root = Path(DEFAULT_ARCHIVE_ROOT)
     if not archive_root.is_dir():
@@ -36,22 +587,113 @@ def _resolve_base_dir() -> Path:
     return latest
 
 
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="複数ポータルの在庫しきい値アラートを実行する。")
+    parser.add_argument("base_dir", nargs="?", help="ポータル名ディレクトリを含むベースディレクトリ")
+    parser.add_argument("settings", nargs="?", help="setting.json のパス")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="指定するとインプロセスで並列実行する（ワーカー数）。未指定時はサブプロセスでシリアル実行",
+    )
+    parser.add_argument(
+        "--executor",
+        choices=("process", "thread"),
+        default="process",
+        help="--workers 指定時のプール種別（既定: process）",
+    )
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument("--no-cache", action="store_true", help="パース結果キャッシュを使わない")
+    cache_group.add_argument("--rebuild-cache", action="store_true", help="キャッシュを読まずにパースし直して上書きする")
+    parser.add_argument("--metrics", metavar="PATH", help="ポータル別の計測結果と全体の集計を JSON Lines で追記するパス")
+    parser.add_argument("--profile", metavar="DIR", help="ポータルごとの cProfile / tracemalloc の結果を書き出すディレクトリ")
+    parser.add_argument(
+        "--sink",
+        metavar="NAMES",
+        help="アラートの送信先（chatwork / json / stdout のカンマ区切り。既定: setting.json の delivery.sinks）",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="常駐してアーカイブルート（第1引数）を監視し、ファイルが揃ったポータルから処理する",
+    )
+    parser.add_argument(
+        "--from",
+        dest="date_from",
+        metavar="YYYY-MM-DD",
+        help="バックフィル: アーカイブルート（第1引数）配下のこの日付以降の日付ディレクトリを判定し、送信せずにレポートを書き出す",
+    )
+    parser.add_argument("--to", dest="date_to", metavar="YYYY-MM-DD", help="バックフィルの最終日（既定: 今日）")
+    parser.add_argument(
+        "--report",
+        metavar="PATH",
+        help="バックフィルのレポート（.json または .csv。既定: backfill_{from}_{to}.json）",
+    )
+    return parser.parse_args()
+
+
+def _parse_date_arg(value: str, option: str) -> str:
+    """yyyy-MM-dd の日付引数を検証して返す。"""
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        print(f"エラー: {option} には yyyy-MM-dd 形式の日付を指定してください: {value}", file=sys.stderr)
+        sys.exit(1)
+
+
 def main() -> None:
-    base_dir = _resolve_base_dir()
+    args = _parse_args()
+    backfill = args.date_from is not None
+    if not backfill and (args.date_to is not None or args.report is not None):
+        print("エラー: --to / --report は --from と一緒に指定してください。", file=sys.stderr)
+        sys.exit(1)
+    if backfill:
+        if args.watch:
+            print("エラー: --from と --watch は同時に指定できません。", file=sys.stderr)
+            sys.exit(1)
+        date_from = _parse_date_arg(args.date_from, "--from")
+        date_to = _parse_date_arg(args.date_to, "--to") if args.date_to else date.today().isoformat()
+        if date_from > date_to:
+            print(f"エラー: --from（{date_from}）が --to（{date_to}）より後です。", file=sys.stderr)
+            sys.exit(1)
+        base_dir = Path(args.base_dir or DEFAULT_ARCHIVE_ROOT).resolve()
+    elif args.watch:
+        if args.workers is not None:
+            print("エラー: --watch と --workers は同時に指定できません。", file=sys.stderr)
+            sys.exit(1)
+        base_dir = Path(args.base_dir or DEFAULT_ARCHIVE_ROOT).resolve()
+    else:
+        base_dir = _resolve_base_dir(args.base_dir)
     if not base_dir.is_dir():
         print(f"エラー: ディレクトリが見つかりません: {base_dir}", file=sys.stderr)
         sys.exit(1)
 
-    if len(sys.argv) < 2:
+    if not args.base_dir and not args.watch and not backfill:
         print(f"引数なし: 直近日付ディレクトリを対象にします: {base_dir}", flush=True)
 
-    settings_path = Path(sys.argv[2]) if len(sys.argv) > 2 else Path(__file__).resolve().parent / "setting.json"
+    settings_path = Path(args.settings) if args.settings else Path(__file__).resolve().parent / "setting.json"
     if not settings_path.exists():
         print(f"エラー: 設定ファイルが見つかりません: {settings_path}", file=sys.stderr)
         sys.exit(1)
+    if args.workers is not None and args.workers < 1:
+        print("エラー: --workers には 1 以上を指定してください。", file=sys.stderr)
+        sys.exit(1)
 
     with open(settings_path, "r", encoding="utf-8") as f:
         settings = json.load(f)
+    if args.sink:
+        from app.delivery import with_sinks
+
+        settings = with_sinks(settings, args.sink)
+    if not backfill:
+        from app.delivery import delivery_options
+
+        try:
+            delivery_options(settings)
+        except ValueError as e:
+            print(f"エラー: {e}", file=sys.stderr)
+            sys.exit(1)
     portals = settings.get("portals") or {}
 
     # min_stock_base_path が空でないポータル名を抽出（小文字で照合用）
@@ -60,6 +702,41 @@ def main() -> None:
         if (cfg or {}).get("min_stock_base_path", "").strip()
     }
 
+    cache_mode = "off" if args.no_cache else "rebuild" if args.rebuild_cache else "use"
+    collect_metrics = bool(args.metrics)
+    profile_dir = Path(args.profile).resolve() if args.profile else None
+    if args.watch:
+        targets = {name: portals[original] or {} for name, original in target_portals_lower.items()}
+        _watch(
+            base_dir,
+            settings_path.resolve(),
+            settings,
+            targets,
+            cache_mode,
+            collect_metrics,
+            Path(args.metrics) if args.metrics else None,
+            profile_dir,
+        )
+        return
+    if backfill:
+        targets = {name: portals[original] or {} for name, original in target_portals_lower.items()}
+        results, entries = _backfill(
+            base_dir,
+            settings,
+            targets,
+            date_from,
+            date_to,
+            args.workers or os.cpu_count() or 1,
+            args.executor,
+            cache_mode,
+            collect_metrics,
+        )
+        _print_summary(results)
+        if collect_metrics:
+            _write_metrics(Path(args.metrics), results)
+        _write_backfill_report(Path(args.report or f"backfill_{date_from}_{date_to}.json"), date_from, date_to, entries)
+        return
+
     # ベースディレクトリ配下のサブディレクトリで対象ポータルに一致するものを収集
     to_process: list[Path] = []
     for sub in base_dir.iterdir():
@@ -67,17 +744,29 @@ def main() -> None:
             to_process.append(sub)
     to_process.sort(key=lambda p: p.name.lower())
 
-    main_py = Path(__file__).resolve().parent / "main.py"
-    for portal_dir in to_process:
-        portal_name = portal_dir.name
-        print(f"--- ポータル: {portal_name} ---", flush=True)
-        ret = subprocess.run(
-            [sys.executable, str(main_py), str(portal_dir), str(settings_path)],
-            cwd=str(Path(__file__).resolve().parent),
+    if args.workers is not None:
+        results = _run_in_process(
+            to_process,
+            settings_path.resolve(),
+            settings,
+            args.workers,
+            args.executor,
+            cache_mode,
+            collect_metrics,
+            profile_dir,
         )
-        if ret.returncode != 0:
-            print(f"警告: ポータル「{portal_name}」でエラー (exit {ret.returncode})", file=sys.stderr)
+    else:
+        results = []
+        for portal_dir in to_process:
+            print(f"--- ポータル: {portal_dir.name} ---", flush=True)
+            result = _run_portal_subprocess(portal_dir, settings_path, cache_mode, collect_metrics, profile_dir, args.sink)
+            if result.exit_code != 0:
+                print(f"警告: ポータル「{result.portal_name}」でエラー (exit {result.exit_code})", file=sys.stderr)
+            results.append(result)
 
+    _print_summary(results)
+    if collect_metrics:
+        _write_metrics(Path(args.metrics), results)
     print("全ポータル処理完了。", flush=True)
 
 